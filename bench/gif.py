@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Times converting a rasterized page to a GIF: with the original conversion,
+which masked transparency through a Python function and saved the result as
+a PNG; with `imaging.encode_gif` choosing a palette; and with it reusing a
+palette chosen for the same rendr revision.
+
+    python bench/gif.py [--width N] [--height N] [--images N]
+"""
+
+import time
+import random
+import cStringIO
+from PIL import Image
+from PIL import ImageDraw
+from rendr import imaging
+from optparse import OptionParser
+
+
+def make_page(width, height, seed=0):
+    """
+    Returns a page-like RGBA image: colored panels and text on a partly
+    transparent background.
+    """
+    rand = random.Random(seed)
+    img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    for _ in range(40):
+        left, top = rand.randrange(width), rand.randrange(height)
+        draw.rectangle((left, top, left + rand.randrange(width / 3),
+            top + rand.randrange(height / 3)),
+            fill=tuple(rand.randrange(256) for _ in range(3)) +
+                (rand.choice((96, 255)),))
+    for y in range(0, height, 16):
+        draw.text((rand.randrange(width / 2), y), "Hello %d" % seed * 8,
+            fill=(20, 20, 20, 255))
+    return img
+
+
+def encode_original(img):
+    img.load()
+    alpha = img.split()[3]
+    img = img.convert("RGB").convert("P",
+        palette=Image.ADAPTIVE, colors=255)
+    mask = Image.eval(alpha, lambda a: 255 if a <=128 else 0)
+    img.paste(255, mask)
+    buf = cStringIO.StringIO()
+    img.save(buf, "png", transparency=255)
+    return buf.getvalue()
+
+
+def encode_fresh(img):
+    return imaging.encode_gif(img)[0]
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--width", type="int", dest="width", default=2000)
+    parser.add_option("--height", type="int", dest="height", default=2000)
+    parser.add_option("--images", type="int", dest="images", default=5,
+        help="number of images of one rendr revision to convert")
+    (opts, args) = parser.parse_args()
+
+    # Each image is a different parameter set for the same rendr
+    pages = [make_page(opts.width, opts.height, i)
+        for i in range(opts.images)]
+    _, palette = imaging.encode_gif(pages[0])
+
+    for name, func in (("original", encode_original),
+            ("gif", encode_fresh),
+            ("gif-reused", lambda img: imaging.encode_gif(img, palette)[0])):
+        t = time.time()
+        size = sum(len(func(img)) for img in pages)
+        seconds = time.time() - t
+        print "%-10s %8.1f ms/image %8d bytes/image" % (name,
+            seconds * 1000 / opts.images, size / opts.images)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""
+Benchmarks the whole render pipeline: starts `bin/server` against an
+in-memory stand-in for S3 and a stand-in for PhantomJS which answers every
+page with the same PNG after a delay, drives concurrent requests for a
+rendr's images, HTML and JSON, and reports the throughput and p50/p95/p99
+latency of each.
+
+    python bench/pipeline.py [options] [-- server options]
+
+Server options are passed to `bin/server`, e.g. `-- --processes 4
+--rasterizers 8` to size a machine.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import pipes
+import random
+import shutil
+import signal
+import socket
+import urllib2
+import hashlib
+import tempfile
+import functools
+import subprocess
+import collections
+import multiprocessing
+import tornado.web
+import tornado.ioloop
+import tornado.netutil
+import tornado.httpserver
+import tornado.httpclient
+from optparse import OptionParser
+
+from gif import make_page
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUCKET = "bench"
+
+RENDR = {
+    "libraryId": "bench",
+    "rendrId": "bench",
+    "css": "div { color: {{color}}; font: 24px sans-serif; }",
+    "body": "<div>{{#params}}Hello {{.}}!{{/params}}</div>",
+}
+
+
+class S3Stub(tornado.web.RequestHandler):
+    """
+    Just enough of S3 for the server: objects are kept in memory, and GETs
+    and PUTs honor ETags as S3 does. Listings aren't supported.
+    """
+    def initialize(self, objects):
+        self.objects = objects
+
+    def _etag(self, key):
+        if key not in self.objects:
+            return None
+        return '"%s"' % hashlib.md5(self.objects[key]).hexdigest()
+
+    def get(self, key):
+        if self.request.query:
+            raise tornado.web.HTTPError(501)
+        etag = self._etag(key)
+        if etag is None:
+            raise tornado.web.HTTPError(404)
+
+        self.set_header("Etag", etag)
+        if self.request.headers.get("If-None-Match") == etag:
+            self.set_status(304)
+        else:
+            self.write(self.objects[key])
+
+    def put(self, key):
+        etag = self._etag(key)
+        if (etag and self.request.headers.get("If-None-Match") == "*") or \
+                self.request.headers.get("If-Match", etag) != etag:
+            raise tornado.web.HTTPError(412)
+
+        self.objects[key] = self.request.body
+        self.set_header("Etag", self._etag(key))
+
+    def delete(self, key):
+        self.objects.pop(key, None)
+        self.set_status(204)
+
+
+def run_s3(sockets, objects):
+    app = tornado.web.Application([
+        (r"/%s/(.+)" % BUCKET, S3Stub, {"objects": objects})])
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    tornado.ioloop.IOLoop.instance().start()
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(port, s3_port, workdir, opts, server_args):
+    """
+    Starts `bin/server` with the PhantomJS stand-in; returns the process.
+    """
+    png_path = os.path.join(workdir, "page.png")
+    make_page(opts.width, opts.height).save(png_path, "png")
+
+    # bin/server passes PhantomJS its own arguments, which the stand-in
+    # doesn't take
+    phantomjs = os.path.join(workdir, "phantomjs")
+    with open(phantomjs, "w") as f:
+        f.write("#!/bin/sh\nexec %s\n" % " ".join(pipes.quote(arg) for arg in
+            [sys.executable, os.path.join(ROOT, "rendr", "test",
+                "fake_rasterize"), "--delay", str(opts.delay), "--png",
+                png_path]))
+    os.chmod(phantomjs, 0755)
+
+    env = dict(os.environ, AWS_ACCESS_KEY_ID="bench",
+        AWS_SECRET_ACCESS_KEY="bench",
+        PYTHONPATH=os.pathsep.join([ROOT] + filter(None,
+            [os.getenv("PYTHONPATH")])))
+    log = open(os.path.join(workdir, "server.log"), "w")
+    return subprocess.Popen([sys.executable,
+            os.path.join(ROOT, "bin", "server"), "--port", str(port),
+            "--phantomjs", phantomjs,
+            "--s3-endpoint", "http://127.0.0.1:%d" % s3_port] +
+            server_args + [BUCKET],
+        env=env, stdout=log, stderr=subprocess.STDOUT,
+        # In its own process group, so its forked processes can be stopped
+        # with it
+        preexec_fn=os.setsid)
+
+
+def wait_for_server(process, port, timeout=60):
+    url = "http://127.0.0.1:%d/bench/bench/ready.json" % port
+    deadline = time.time() + timeout
+    while time.time() < deadline and process.poll() is None:
+        try:
+            urllib2.urlopen(url, timeout=1).read()
+            return True
+        except (urllib2.URLError, socket.error):
+            time.sleep(0.2)
+    return False
+
+
+def run_load(port, formats, requests, concurrency, distinct):
+    """
+    Makes `requests` requests with `concurrency` in progress at once, cycling
+    through `formats`. Returns ({format: [(seconds, code)]}, seconds).
+    """
+    io_loop = tornado.ioloop.IOLoop.instance()
+    client = tornado.httpclient.AsyncHTTPClient(io_loop=io_loop,
+        max_clients=concurrency, force_instance=True)
+    rand = random.Random(0)
+    results = collections.defaultdict(list)
+    counts = {"sent": 0, "done": 0}
+
+    def send():
+        format = formats[counts["sent"] % len(formats)]
+        counts["sent"] += 1
+        url = "http://127.0.0.1:%d/bench/bench/%d.%s?color=%s" % (port,
+            rand.randrange(distinct), format,
+            rand.choice(("red", "green", "blue")))
+        client.fetch(url, functools.partial(on_response, format, time.time()),
+            request_timeout=120)
+
+    def on_response(format, start, response):
+        results[format].append((time.time() - start, response.code))
+        counts["done"] += 1
+        if counts["sent"] < requests:
+            send()
+        elif counts["done"] == requests:
+            io_loop.stop()
+
+    t = time.time()
+    for _ in range(min(concurrency, requests)):
+        send()
+    io_loop.start()
+    return results, time.time() - t
+
+
+def percentile(values, p):
+    """
+    Returns the `p`th percentile of sorted `values`, by nearest rank.
+    """
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def report(results, seconds):
+    print "%-8s %8s %8s %9s %9s %9s %9s" % ("endpoint", "requests",
+        "errors", "req/s", "p50 ms", "p95 ms", "p99 ms")
+    rows = [(format, results[format]) for format in sorted(results)]
+    rows.append(("all", sum(results.values(), [])))
+    for name, row in rows:
+        latencies = sorted(r[0] * 1000 for r in row)
+        print "%-8s %8d %8d %9.1f %9.1f %9.1f %9.1f" % (name, len(row),
+            sum(1 for r in row if r[1] != 200), len(row) / seconds,
+            percentile(latencies, 50), percentile(latencies, 95),
+            percentile(latencies, 99))
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options] [-- server options]")
+    parser.add_option("--requests", type="int", dest="requests",
+        default=1000, help="number of requests to make")
+    parser.add_option("--concurrency", type="int", dest="concurrency",
+        default=20, help="keep N requests in progress at once")
+    parser.add_option("--formats", type="string", dest="formats",
+        default="png,jpg,gif,html,json",
+        help="request these formats, in turn")
+    parser.add_option("--distinct", type="int", dest="distinct",
+        default=100, help="spread requests over N parameter sets per " +
+            "format; fewer means more cache hits")
+    parser.add_option("--delay", type="float", dest="delay", default=0.05,
+        help="the stand-in PhantomJS takes SECONDS to render a page")
+    parser.add_option("--width", type="int", dest="width", default=600)
+    parser.add_option("--height", type="int", dest="height", default=400)
+    (opts, server_args) = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="rendr-bench-")
+    objects = {"bench/rendrs/bench.json": json.dumps(RENDR)}
+
+    s3_sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    s3_port = s3_sockets[0].getsockname()[1]
+    s3 = multiprocessing.Process(target=run_s3, args=(s3_sockets, objects))
+    s3.start()
+    for sock in s3_sockets:
+        sock.close()
+
+    port = free_port()
+    server = start_server(port, s3_port, workdir, opts, server_args)
+    try:
+        if not wait_for_server(server, port):
+            with open(os.path.join(workdir, "server.log")) as f:
+                sys.stderr.write(f.read()[-4000:])
+            sys.exit("bin/server didn't start")
+
+        results, seconds = run_load(port, opts.formats.split(","),
+            opts.requests, opts.concurrency, opts.distinct)
+        report(results, seconds)
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
+        s3.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Times building a rendr's HTML page -- the templating done for every image --
+with templates parsed on every request, as `pystache.render` does, and with
+parsed templates cached by `render_html`.
+
+    python bench/templates.py [--sections N] [--requests N]
+"""
+
+import json
+import timeit
+import pystache
+import rendr
+from optparse import OptionParser
+
+
+def make_rendr(sections):
+    """
+    Returns a personalized rendr with `sections` conditional sections.
+    """
+    body = "".join("""
+        {{#show%d}}
+            <div class="section-%d">
+                <h2>Hello {{name}}!</h2>
+                {{#items}}<span>{{.}}</span>{{/items}}
+                {{^items}}<span>Nothing yet</span>{{/items}}
+            </div>
+        {{/show%d}}""" % (i, i, i) for i in range(sections))
+    css = "".join(".section-%d { color: {{color}}; }\n" % i
+        for i in range(sections))
+    return {"libraryId": "bench", "rendrId": "bench", "css": css,
+        "body": body}
+
+
+def render_uncached(rendr_obj, data):
+    return pystache.render("""
+        <!DOCTYPE html>
+        <html>
+            <head>
+                <style>{{{css}}}</style>
+                <script>window.query = {{{data}}};</script>
+            </head>
+            <body style="margin:0;padding:0;overflow:hidden">
+                {{{html}}}
+            </body>
+        </html>
+    """, {
+        "css": pystache.render(rendr_obj["css"], data),
+        "html": pystache.render(rendr_obj["body"], data),
+        "data": json.dumps(data),
+    })
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--sections", type="int", dest="sections", default=50,
+        help="number of sections in the rendr body")
+    parser.add_option("--requests", type="int", dest="requests",
+        default=200, help="number of pages to build")
+    (opts, args) = parser.parse_args()
+
+    rendr_obj = make_rendr(opts.sections)
+    data = {"name": "Alice", "color": "red", "items": ["a", "b", "c"],
+        "params": ["x"]}
+    data.update(("show%d" % i, i % 2 == 0) for i in range(opts.sections))
+
+    for name, func in (("uncached", render_uncached),
+            ("cached", rendr.render_html)):
+        seconds = timeit.timeit(lambda: func(rendr_obj, data),
+            number=opts.requests)
+        print "%-10s %8.3f ms/request" % (name,
+            seconds * 1000 / opts.requests)
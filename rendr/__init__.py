@@ -21,30 +21,34 @@
 import os
 import cgi
 import json
+import math
 import uuid
 import stat
 import time
 import email
-import Image
-import base64
 import slimit
 import cssmin
 import urllib
 import hashlib
 import httplib
 import pystache
-import tempfile
+import functools
 import datetime
-import cStringIO
-import subprocess
 import tornado.web
 import logging as log
+import tornado.escape
 import tornado.ioloop
 import tornado.template
 from tornado import gen
-from rendr import asyncs3
+from rendr import warmer
+from rendr import imaging
+from rendr import inflight
+from rendr import scheduler
+from rendr import asyncpool
+from rendr import rasterpool
 from rendr import pycollectd
-from rendr import asyncprocess
+from rendr import imagecache
+from rendr import templatecache
 
 
 ASSET_MANIFEST = {
@@ -82,31 +86,105 @@ ASSET_MANIFEST = {
 }
 
 
-def delete_files(folder, max, lifetime):
+def rendr_revision(rendr):
     """
-    folder: str
-        the folder whose files are to be deleted
-    max: int
-        the maximum number of files to be deleted
-    lifetime: int
-        the time (secs) each file allowed to exist before deleted
-
-    Deletes up to max number of files older than the lifetime.
+    rendr: dict
+        the rendr object, as stored
+
+    Returns a short hash which changes whenever the rendr is modified.
     """
-    count = 0
-    now = time.time()
-    for (root, _, names) in os.walk(folder, topdown=False):
-        for name in names:
-            if name.lower().rpartition(".")[2] not in ("png", "jpg", "gif"):
-                continue
+    return hashlib.sha1(json.dumps(rendr, sort_keys=True)).hexdigest()[:16]
 
-            target = os.path.join(root, name)
-            diff = now - os.path.getctime(target)
-            if diff > lifetime:
-                os.remove(target)
-                count += 1
-                if count == max:
-                    return
+
+def valid_regions(regions):
+    """
+    regions: dict
+        named regions of a rendr's image, as
+        {name: [top, left, bottom, right]}
+
+    Returns True if each region is a non-empty rectangle.
+    """
+    if not isinstance(regions, dict):
+        return False
+    for name, clip in regions.iteritems():
+        if not isinstance(clip, list) or len(clip) != 4 or \
+                not all(isinstance(n, int) and n >= 0 for n in clip):
+            return False
+        top, left, bottom, right = clip
+        if bottom <= top or right <= left:
+            return False
+    return True
+
+
+def valid_warm_paths(paths):
+    """
+    paths: list
+        image paths relative to a rendr, e.g. "hello.png?color=red"
+
+    Returns True if there are up to 20 paths to images.
+    """
+    return isinstance(paths, list) and len(paths) <= 20 and all(
+        isinstance(path, basestring) and
+        path.partition("?")[0].rpartition(".")[2] in imaging.FORMATS
+        for path in paths)
+
+
+def _int_param(value, low, high, default=None):
+    """
+    Returns a request parameter as an int from `low` to `high`, or
+    `default` if it isn't one.
+    """
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    return value if low <= value <= high else default
+
+
+def _url_quote(path):
+    # Escapes what a browser would, leaving existing escapes alone
+    return urllib.quote(tornado.escape.utf8(path), safe="/%?&=+;:,@!$'()*~")
+
+
+# The page served to the rasterizer, with the rendr's CSS and body
+_HTML_WRAPPER = pystache.parse(u"""
+    <!DOCTYPE html>
+    <html>
+        <head>
+            <style>{{{css}}}</style>
+            <script>
+                window.query = {{{data}}};
+                window.decodeBase64UrlSafe = function (s) {
+                    s = s.replace(/-/g, '+').replace(/_/g, '/');
+                    return decodeURIComponent(escape(atob(s)));
+                };
+            </script>
+        </head>
+        <body style="margin:0;padding:0;overflow:hidden">
+            {{{html}}}
+        </body>
+    </html>
+""")
+
+# Parsed rendr CSS and body templates
+_templates = templatecache.TemplateCache()
+
+
+def render_html(rendr, data):
+    """
+    rendr: dict
+        the rendr object, as stored
+    data: dict
+        the query parameters to render it with
+
+    Returns the HTML page for the rendr, as served to the rasterizer.
+    """
+    key = (rendr.get("libraryId"), rendr.get("rendrId"))
+    return pystache.render(_HTML_WRAPPER, {
+        "css": _templates.render(key + ("css",), rendr["css"], data),
+        "html": _templates.render(key + ("body",), rendr["body"], data),
+        "data": json.dumps(data),
+    })
 
 
 class UI(tornado.web.RequestHandler):
@@ -115,6 +193,23 @@ class UI(tornado.web.RequestHandler):
     def initialize(self, environment=None):
         self.environment = environment
 
+    def write_error(self, status_code, **kwargs):
+        if "retry_after" in kwargs:
+            self.set_header("Retry-After", kwargs["retry_after"])
+        super(UI, self).write_error(status_code, **kwargs)
+
+    def _key_error(self, error):
+        """
+        Responds to a library key which couldn't be checked: with a 503 if
+        the verifier is too busy, so the client tries again, rather than
+        being told the key is wrong.
+        """
+        if isinstance(error, asyncpool.PoolFull):
+            self.application.queue_count("rendrit_keys", "rejected")
+            self.send_error(503, retry_after=1)
+        else:
+            self.send_error(500)
+
     # Stupid override to stop Tornado removing whitespace from the template
     def create_template_loader(self, template_path):
         if "template_loader" in self.application.settings:
@@ -189,7 +284,13 @@ class LibraryManager(UI):
                 raise tornado.web.HTTPError(404)
 
         # Validate the library against the library key hash
-        if not asyncs3.pwd_context.verify(library_key, result["keyHash"]):
+        verified = yield gen.Task(self.db.verify_library_key, library_id,
+            result, library_key)
+        valid, error = verified.args
+        if error:
+            self._key_error(error)
+            return
+        elif not valid:
             # If a UI view, redirect to the homepage
             if "json" not in self.request.headers.get("Accept"):
                 self.redirect("/")
@@ -199,8 +300,8 @@ class LibraryManager(UI):
 
         # Retrieve the rendrs for this library
         rendrs = yield gen.Task(self.db.list_rendrs, library_id)
-        if not result or "error" in result:
-            raise tornado.web.HTTPError(404)
+        if isinstance(rendrs, dict):
+            raise tornado.web.HTTPError(500)
 
         del result["keyHash"]
         result["rendrs"] = rendrs
@@ -221,10 +322,18 @@ class LibraryManager(UI):
 
 
 class RendrManager(UI):
-    """APIs to work work rendr objects."""
-    def initialize(self, db=None, environment=None):
+    """
+    APIs to work work rendr objects.
+
+    When a rendr is saved, its images are deleted from `cache`, and if
+    there's a `warmer`, its test image and any paths in its "warmPaths"
+    are rendered into the cache in the background.
+    """
+    def initialize(self, db=None, environment=None, cache=None, warmer=None):
         super(RendrManager, self).initialize(environment=environment)
         self.db = db
+        self.cache = cache
+        self.warmer = warmer
 
     @tornado.web.asynchronous
     @gen.engine
@@ -242,42 +351,94 @@ class RendrManager(UI):
             raise tornado.web.HTTPError(404)
 
         # Validate the library against the library key
-        if not asyncs3.pwd_context.verify(req["libraryKey"], library_data["keyHash"]):
+        result = yield gen.Task(self.db.verify_library_key, library_id,
+            library_data, req["libraryKey"])
+        valid, error = result.args
+        if error:
+            self._key_error(error)
+            return
+        elif not valid:
             raise tornado.web.HTTPError(403)
 
         # The key matches, so update the rendr.
+        rendr = {
+            "rendrId": rendr_id,
+            "libraryId": library_id,
+            "css": req["css"],
+            "body": req["body"],
+            "testPath": req["testPath"],
+            "testParams": req["testParams"]
+        }
+        current = None
+        for field, valid in (("regions", valid_regions),
+                ("warmPaths", valid_warm_paths)):
+            if field in req:
+                value = req[field]
+                if value and not valid(value):
+                    raise tornado.web.HTTPError(400)
+            else:
+                # Saves from clients which don't know about the field keep
+                # the rendr's existing value
+                if current is None:
+                    current = yield gen.Task(self.db.read_rendr, library_id,
+                        rendr_id)
+                value = (current or {}).get(field)
+            if value:
+                rendr[field] = value
         result = yield gen.Task(self.db.write_rendr, library_id,
-            rendr_id, {
-                "rendrId": rendr_id,
-                "libraryId": library_id,
-                "css": req["css"],
-                "body": req["body"],
-                "testPath": req["testPath"],
-                "testParams": req["testParams"]
-            }
-        )
+            rendr_id, rendr)
 
         if not result or "error" in result:
             raise tornado.web.HTTPError(500)
 
+        # Images of the old revision can't be asked for any more
+        if self.cache:
+            self.cache.delete_rendr(library_id, rendr_id)
+        if self.warmer:
+            prefix = "/%s/%s/" % (urllib.quote(library_id),
+                urllib.quote(rendr_id))
+            self.warmer.warm([prefix + _url_quote(path) for path in
+                ["%s.png?%s" % (rendr["testPath"] or "",
+                    rendr["testParams"] or "")] +
+                rendr.get("warmPaths", [])],
+                revision=rendr_revision(rendr))
+
         self.set_header("Content-Type", "application/json")
         self.write(result)
         self.finish()
 
 
 class Renderer(tornado.web.RequestHandler):
-    _rendr_failure_times = {}
+    _in_flight = inflight.InFlight()
 
-    def initialize(self, db=None, timeout=None, phantomjs=None,
-            rasterize=None, port=None, static_subdomains=None):
+    def initialize(self, db=None, timeout=None, rasterizers=None, port=None,
+            static_subdomains=None, cache=None, encoder=None,
+            transfer=None, scratch=None, scheduler=None, max_wait=None,
+            breaker=None, palettes=None, jpeg_progressive=False,
+            png_compress_level=None, negotiate=False):
         self.db = db
         self.timeout = timeout or 10
-        self.phantomjs = phantomjs
-        self.rasterize = rasterize
+        self.rasterizers = rasterizers
         self.port = port
         self.static_subdomains = static_subdomains
+        self.cache = cache
+        self.encoder = encoder
+        self.transfer = transfer or "pipe"
+        self.scratch = scratch
+        self.scheduler = scheduler
+        self.max_wait = max_wait or self.timeout / 2.0
+        self.breaker = breaker
+        self.palettes = palettes
+        self.jpeg_progressive = jpeg_progressive
+        self.png_compress_level = png_compress_level
+        self.negotiate = negotiate
+        # (library_id, rendr_id, revision) of the rendr being rendered, for
+        # reusing its GIF palette
+        self.palette_key = None
 
     def write_error(self, status_code, **args):
+        if "retry_after" in args:
+            self.set_header("Retry-After", args["retry_after"])
         if "message" in args:
             args["message"] = "<pre>%s</pre>" % cgi.escape(args["message"])
 
@@ -289,6 +450,298 @@ class Renderer(tornado.web.RequestHandler):
                         "message": args.get("message", ""),
                     })
 
+    def _set_cache_headers(self):
+        self.set_header("Date", datetime.datetime.utcnow())
+        self.set_header("Expires", datetime.datetime.utcnow() +
+            datetime.timedelta(seconds=3600))
+        self.set_header("Cache-Control", "public, max-age=" +
+            str(3600))
+
+    def _check_etag(self, etag):
+        """
+        Sets the response's ETag. If the client already has it, sends a 304
+        response and returns True.
+        """
+        self.set_header("Etag", etag)
+        inm = self.request.headers.get("If-None-Match")
+        if not inm:
+            return False
+
+        # If-None-Match uses the weak comparison
+        weak = lambda tag: tag[2:] if tag.startswith("W/") else tag
+        tags = [t.strip() for t in inm.split(",")]
+        if "*" in tags or weak(etag) in [weak(t) for t in tags]:
+            self.set_status(304)
+            self.finish()
+            return True
+        return False
+
+    def _write_image(self, format, body):
+        self._set_cache_headers()
+        if "+" in format:
+            # Negotiated -- whichever format came out smallest
+            format = imaging.image_format(body)
+        self.set_header("Content-Type", imaging.MIME_TYPES[format])
+        self.write(body)
+
+    @gen.engine
+    def _encode(self, png, format, quality, clip=None, options=None,
+            callback=None):
+        """
+        Converts a PNG image to `format`, optionally cropping it to `clip`
+        (top, left, bottom, right), with the encoding `options` of
+        `imaging.encode_image`. Calls back with `(body, error)`; a region
+        outside the image is a 400 error.
+        """
+        # Encoding is CPU-bound, so it runs in the encoder pool where there
+        # is one
+        if format == "png" and not clip and not options:
+            callback(png, None)
+            return
+
+        palette = None
+        if format == "gif" and self.palettes and self.palette_key:
+            palette = self.palettes.get(self.palette_key)
+
+        if not self.encoder:
+            try:
+                body, _, new_palette = imaging.encode_image(png, format,
+                    quality, clip, palette, options)
+            except imaging.RegionError as e:
+                callback(None, tornado.web.HTTPError(400, str(e)))
+                return
+        else:
+            t_encode = time.time()
+            result = yield gen.Task(self.encoder.run, imaging.encode_image,
+                png, format, quality, clip, palette, options)
+            encoded, error = result.args
+            if isinstance(error, asyncpool.PoolFull):
+                callback(None, self._busy(None, "encoders busy"))
+                return
+            elif isinstance(error, imaging.RegionError):
+                callback(None, tornado.web.HTTPError(400, str(error)))
+                return
+            elif error:
+                callback(None, error)
+                return
+
+            body, encode_time, new_palette = encoded
+            name = format.replace("+", "_or_")
+            self.application.queue_metric("rendrit_encode",
+                name + "_wait", time.time() - t_encode - encode_time,
+                pycollectd.CollectdClient.average)
+            self.application.queue_metric("rendrit_encode",
+                name + "_time", encode_time,
+                pycollectd.CollectdClient.average)
+
+        if palette is None and new_palette and self.palettes and \
+                self.palette_key:
+            self.palettes.put(self.palette_key, new_palette)
+        callback(body, None)
+
+    def _busy(self, library_id, reason):
+        """
+        Returns a RenderRejected for work shed because the server is busy,
+        suggesting a retry once `library_id`'s queue should have moved.
+        """
+        wait = 0
+        if self.scheduler:
+            wait = self.scheduler.expected_wait(library_id)
+        return scheduler.RenderRejected(reason, max(1, int(math.ceil(wait))))
+
+    @gen.engine
+    def _render_image(self, library_id, rendr_id, query_uri, html, format,
+            quality, options, cache_key, deadline, background=False,
+            callback=None):
+        """
+        Rasterizes and encodes an image, and adds it to the cache. Calls back
+        with `(body, error)`, where `error` is an HTTPError, or a
+        RenderRejected if the render couldn't start by `deadline`. With
+        `background`, the render gives way to all others.
+
+        The page is rendered from `html`, with `query_uri` as its address so
+        relative URLs still resolve against this server.
+        """
+        # Shed load rather than queueing more work than the rasterizers
+        # and encoders can get through
+        if self.rasterizers.is_full() or (self.encoder and
+                format != "png" and self.encoder.is_full()):
+            if self.breaker:
+                self.breaker.release((library_id, rendr_id))
+            callback(None, self._busy(library_id, "rasterizers busy"))
+            return
+
+        ticket = None
+        if self.scheduler:
+            self.application.queue_metric("rendrit_scheduler",
+                "queue_length", self.scheduler.queue_length(),
+                pycollectd.CollectdClient.average)
+            self.application.queue_metric("rendrit_library_queue",
+                library_id, self.scheduler.queue_length(library_id),
+                pycollectd.CollectdClient.average)
+            result = yield gen.Task(self.scheduler.acquire, library_id,
+                deadline, background=background)
+            ticket, error = result.args
+            if error:
+                self.application.queue_count("rendrit_scheduler",
+                    "rejected")
+                self.application.queue_count("rendrit_library_rejected",
+                    library_id)
+                if self.breaker:
+                    self.breaker.release((library_id, rendr_id))
+                callback(None, error)
+                return
+            self.application.queue_metric("rendrit_scheduler", "wait",
+                ticket.started - ticket.queued,
+                pycollectd.CollectdClient.average)
+            self.application.queue_metric("rendrit_library_wait",
+                library_id, ticket.started - ticket.queued,
+                pycollectd.CollectdClient.average)
+
+        # In "pipe" mode the rasterizer sends the image back in its
+        # response, rather than through a temporary file
+        if self.transfer == "pipe":
+            output_path = None
+        else:
+            output_path = self.scratch.mkstemp(suffix=".png")
+
+        try:
+            response = yield gen.Task(self.rasterizers.rasterize, query_uri,
+                output_path, html=html)
+        finally:
+            if ticket:
+                self.scheduler.release(ticket)
+
+        # Track the last failure
+        if not response.startswith("success"):
+            if output_path:
+                self.scratch.remove(output_path)
+            log.error("Renderer._render_image failure (%s): %s" % (query_uri,
+                response))
+            # Rendr failures caused by timeouts count towards tripping the
+            # rendr's circuit breaker; other failures don't, and close it
+            if self.breaker and rasterpool.timed_out(response):
+                self.breaker.failure((library_id, rendr_id))
+            elif self.breaker:
+                self.breaker.success((library_id, rendr_id))
+            callback(None, tornado.web.HTTPError(504, response))
+            return
+
+        if self.breaker:
+            self.breaker.success((library_id, rendr_id))
+
+        if output_path:
+            with open(output_path, "rb") as f:
+                png = f.read()
+            self.scratch.remove(output_path)
+        else:
+            png = rasterpool.image_data(response)
+
+        result = yield gen.Task(self._encode, png, format, quality,
+            options=options)
+        body, error = result.args
+        if error:
+            callback(None, error)
+            return
+
+        if self.cache:
+            evicted = self.cache.put(cache_key, body)
+            if evicted:
+                self.application.queue_count("rendrit_cache", "evict",
+                    evicted)
+
+        callback(body, None)
+
+    @gen.engine
+    def _render(self, library_id, rendr_id, rendr, rendr_desc, data, format,
+            quality, options, cache_key, t, callback=None):
+        """
+        Renders an image which isn't in the cache, sharing the render with
+        any concurrent requests for the same image. Calls back with
+        `(body, error)`.
+        """
+        query_uri = "http://127.0.0.1:%s/%s/%s.html%s" % (self.port,
+            library_id, rendr_desc,
+            "?" + self.request.query if self.request.query else "")
+
+        # The rasterizer gets the page directly, rather than fetching it
+        # back from the .html endpoint
+        html = render_html(rendr, data)
+
+        # The server warms its cache with background renders, which give
+        # way to everything else. Concurrent requests for the same image
+        # share one render, but a background render is only shared with
+        # other background requests, so no client waits behind it.
+        background = warmer.from_warmer(self.request) and \
+            self.request.headers.get(warmer.PRIORITY_HEADER) == "background"
+        flight_key = cache_key
+        if background and cache_key not in Renderer._in_flight:
+            flight_key = cache_key + ("background",)
+
+        if flight_key in Renderer._in_flight:
+            self.application.queue_count("rendrit_render", "coalesced")
+        elif self.breaker and \
+                not self.breaker.allow((library_id, rendr_id)):
+            # The rendr keeps timing out -- refuse to render it for a
+            # while. This prevents infinite rendr loops, provided there
+            # are fewer than 8 or so rendrs in the loop.
+            self.application.queue_count("rendrit_breaker", "refused")
+            callback(None, scheduler.RenderRejected("rendr keeps failing",
+                max(1, int(math.ceil(self.breaker.retry_after(
+                    (library_id, rendr_id)))))))
+            return
+        else:
+            self.application.queue_count("rendrit_render", "started")
+        result = yield gen.Task(Renderer._in_flight.run, flight_key,
+            functools.partial(self._render_image, library_id, rendr_id,
+                query_uri, html, format, quality, options, cache_key,
+                t + self.max_wait, background))
+        callback(*result.args)
+
+    def _choose_encoding(self, format, data):
+        """
+        Returns the `(format, quality, options)` to encode an image with,
+        from the server's settings and the "q", "zlib" and "colors"
+        parameters; see `imaging.encode_image`. When negotiating, a PNG or
+        JPEG is served as a WebP if the client accepts them and it comes out
+        smaller; the format is then "png+webp" or "jpg+webp".
+        """
+        if self.negotiate and format in ("png", "jpg"):
+            # The response depends on what the client accepts
+            self.set_header("Vary", "Accept")
+            if "image/webp" in self.request.headers.get("Accept", "") and \
+                    imaging.can_encode("webp"):
+                format += "+webp"
+
+        formats = format.split("+")
+        options = {}
+        if "jpg" in formats and self.jpeg_progressive:
+            options["progressive"] = True
+        if "png" in formats:
+            level = _int_param(data.get("zlib"), 0, 9,
+                self.png_compress_level)
+            if level is not None:
+                options["compress_level"] = level
+            colors = _int_param(data.get("colors"), 2, 256)
+            if colors:
+                options["colors"] = colors
+
+        # A WebP standing in for a PNG is lossless, like the PNG
+        quality = None
+        if "jpg" in formats or formats == ["webp"]:
+            quality = _int_param(data.get("q"), 1, 100, 70)
+        return format, quality, options
+
+    def _send_render_error(self, error):
+        if isinstance(error, scheduler.RenderRejected):
+            self.send_error(503, message=str(error),
+                retry_after=error.retry_after)
+        elif isinstance(error, tornado.web.HTTPError):
+            self.send_error(error.status_code,
+                message=error.log_message or "")
+        else:
+            self.send_error(500)
+
     @tornado.web.asynchronous
     @gen.engine
     def get(self, format):
@@ -321,80 +774,99 @@ class Renderer(tornado.web.RequestHandler):
 
         format = format.lower()
 
-        if format in ("jpg", "gif", "png"):
-            # Check recency of last total failure -- if less than timeout * 10,
-            # throw an error immediately. This prevents infinite rendr loops,
-            # provided there are fewer than 8 or so rendrs in the loop.
-            if t - Renderer._rendr_failure_times.get((library_id, rendr_id), 0) \
-                    < self.timeout * 10:
-                raise tornado.web.HTTPError(503)
-
-            query_uri = "http://127.0.0.1:%s/%s/%s.html%s" % (self.port,
-                library_id, rendr_desc,
-                "?" + self.request.query if self.request.query else "")
-            fd, output_path = tempfile.mkstemp(suffix=".png")
-            os.close(fd) # not using it yet
-
-            result = yield gen.Task(asyncprocess.run_cmd,
-                [self.phantomjs, "--disk-cache=yes",
-                "--max-disk-cache-size=524288", self.rasterize, query_uri,
-                output_path],
-                self.timeout)
-
-            # Track the last failure
-            if not result[0][0].startswith("success"):
-                log.error("Renderer.get failure (%s): %s" % (self.request.uri,
-                    result[0][0]))
-                # Any rendr failures caused by timeouts will trigger a lockout
-                # for 10 times the timeout duration
-                if time.time() - t > self.timeout - 1.0:
-                    Renderer._rendr_failure_times[(library_id, rendr_id)] = t
-                self.send_error(504, message='\n'.join(
-                    l for l in result[0][0].split('\n')
-                        if not l.startswith('success: written')))
+        if format in imaging.FORMATS:
+            if not imaging.can_encode(format):
+                raise tornado.web.HTTPError(400)
+            format, quality, options = self._choose_encoding(format, data)
+
+            # Retrieve the rendr, so the cache key reflects its current
+            # revision
+            rendr = yield gen.Task(self.db.read_rendr, library_id,
+                rendr_id)
+            # Warming a rendr just saved by another process, which this
+            # one may have an old copy of. Only the warmer may ask for
+            # this, as it goes back to S3.
+            revision = None
+            if warmer.from_warmer(self.request):
+                revision = self.request.headers.get(warmer.REVISION_HEADER)
+            if revision and rendr and "error" not in rendr and \
+                    rendr_revision(rendr) != revision:
+                rendr = yield gen.Task(self.db.read_rendr, library_id,
+                    rendr_id, revalidate=True)
+            if not rendr or "error" in rendr:
+                raise tornado.web.HTTPError(404)
+
+            # Rendrs may define named regions, each served as a crop of the
+            # whole image, so a sliced layout only needs one render. Where
+            # none are defined, "region" is an ordinary parameter.
+            regions = rendr.get("regions") or {}
+            region = data.pop("region", None) if regions else None
+            if region is not None and (not isinstance(region, basestring)
+                    or region not in regions):
+                raise tornado.web.HTTPError(404)
+
+            revision = rendr_revision(rendr)
+            self.palette_key = (library_id, rendr_id, revision)
+            cache_key = imagecache.cache_key(library_id, rendr_id,
+                revision, data, format, quality, region=region,
+                options=options)
+
+            # The cache key covers everything the image depends on, so it
+            # makes a strong ETag; revalidation needs no render at all, and
+            # no S3 read while the definition is cached. GIFs sharing a
+            # palette depend on which GIF chose it, though, so they're only
+            # equivalent from one encoding to the next.
+            etag = '"%s"' % cache_key[2]
+            if format == "gif" and self.palettes:
+                etag = "W/" + etag
+            self._set_cache_headers()
+            if self._check_etag(etag):
                 return
 
-            # Serve output path
-            self.set_header("Date", datetime.datetime.utcnow())
-            self.set_header("Expires", datetime.datetime.utcnow() +
-                datetime.timedelta(seconds=3600))
-            self.set_header("Cache-Control", "public, max-age=" +
-                str(3600))
-            self.set_header("Content-Type",
-                "image/" + ("jpeg" if format == "jpg" else format))
-            # Use PIL to convert image to the desired output format, if it's
-            # not PNG
-            if format == "png":
-                with open(output_path, "rb") as f:
-                    self.write(f.read())
-            else:
-                img = Image.open(output_path, "r")
-                buf = cStringIO.StringIO()
-                if format == "jpg":
-                    try:
-                        quality = int(data["q"])
-                    except Exception:
-                        quality = 70
-                    img = img.convert("RGB")
-                    img.save(buf, "jpeg", quality=quality)
-                elif format == "gif":
-                    # Convert to GIF while maintaining transparency
-                    img.load()
-                    alpha = img.split()[3]
-                    img = img.convert("RGB").convert("P",
-                        palette=Image.ADAPTIVE, colors=255)
-                    # Set all pixel values below 128 to 255, and the rest to 0
-                    mask = Image.eval(alpha, lambda a: 255 if a <=128 else 0)
-                    img.paste(255, mask)
-                    # The transparency index is 255
-                    img.save(buf, "png", transparency=255)
-
-                self.write(buf.getvalue())
+            if self.cache:
+                body, tier = self.cache.get(cache_key)
+                self.application.queue_count("rendrit_cache",
+                    tier + "_hit" if tier else "miss")
+                if body is not None:
+                    self._write_image(format, body)
+                    self.finish()
+                    return
 
-            self.finish()
+            # Regions are cropped from the whole image as a PNG, which is
+            # rendered and cached just as if it had been asked for itself
+            body = None
+            render_format, render_key = format, cache_key
+            if region is not None:
+                render_format = "png"
+                render_key = imagecache.cache_key(library_id, rendr_id,
+                    revision, data, "png")
+                if self.cache:
+                    body, _ = self.cache.get(render_key)
+
+            if body is None:
+                result = yield gen.Task(self._render, library_id, rendr_id,
+                    rendr, rendr_desc, data, render_format, quality,
+                    None if region is not None else options, render_key, t)
+                body, error = result.args
+                if error:
+                    self._send_render_error(error)
+                    return
 
-            # Delete upto 2 files older than 60 seconds
-            delete_files(os.path.dirname(output_path), 2, 60)
+            if region is not None:
+                result = yield gen.Task(self._encode, body, format, quality,
+                    regions[region], options)
+                body, error = result.args
+                if error:
+                    self._send_render_error(error)
+                    return
+                if self.cache:
+                    evicted = self.cache.put(cache_key, body)
+                    if evicted:
+                        self.application.queue_count("rendrit_cache",
+                            "evict", evicted)
+
+            self._write_image(format, body)
+            self.finish()
         elif format in ("html", "json"):
             # Retrieve the rendr file
             rendr = yield gen.Task(self.db.read_rendr, library_id,
@@ -402,40 +874,332 @@ class Renderer(tornado.web.RequestHandler):
             if not rendr or "error" in rendr:
                 raise tornado.web.HTTPError(404)
 
+            # The JSON doesn't depend on the parameters
+            etag_key = imagecache.cache_key(library_id, rendr_id,
+                rendr_revision(rendr), data if format == "html" else {},
+                format)
+            if self._check_etag('"%s"' % etag_key[2]):
+                return
+
             # Render the rendr
             if format == "json":
                 self.set_header("Content-Type", "application/json")
                 self.write(rendr)
             elif format == "html":
                 self.set_header("Content-Type", "text/html")
-                self.write(pystache.render("""
-                    <!DOCTYPE html>
-                    <html>
-                        <head>
-                            <style>{{{css}}}</style>
-                            <script>
-                                window.query = {{{data}}};
-                                window.decodeBase64UrlSafe = function (s) {
-                                    s = s.replace(/-/g, '+').replace(/_/g, '/');
-                                    return decodeURIComponent(escape(atob(s)));
-                                };
-                            </script>
-                        </head>
-                        <body style="margin:0;padding:0;overflow:hidden">
-                            {{{html}}}
-                        </body>
-                    </html>
-                """, {
-                    "css": pystache.render(rendr["css"], data),
-                    "html": pystache.render(rendr["body"], data),
-                    "data": json.dumps(data),
-                }))
+                self.write(render_html(rendr, data))
 
             self.finish()
         else:
             raise tornado.web.HTTPError(400)
 
 
+def _batch_data(item):
+    """
+    Returns the render data for one parameter set in a batch: an object of
+    query parameters, with the path parameters as a list in "params". Returns
+    None if it isn't valid.
+    """
+    if not isinstance(item, dict):
+        return None
+
+    data = {}
+    for k, v in item.iteritems():
+        values = v if isinstance(v, list) else [v]
+        if not all(isinstance(value, basestring) for value in values):
+            return None
+        if k == "params" or len(values) != 1:
+            data[k] = values
+        else:
+            data[k] = values[0]
+    data["params"] = data.get("params") or [""]
+    return data
+
+
+def _batch_path(library_id, rendr_id, data, ext):
+    """
+    Returns the path of the GET request equivalent to one set of parameters
+    in a batch.
+    """
+    query = [(k, tornado.escape.utf8(value)) for k, v in sorted(data.items())
+        if k != "params" for value in (v if isinstance(v, list) else [v])]
+    return "/%s/%s/%s.%s%s" % (urllib.quote(library_id),
+        urllib.quote(rendr_id), "/".join(urllib.quote(
+            tornado.escape.utf8(p), safe="") for p in data["params"]), ext,
+        "?" + urllib.urlencode(query) if query else "")
+
+
+class BatchRenderer(Renderer):
+    """
+    Renders one rendr with many sets of parameters in one request:
+
+        POST /batch/<library>/<rendr>.<png|jpg|gif|webp>
+        {"params": [{"params": ["hello"], "color": "red"}, ...]}
+
+    Each set is rendered as if its "params" were the path parameters and
+    the rest the query parameters of a GET request, so the set above renders
+    like /<library>/<rendr>/hello.png?color=red.
+
+    The response is a multipart/mixed document with one part per set, in
+    order, which is streamed as the images are done. Each part has its
+    index in the list as its Content-ID, the path of the equivalent GET
+    request as its Content-Location, and an X-Status header with the status
+    that request would have had; failed parts hold an error message rather
+    than an image, and parts refused because the server is busy have a
+    Retry-After header.
+
+    The rendr is read once, and images which aren't cached are rendered
+    `batch_size` at a time, each group by a single rasterizer job that
+    reuses one page.
+    """
+    def initialize(self, batch_size=None, max_batch=None, **kwargs):
+        super(BatchRenderer, self).initialize(**kwargs)
+        # Parts are always in the format asked for
+        self.negotiate = False
+        self.batch_size = batch_size or 10
+        self.max_batch = max_batch or 1000
+        self._closed = False
+
+    def on_connection_close(self):
+        self._closed = True
+
+    def _write_part(self, index, path, status, body, content_type,
+            retry_after=None):
+        self.write("--%s\r\nContent-ID: <%d>\r\nContent-Location: %s\r\n"
+            "X-Status: %d\r\nContent-Type: %s\r\nContent-Length: %d\r\n"
+            "%s\r\n" % (self._boundary, index, path, status, content_type,
+                len(body), "Retry-After: %d\r\n" % retry_after
+                    if retry_after else ""))
+        self.write(body)
+        self.write("\r\n")
+
+    @gen.engine
+    def _render_batch(self, library_id, rendr_id, rendr, format, items,
+            callback=None):
+        """
+        Renders `items`, a list of (data, region, cache_key, render_key)
+        tuples, calling back with a list of `(body, error)` pairs.
+
+        Each distinct `render_key` is rendered once. For a region, it's the
+        key of the whole image as a PNG, which is cropped from the cache if
+        it's there, and otherwise rendered and cached just as if it had been
+        asked for itself.
+        """
+        regions = rendr.get("regions") or {}
+        wholes = set(render_key for _, region, _, render_key in items
+            if region is not None)
+        pngs, errors, pages = {}, {}, []
+        for data, region, _, render_key in items:
+            if render_key in pngs:
+                continue
+            pngs[render_key] = None
+            if render_key in wholes and self.cache:
+                pngs[render_key], _ = self.cache.get(render_key)
+            if pngs[render_key] is None:
+                pages.append((render_key, data))
+
+        if pages:
+            result = yield gen.Task(self._rasterize_batch, library_id,
+                rendr_id, rendr, pages)
+            responses, error = result.args
+            if error:
+                callback([(None, error)] * len(items))
+                return
+
+            for (render_key, _), (png, error) in zip(pages, responses):
+                if error:
+                    errors[render_key] = error
+                    continue
+                pngs[render_key] = png
+                if render_key in wholes and self.cache:
+                    self.cache.put(render_key, png)
+
+        results = []
+        for data, region, cache_key, render_key in items:
+            if render_key in errors:
+                results.append((None, errors[render_key]))
+                continue
+
+            _, quality, options = self._choose_encoding(format, data)
+            result = yield gen.Task(self._encode, pngs[render_key], format,
+                quality, regions.get(region), options)
+            body, error = result.args
+            if body is not None and self.cache:
+                evicted = self.cache.put(cache_key, body)
+                if evicted:
+                    self.application.queue_count("rendrit_cache", "evict",
+                        evicted)
+            results.append((body, error))
+
+        callback(results)
+
+    @gen.engine
+    def _rasterize_batch(self, library_id, rendr_id, rendr, pages,
+            callback=None):
+        """
+        Rasterizes `pages`, a list of (key, data) pairs, in one rasterizer
+        job. Calls back with `(pngs, error)`, where `pngs` is a list of
+        `(png, error)` pairs, one per page, and `error` is set if the job
+        couldn't be started at all.
+        """
+        if self.rasterizers.is_full():
+            callback(None, self._busy(library_id, "rasterizers busy"))
+            return
+
+        ticket = None
+        if self.scheduler:
+            result = yield gen.Task(self.scheduler.acquire, library_id,
+                time.time() + self.max_wait)
+            ticket, error = result.args
+            if error:
+                self.application.queue_count("rendrit_scheduler",
+                    "rejected")
+                callback(None, error)
+                return
+
+        urls = ["http://127.0.0.1:%s%s" % (self.port, _batch_path(
+            library_id, rendr_id, data, "html")) for _, data in pages]
+        # As for single renders, "pipe" mode sends the images back in the
+        # rasterizer's responses, rather than through temporary files
+        outputs = None
+        if self.transfer != "pipe":
+            outputs = [self.scratch.mkstemp(suffix=".png") for _ in pages]
+        try:
+            responses = yield gen.Task(self.rasterizers.rasterize_batch,
+                zip(urls, [render_html(rendr, data) for _, data in pages]),
+                outputs)
+        finally:
+            if ticket:
+                self.scheduler.release(ticket, len(pages))
+
+        pngs = []
+        for i, response in enumerate(responses):
+            png = None
+            if outputs:
+                if response.startswith("success"):
+                    with open(outputs[i], "rb") as f:
+                        png = f.read()
+                self.scratch.remove(outputs[i])
+            else:
+                png = rasterpool.image_data(response)
+
+            if png is None:
+                log.error("BatchRenderer._rasterize_batch failure (%s): %s" % (
+                    urls[i], response))
+                if self.breaker and rasterpool.timed_out(response):
+                    self.breaker.failure((library_id, rendr_id))
+                elif self.breaker:
+                    self.breaker.success((library_id, rendr_id))
+                pngs.append((None, tornado.web.HTTPError(504, response)))
+            else:
+                if self.breaker:
+                    self.breaker.success((library_id, rendr_id))
+                pngs.append((png, None))
+
+        callback(pngs, None)
+
+    @tornado.web.asynchronous
+    @gen.engine
+    def post(self, library_id, rendr_id, format):
+        library_id = urllib.unquote(library_id)
+        rendr_id = urllib.unquote(rendr_id)
+        if not imaging.can_encode(format):
+            raise tornado.web.HTTPError(400)
+
+        try:
+            sets = json.loads(self.request.body)["params"]
+        except Exception:
+            raise tornado.web.HTTPError(400)
+        if not isinstance(sets, list) or len(sets) > self.max_batch:
+            raise tornado.web.HTTPError(400)
+        sets = [_batch_data(item) for item in sets]
+        if None in sets:
+            raise tornado.web.HTTPError(400)
+
+        rendr = yield gen.Task(self.db.read_rendr, library_id, rendr_id)
+        if not rendr or "error" in rendr:
+            raise tornado.web.HTTPError(404)
+
+        if self.breaker and not self.breaker.allow((library_id, rendr_id)):
+            self.application.queue_count("rendrit_breaker", "refused")
+            self.send_error(503, retry_after=max(1, int(math.ceil(
+                self.breaker.retry_after((library_id, rendr_id))))))
+            return
+
+        self.application.queue_count("rendrit_batch", "sets", len(sets))
+        self._boundary = uuid.uuid4().hex
+        self.set_header("Content-Type",
+            "multipart/mixed; boundary=" + self._boundary)
+
+        revision = rendr_revision(rendr)
+        self.palette_key = (library_id, rendr_id, revision)
+        regions = rendr.get("regions") or {}
+        mime_type = imaging.MIME_TYPES[format]
+        for start in range(0, len(sets), self.batch_size):
+            if self._closed:
+                break
+
+            # Serve what's cached, and render the rest together
+            results = {}
+            misses = []
+            for i in range(start, min(start + self.batch_size, len(sets))):
+                # Regions are handled as for GET requests
+                data = dict(sets[i])
+                region = data.pop("region", None) if regions else None
+                if region is not None and (not isinstance(region,
+                        basestring) or region not in regions):
+                    results[i] = (None, tornado.web.HTTPError(404))
+                    continue
+
+                _, quality, options = self._choose_encoding(format, data)
+                cache_key = imagecache.cache_key(library_id, rendr_id,
+                    revision, data, format, quality, region=region,
+                    options=options)
+                body, tier = None, None
+                if self.cache:
+                    body, tier = self.cache.get(cache_key)
+                    self.application.queue_count("rendrit_cache",
+                        tier + "_hit" if tier else "miss")
+                if body is not None:
+                    results[i] = (body, None)
+                    continue
+
+                render_key = cache_key
+                if region is not None:
+                    render_key = imagecache.cache_key(library_id, rendr_id,
+                        revision, data, "png")
+                misses.append((i, (data, region, cache_key, render_key)))
+
+            if misses:
+                self.application.queue_count("rendrit_batch", "rendered",
+                    len(misses))
+                rendered = yield gen.Task(self._render_batch, library_id,
+                    rendr_id, rendr, format, [item for _, item in misses])
+                results.update(zip([i for i, _ in misses], rendered))
+
+            for i in sorted(results):
+                path = _batch_path(library_id, rendr_id, sets[i], format)
+                body, error = results[i]
+                if error is None:
+                    self._write_part(i, path, 200, body, mime_type)
+                else:
+                    status = getattr(error, "status_code", 500)
+                    retry_after = None
+                    if isinstance(error, scheduler.RenderRejected):
+                        status = 503
+                        retry_after = error.retry_after
+                    self._write_part(i, path, status, str(error),
+                        "text/plain", retry_after)
+            self.flush()
+
+        # Everything may have been cached, or the renders turned away, in
+        # which case a probe the breaker allowed never happened
+        if self.breaker:
+            self.breaker.release((library_id, rendr_id))
+        if not self._closed:
+            self.finish("--%s--\r\n" % self._boundary)
+
+
 class StaticBuild(tornado.web.RequestHandler):
     _bundles = {}
     _cache_time = 86400*365*10  # 10 years
@@ -531,6 +1295,7 @@ class CollectdLoggingApplication(tornado.web.Application):
         )
 
         self._collectd_loggers = {}
+        self._stats_timers = []
         if settings.get("collectd_server"):
             self._collectd_name = settings.get("collectd_name", "tornado")
             self.send_interval = settings.get("send_interval",
@@ -543,11 +1308,17 @@ class CollectdLoggingApplication(tornado.web.Application):
                 self._connect_collectd(collectd_server)
 
     def _connect_collectd(self, hostname, port=25826):
+        self._collectd_addr = (hostname, port)
         for logger_name in [
                 "rendrit_request",
                 "rendrit_processing_time",
                 "rendrit_error_rate"
             ]:
+            self._collectd_logger(logger_name)
+
+    def _collectd_logger(self, logger_name):
+        if logger_name not in self._collectd_loggers:
+            hostname, port = self._collectd_addr
             collectd_logger = pycollectd.CollectdClient(
                     hostname,
                     collectd_port=port,
@@ -556,6 +1327,42 @@ class CollectdLoggingApplication(tornado.web.Application):
             )
             collectd_logger.start()
             self._collectd_loggers[logger_name] = collectd_logger
+        return self._collectd_loggers[logger_name]
+
+    def queue_metric(self, logger_name, metric, value, cumm_func=None):
+        """
+        Queues `value` for `metric` on the named collectd logger, which is
+        created on first use. Does nothing unless collectd is configured.
+        """
+        if self._collectd_loggers:
+            self._collectd_logger(logger_name).queue(metric, value, cumm_func)
+
+    def queue_count(self, logger_name, metric, count=1):
+        """
+        Queues `count` occurrences of `metric`, reported as a rate per second.
+        """
+        if self._collectd_loggers:
+            self.queue_metric(logger_name, metric, count,
+                lambda values: sum(values) / float(self.send_interval))
+
+    def report_stats(self, logger_name, stats):
+        """
+        Reports the values in the dict `stats` on the named collectd logger
+        once every send interval, e.g. a component's running totals. Does
+        nothing unless collectd is configured.
+        """
+        if not self._collectd_loggers:
+            return
+
+        def report():
+            for metric, value in stats.items():
+                self.queue_metric(logger_name, metric, value,
+                    lambda values: values[-1])
+
+        timer = tornado.ioloop.PeriodicCallback(report,
+            self.send_interval * 1000)
+        timer.start()
+        self._stats_timers.append(timer)
 
     def log_request(self, handler):
         super(CollectdLoggingApplication, self).log_request(handler)
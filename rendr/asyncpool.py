@@ -0,0 +1,150 @@
+#Copyright (C) 2012 TaguchiMarketing Pty Ltd
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import time
+import pickle
+import logging
+import functools
+import tornado.ioloop
+import multiprocessing
+import tornado.stack_context
+import multiprocessing.pool
+
+
+class PoolFull(Exception):
+    pass
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+class _Task(object):
+    def __init__(self, callback):
+        self.callback = callback
+        self.timeout = None
+        self.done = False
+
+
+def _call(func, args):
+    """
+    Runs in a worker: returns `(result, error)` rather than raising.
+    """
+    try:
+        return func(*args), None
+    except Exception as e:
+        logging.exception("AsyncPool._call(func=%s): failure!" % repr(func))
+        return None, e
+
+
+class AsyncPool(object):
+    """
+    Runs blocking functions in a pool of `workers` threads, so they don't
+    hold up the IOLoop. With `processes`, the workers are processes instead,
+    for CPU-bound functions; the function, its arguments and its result must
+    then be picklable.
+
+    Results are passed back to callbacks on the IOLoop as `(result, error)`,
+    where `error` is the exception the function raised, if any. At most
+    `max_queue` calls may wait for a free worker; further calls fail
+    immediately with `PoolFull`.
+
+    With `timeout`, calls which haven't called back within that many
+    seconds fail with `TaskTimeout`, and stop counting towards the queue;
+    a worker process which dies takes its call with it, and would
+    otherwise never call back.
+    """
+    def __init__(self, workers=None, max_queue=None, processes=False,
+            timeout=None, io_loop=None):
+        self.workers = workers or 4
+        self.max_queue = max_queue if max_queue is not None else 1000
+        self.processes = processes
+        self.timeout = timeout
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.pending = 0
+
+        if processes:
+            self._pool = multiprocessing.Pool(self.workers)
+        else:
+            self._pool = multiprocessing.pool.ThreadPool(self.workers)
+
+    def is_full(self):
+        """
+        Returns True if no more calls can be queued.
+        """
+        return self.pending >= self.workers + self.max_queue
+
+    def run(self, func, *args, **kwargs):
+        """
+        Calls `func(*args)` in a worker, and then `callback(result, error)`
+        on the IOLoop.
+        """
+        callback = tornado.stack_context.wrap(kwargs.pop("callback"))
+        if self.is_full():
+            callback(None, PoolFull())
+            return
+
+        if self.processes:
+            # A call which can't be pickled would be dropped by the pool
+            # without calling back
+            try:
+                pickle.dumps((func, args), pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                logging.exception("AsyncPool.run(func=%s): failure!" %
+                    repr(func))
+                callback(None, e)
+                return
+
+        task = _Task(callback)
+        self.pending += 1
+        if self.timeout:
+            task.timeout = self.io_loop.add_timeout(
+                time.time() + self.timeout,
+                functools.partial(self._expire, task))
+        self._pool.apply_async(_call, (func, args),
+            callback=functools.partial(self._on_result, task))
+
+    def _on_result(self, task, result):
+        # Called on a pool (result handler) thread -- hop back onto the
+        # IOLoop
+        self.io_loop.add_callback(functools.partial(self._finish, task,
+            result))
+
+    def _expire(self, task):
+        task.timeout = None
+        logging.warning("AsyncPool: call timed out after %ss" % self.timeout)
+        self._finish(task, (None, TaskTimeout()))
+
+    def _finish(self, task, result):
+        # Whichever of the result and the timeout comes second is ignored
+        if task.done:
+            return
+        task.done = True
+        if task.timeout:
+            self.io_loop.remove_timeout(task.timeout)
+        self.pending -= 1
+        task.callback(*result)
+
+    def close(self):
+        """
+        Stops the workers once they've finished any queued calls.
+        """
+        self._pool.close()
+        self._pool.join()
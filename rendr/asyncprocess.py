@@ -18,13 +18,16 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #SOFTWARE.
 
+
 import os
 import time
+import errno
 import fcntl
 import logging
 import tornado
 import traceback
 import subprocess
+import collections
 import tornado.ioloop
 import tornado.stack_context
 
@@ -35,6 +38,19 @@ def _nonblocking(f):
     fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
 
 
+def _read(f):
+    """
+    Reads whatever is available from the non-blocking file `f`. Returns None
+    if nothing is available yet, and "" at EOF.
+    """
+    try:
+        return os.read(f.fileno(), 65536)
+    except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return None
+        return ""
+
+
 def _exception_handler(exc_type, exc_value, exc_traceback):
     logging.exception(
         "AsyncProcess.exception_handler(type=%s, value=%s, traceback=%s)"
@@ -44,6 +60,14 @@ def _exception_handler(exc_type, exc_value, exc_traceback):
     return True
 
 
+class _Message(object):
+    def __init__(self, data, callback, timeout):
+        self.data = data
+        self.callback = callback
+        self.timeout = timeout
+        self.retries = 0
+
+
 class AsyncProcess(object):
     """
     Manages an asynchronous worker process.
@@ -52,13 +76,17 @@ class AsyncProcess(object):
     any specific format, while responses read from stdout are expected to be
     LF-terminated.
 
-    The process is terminated after `timeout` seconds, unless it exits
-    earlier.
+    Used via `run`, the process is terminated after `timeout` seconds, unless
+    it exits earlier, and its complete output is passed to the callback.
 
-    Internally, messages are written from the stdin queue to the process,
-    and placed in an in-flight queue until the corresponding stdout message
-    is read, whereupon the callback associated with the stdin message is
-    called.
+    Used via `start` and `submit`, the process serves any number of messages.
+    Messages are written from the stdin queue to the process, and placed in
+    an in-flight queue until the corresponding stdout message is read,
+    whereupon the callback associated with the stdin message is called. Up
+    to `max_in_flight` messages are written ahead of their responses; the
+    rest wait in the stdin queue (of at most `max_queue` messages) until the
+    process has caught up. Each message must be answered within `timeout`
+    seconds of reaching the head of the in-flight queue.
 
     If the process terminates without writing to stderr, it is restarted and
     any requests in the in-flight queue are re-issued. If the process has
@@ -66,14 +94,36 @@ class AsyncProcess(object):
     callbacks associated with any outstanding requests are called with an
     error message.
     """
-    def __init__(self, command=None, timeout=None, io_loop=None):
+    # Limits on how much unwritten input, and how much stderr output, is held
+    _max_stdin_buf = 1024 * 1024
+    _max_stderr_buf = 4096
+
+    def __init__(self, command=None, timeout=None, io_loop=None,
+            max_in_flight=None, max_queue=None, max_retries=None):
         self.command = command
         self.process = None
         self.timeout = timeout or 60
         self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.max_in_flight = max_in_flight or 1
+        self.max_queue = max_queue if max_queue is not None else 1000
+        self.max_retries = max_retries if max_retries is not None else 2
+        self.responses = 0
 
         self._stdout_buf = ""
+        # Output read since the last complete line; joined into _stdout_buf
+        # only once a line ends, so long lines aren't copied on every read
+        self._stdout_chunks = []
         self._stderr_buf = ""
+        self._stdin_buf = ""
+
+        self._stdin_queue = collections.deque()
+        self._in_flight = collections.deque()
+        self._serving = False
+        self._started_at = 0
+        self._writing = False
+        self._open_streams = set()
+        self._respawn_timeout = None
+        self._message_timeout = None
 
         self._terminate_timeout = None
         self._terminate_cb = None
@@ -85,6 +135,19 @@ class AsyncProcess(object):
         """
         return not self._terminated
 
+    def is_serving(self):
+        """
+        Returns True between calls to `start` and `stop`, including while the
+        process is being restarted.
+        """
+        return self._serving
+
+    def pending(self):
+        """
+        Returns the number of submitted messages still awaiting a response.
+        """
+        return len(self._stdin_queue) + len(self._in_flight)
+
     def terminate(self):
         """
         Terminates the subprocess.
@@ -99,7 +162,75 @@ class AsyncProcess(object):
         logging.debug("AsyncProcess.run(cmd=%s)" % repr(self.command))
 
         self._terminate_cb = tornado.stack_context.wrap(callback)
+        self._spawn()
+
+        # terminate after timeout
+        self._terminate_timeout = self.io_loop.add_timeout(time.time() +
+            self.timeout, self._on_close)
+
+    def start(self):
+        """
+        Starts the process, ready to serve messages passed to `submit`.
+        """
+        logging.debug("AsyncProcess.start(cmd=%s)" % repr(self.command))
+
+        self._serving = True
+        self._spawn()
+        self._write_pending()
+
+    def stop(self, error="stopped"):
+        """
+        Stops the process; callbacks for any outstanding messages are called
+        with `error`.
+        """
+        self._serving = False
+        if self._respawn_timeout:
+            self.io_loop.remove_timeout(self._respawn_timeout)
+            self._respawn_timeout = None
+
+        self._close_process()
+
+        outstanding = list(self._in_flight) + list(self._stdin_queue)
+        self._in_flight.clear()
+        self._stdin_queue.clear()
+        for message in outstanding:
+            self._respond(message, None, error)
+
+    def restart(self):
+        """
+        Restarts the process, re-issuing any in-flight messages.
+        """
+        if self._respawn_timeout:
+            self.io_loop.remove_timeout(self._respawn_timeout)
+            self._respawn_timeout = None
+
+        self._close_process()
+        self._stdin_queue.extendleft(reversed(self._in_flight))
+        self._in_flight.clear()
+        self._spawn()
+        self._write_pending()
+
+    def submit(self, message, callback=None, timeout=None):
+        """
+        Queues `message` (a string without a trailing LF) to be written to
+        the process. `callback` is called with `(response, error)`: the
+        response line without its LF, or None and an error message if the
+        message timed out, the queue was full, or the process died.
+        """
+        callback = tornado.stack_context.wrap(callback)
+
+        if not self._serving:
+            callback(None, "not running")
+            return
+        elif len(self._stdin_queue) >= self.max_queue:
+            callback(None, "queue full")
+            return
 
+        self._stdin_queue.append(_Message(message, callback,
+            timeout or self.timeout))
+        self._write_pending()
+
+    def _spawn(self):
         self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE,
             stdin=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True,
             shell=False)
@@ -114,11 +245,92 @@ class AsyncProcess(object):
             self.io_loop.add_handler(self.process.stderr.fileno(),
                 self._on_read_stderr, self.io_loop.READ)
 
+        self._stdout_buf = ""
+        self._stdout_chunks = []
+        self._stderr_buf = ""
+        self._stdin_buf = ""
+        self._writing = False
+        self._open_streams = set([self.process.stdout.fileno(),
+            self.process.stderr.fileno()])
+        self._started_at = time.time()
+        self.responses = 0
         self._terminated = False
 
-        # terminate after timeout
-        self._terminate_timeout = self.io_loop.add_timeout(time.time() +
-            self.timeout, self._on_close)
+    def _write_pending(self):
+        """
+        Moves messages from the stdin queue to the in-flight queue, as long
+        as the process is keeping up, and writes them out.
+        """
+        if self._terminated:
+            return
+
+        while self._stdin_queue and \
+                len(self._in_flight) < self.max_in_flight and \
+                len(self._stdin_buf) < AsyncProcess._max_stdin_buf:
+            message = self._stdin_queue.popleft()
+            self._in_flight.append(message)
+            self._stdin_buf += message.data + "\n"
+            if len(self._in_flight) == 1:
+                self._reset_message_timeout()
+
+        self._on_write_stdin()
+
+    def _on_write_stdin(self, fd=None, events=None):
+        """
+        Writes as much buffered input as the process will accept; waits for
+        the pipe to become writable again if it fills up.
+        """
+        if self._terminated:
+            return
+
+        while self._stdin_buf:
+            try:
+                written = os.write(self.process.stdin.fileno(),
+                    self._stdin_buf)
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # EPIPE etc -- the process is exiting, and will be
+                    # handled when stdout closes
+                    self._stdin_buf = ""
+                break
+            self._stdin_buf = self._stdin_buf[written:]
+
+        if self._stdin_buf and not self._writing:
+            self._writing = True
+            with tornado.stack_context.NullContext():
+                self.io_loop.add_handler(self.process.stdin.fileno(),
+                    self._on_write_stdin, self.io_loop.WRITE)
+        elif not self._stdin_buf and self._writing:
+            self._writing = False
+            self.io_loop.remove_handler(self.process.stdin.fileno())
+
+    def _reset_message_timeout(self):
+        """
+        (Re)starts the response timer for the message at the head of the
+        in-flight queue.
+        """
+        if self._message_timeout:
+            self.io_loop.remove_timeout(self._message_timeout)
+            self._message_timeout = None
+
+        if self._in_flight and not self._terminated:
+            self._message_timeout = self.io_loop.add_timeout(time.time() +
+                self._in_flight[0].timeout, self._on_message_timeout)
+
+    def _on_message_timeout(self):
+        self._message_timeout = None
+        message = self._in_flight.popleft()
+        self._respond(message, None,
+            "timed out after %d seconds" % message.timeout)
+
+        # Any later response can't be matched to its message any more, so
+        # start afresh
+        if self._serving and not self._terminated:
+            self.restart()
+
+    def _respond(self, message, response, error):
+        with tornado.stack_context.NullContext():
+            message.callback(response, error)
 
     def _on_read_stdout(self, fd, events):
         """
@@ -127,23 +339,55 @@ class AsyncProcess(object):
         if self._terminated:
             return
 
-        buf = self.process.stdout.read()
+        buf = _read(self.process.stdout)
+        if buf is None:
+            return
 
         try:
-            self._stdout_buf += buf or ""
+            self._stdout_chunks.append(buf)
 
-            if self.process.poll() is not None or not buf:
+            if not buf:
                 logging.warning(
                     "AsyncProcess._on_read_stdout(command=%s): exit!" % \
                     repr(self.command))
-                self._on_close()
+                self._on_eof(fd)
                 return
+            elif self._serving and "\n" in buf:
+                # Responses can be long (see RasterizePool's data URIs), so
+                # only look for complete lines once one has arrived
+                self._on_responses()
         except Exception:
             logging.exception(
                 "AsyncProcess._on_read_stdout(command=%s): failure!" % \
                 repr(self.command))
             self._on_close()
 
+    def _on_responses(self):
+        """
+        Matches complete response lines to in-flight messages.
+        """
+        self._join_stdout()
+        process = self.process
+        while "\n" in self._stdout_buf and self.process is process:
+            line, _, self._stdout_buf = self._stdout_buf.partition("\n")
+            if not self._in_flight:
+                logging.warning(
+                    "AsyncProcess._on_responses(cmd=%s): unexpected %s"
+                    % (repr(self.command), repr(line)))
+                continue
+
+            message = self._in_flight.popleft()
+            self.responses += 1
+            self._reset_message_timeout()
+            self._respond(message, line, None)
+
+        self._write_pending()
+
+    def _join_stdout(self):
+        if self._stdout_chunks:
+            self._stdout_buf += "".join(self._stdout_chunks)
+            self._stdout_chunks = []
+
     def _on_read_stderr(self, fd, events):
         """
         Called when the worker has error output available.
@@ -151,43 +395,71 @@ class AsyncProcess(object):
         if self._terminated:
             return
 
-        buf = self.process.stderr.read()
+        buf = _read(self.process.stderr)
+        if buf is None:
+            return
 
         try:
-            self._stderr_buf += buf or ""
+            self._stderr_buf += buf
+            if self._serving:
+                # Only the most recent output matters to a long-lived worker
+                self._stderr_buf = \
+                    self._stderr_buf[-AsyncProcess._max_stderr_buf:]
 
-            if self.process.poll() is not None or not buf:
+            if not buf:
                 logging.warning(
                     "AsyncProcess._on_read_stderr(cmd=%s): exit!" % \
                     repr(self.command))
-                self._on_close()
+                self._on_eof(fd)
         except Exception:
             logging.exception(
                 "AsyncProcess._on_read_stderr(cmd=%s): failure!" % \
                 repr(self.command))
 
-    def _on_close(self):
+    def _on_eof(self, fd):
         """
-        Called when the worker terminates.
+        Called when stdout or stderr is closed; the process is treated as
+        having exited once both are, so neither stream's output is lost.
+        """
+        self.io_loop.remove_handler(fd)
+        self._open_streams.discard(fd)
+        if not self._open_streams:
+            self._on_close()
+
+    def _close_process(self):
+        """
+        Removes IOLoop handlers, closes pipes and stops the process.
         """
         if self._terminated:
             return
 
         self._terminated = True
 
-        try:
-            self.io_loop.remove_handler(self.process.stdout.fileno())
-        except KeyError:
-            pass
-        try:
-            self.io_loop.remove_handler(self.process.stderr.fileno())
-        except KeyError:
-            pass
+        for timeout in (self._terminate_timeout, self._message_timeout):
+            if timeout:
+                self.io_loop.remove_timeout(timeout)
+        self._terminate_timeout = None
+        self._message_timeout = None
+
+        # Handlers for streams already at EOF have been removed
+        fds = list(self._open_streams)
+        self._open_streams.clear()
+        if self._writing:
+            fds.append(self.process.stdin.fileno())
+            self._writing = False
+        for fd in fds:
+            try:
+                self.io_loop.remove_handler(fd)
+            except KeyError:
+                pass
 
         # close fds
         self.process.stdout.close()
         self.process.stderr.close()
-        self.process.stdin.close()
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
 
         # terminate with SIGTERM
         try:
@@ -202,11 +474,65 @@ class AsyncProcess(object):
             logging.info(
                 "AsyncProcess.terminate(cmd=%s): killed" % repr(self.command))
 
+    def _on_close(self):
+        """
+        Called when the worker terminates.
+        """
+        if self._terminated:
+            return
+
+        self._close_process()
+
         # notify terminate listener
         if self._terminate_cb:
+            self._join_stdout()
             with tornado.stack_context.NullContext():
                 self._terminate_cb(self._stdout_buf, self._stderr_buf)
 
+        if self._serving:
+            self._on_worker_exit()
+
+    def _on_worker_exit(self):
+        """
+        Restarts a worker which exited unexpectedly, unless it wrote to stderr.
+        """
+        if self._stderr_buf:
+            logging.error("AsyncProcess._on_worker_exit(cmd=%s): %s"
+                % (repr(self.command), self._stderr_buf))
+            self.stop("process exited: " + self._stderr_buf.strip())
+            return
+
+        # Re-issue in-flight messages. The one at the head was being handled
+        # when the process died, so give up on it after max_retries attempts
+        # -- it's probably what's killing the process
+        if self._in_flight:
+            message = self._in_flight[0]
+            message.retries += 1
+            if message.retries > self.max_retries:
+                self._in_flight.popleft()
+                self._respond(message, None, "process exited")
+        self._stdin_queue.extendleft(reversed(self._in_flight))
+        self._in_flight.clear()
+
+        # Don't restart in a tight loop if the process can't stay up
+        if time.time() - self._started_at < 1.0:
+            self._respawn_timeout = self.io_loop.add_timeout(
+                time.time() + 1.0, self._respawn)
+        else:
+            self._respawn()
+
+    def _respawn(self):
+        self._respawn_timeout = None
+        if self._serving and self._terminated:
+            try:
+                self._spawn()
+            except OSError:
+                logging.exception("AsyncProcess._respawn(cmd=%s): failure!"
+                    % repr(self.command))
+                self.stop("couldn't start process")
+                return
+            self._write_pending()
+
 
 def run_cmd(cmd, timeout=60, callback=None, io_loop=None):
     """
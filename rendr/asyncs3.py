@@ -23,23 +23,37 @@ import re
 import sys
 import json
 import hmac
+import time
 import uuid
 import base64
 import urllib
 import hashlib
+import calendar
+import logging
 import tempfile
 import urlparse
+import functools
 import itertools
 import subprocess
+import collections
 import email.utils
 import tornado.web
+import xml.sax.handler
+import tornado.escape
 import tornado.ioloop
 import tornado.template
 import tornado.httpclient
+import xml.sax
 from tornado import gen
-from xml.dom import minidom
+from rendr import inflight
 from passlib.apps import custom_app_context as pwd_context
 
+try:
+    from tornado.curl_httpclient import CurlAsyncHTTPClient as _HTTPClient
+except ImportError:
+    # Without pycurl, every request to S3 makes a new connection
+    from tornado.simple_httpclient import SimpleAsyncHTTPClient as _HTTPClient
+
 
 SIG_HEADERS = ("content-type", "content-md5", "date")
 SIG_HEADER_PREFIX = "x-amz-"
@@ -90,51 +104,358 @@ def canonicalize_headers(method, path, headers, expires=None):
         [url.path, "?" + params if params else ""]))
 
 
+class ListBucketParser(xml.sax.handler.ContentHandler):
+    """
+    Incrementally parses a ListBucket response fed to it in chunks, calling
+    `on_object` with an `Object` for each key as soon as it's been read.
+
+    Once the whole response has been fed, `is_truncated` says whether there
+    are more pages, and `marker` is the key to continue listing after.
+    """
+    Object = collections.namedtuple("Object", ["key", "size", "etag",
+        "modified"])
+
+    def __init__(self, on_object):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.on_object = on_object
+        self.is_truncated = False
+        self.marker = None
+
+        self._path = []
+        self._text = []
+        self._object = {}
+        self._parser = xml.sax.make_parser()
+        self._parser.setContentHandler(self)
+
+    def feed(self, data):
+        self._parser.feed(data)
+
+    def close(self):
+        self._parser.close()
+
+    def startElement(self, name, attrs):
+        self._path.append(name)
+        self._text = []
+
+    def characters(self, content):
+        self._text.append(content)
+
+    def endElement(self, name):
+        path = tuple(self._path)
+        self._path.pop()
+        text = u"".join(self._text)
+        if path[:2] == ("ListBucketResult", "Contents") and len(path) == 3:
+            self._object[name] = text
+        elif path == ("ListBucketResult", "Contents"):
+            fields, self._object = self._object, {}
+            # e.g. 2013-02-05T06:55:23.000Z
+            modified = fields.get("LastModified")
+            if modified:
+                modified = calendar.timegm(time.strptime(modified[:19],
+                    "%Y-%m-%dT%H:%M:%S"))
+            self.marker = fields["Key"]
+            self.on_object(ListBucketParser.Object(fields["Key"],
+                int(fields.get("Size", 0)), fields.get("ETag"), modified))
+        elif path == ("ListBucketResult", "NextMarker"):
+            self.marker = text
+        elif path == ("ListBucketResult", "IsTruncated"):
+            self.is_truncated = text == "true"
+
+
+class DefinitionCache(object):
+    """
+    An LRU cache of up to `max_entries` S3 objects, holding each object's
+    body, ETag and the time it was last fetched or revalidated.
+
+    Entries are fresh for `ttl` seconds; after that they may be served stale
+    for up to `max_stale` more seconds while they're revalidated.
+    """
+    Entry = collections.namedtuple("Entry", ["body", "etag", "fetched"])
+
+    def __init__(self, ttl=None, max_stale=None, max_entries=None):
+        self.ttl = ttl if ttl is not None else 30
+        self.max_stale = max_stale if max_stale is not None else 300
+        self.max_entries = max_entries or 10000
+        self.stats = dict.fromkeys(("hits", "stale_hits", "misses",
+            "not_modified"), 0)
+
+        self._entries = collections.OrderedDict()
+
+    def get(self, filename):
+        """
+        Returns a (entry, state) tuple, where state is "fresh", "stale" or
+        "expired"; or (None, None) if there's no entry.
+        """
+        entry = self._entries.pop(filename, None)
+        if entry is None:
+            return None, None
+
+        self._entries[filename] = entry
+        age = time.time() - entry.fetched
+        if age < self.ttl:
+            return entry, "fresh"
+        elif age < self.ttl + self.max_stale:
+            return entry, "stale"
+        else:
+            return entry, "expired"
+
+    def put(self, filename, body, etag):
+        self._entries.pop(filename, None)
+        self._entries[filename] = DefinitionCache.Entry(body, etag,
+            time.time())
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, filename):
+        self._entries.pop(filename, None)
+
+
+class KeyVerifier(object):
+    """
+    Verifies library keys against their stored hashes, remembering
+    successful verifications for `ttl` seconds (up to `max_entries` of them).
+
+    Verifications are remembered by an HMAC of the library ID, key and hash
+    under a per-process secret, so keys aren't held in memory in the clear,
+    and a new hash for a library makes the old entries useless. Keys which
+    aren't remembered are checked in `pool` (an `AsyncPool`) if given, or
+    on the IOLoop otherwise.
+    """
+    def __init__(self, ttl=None, max_entries=None, pool=None):
+        self.ttl = ttl if ttl is not None else 300
+        self.max_entries = max_entries or 10000
+        self.pool = pool
+        self.stats = dict.fromkeys(("hits", "misses", "failures"), 0)
+
+        self._secret = os.urandom(32)
+        self._verified = collections.OrderedDict()
+
+    def _token(self, library_id, key, key_hash):
+        return hmac.new(self._secret, "\0".join(tornado.escape.utf8(s)
+            for s in (library_id, key, key_hash)), hashlib.sha256).digest()
+
+    @gen.engine
+    def verify(self, library_id, key, key_hash, callback=None):
+        """
+        Calls back with `(valid, error)`: whether `key` matches `key_hash`,
+        and the exception the pool reported if it couldn't be checked, e.g.
+        `asyncpool.PoolFull`.
+        """
+        token = self._token(library_id, key, key_hash)
+        verified_at = self._verified.pop(token, None)
+        if verified_at is not None and time.time() - verified_at < self.ttl:
+            self._verified[token] = verified_at
+            self.stats["hits"] += 1
+            callback(True, None)
+            return
+
+        self.stats["misses"] += 1
+        if self.pool:
+            result = yield gen.Task(self.pool.run, pwd_context.verify, key,
+                key_hash)
+            valid, error = result.args
+        else:
+            valid, error = pwd_context.verify(key, key_hash), None
+
+        if error:
+            callback(False, error)
+            return
+
+        if valid:
+            self._verified[token] = time.time()
+            while len(self._verified) > self.max_entries:
+                self._verified.popitem(last=False)
+        else:
+            self.stats["failures"] += 1
+
+        callback(bool(valid), None)
+
+
 class S3DB(object):
-    "Asynchronous S3 client"
-    def __init__(self, key_id=None, key=None, bucket=None, io_loop=None):
+    """
+    Asynchronous S3 client.
+
+    Requests share one HTTP client, which makes at most `max_clients`
+    requests at once and queues the rest; with pycurl installed, it also
+    keeps connections alive between requests. Live counts of requests
+    in progress and queued, and totals of requests and server or network
+    errors, are kept in `stats`. `on_request`, if set, is called with
+    `(operation, seconds, code)` as each request finishes, where
+    `operation` is "get", "list", "put" or "delete".
+
+    Requests go to `endpoint`, with the bucket in the path; by default, to
+    S3 itself.
+    """
+    def __init__(self, key_id=None, key=None, bucket=None, io_loop=None,
+            cache_ttl=None, cache_stale=None, cache_size=None,
+            key_verifier=None, max_clients=None, connect_timeout=None,
+            request_timeout=None, endpoint=None):
         self.key_id = key_id
         self.key = key
         self.bucket = bucket
+        self.endpoint = (endpoint or "https://s3.amazonaws.com").rstrip("/")
         self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.cache = DefinitionCache(ttl=cache_ttl, max_stale=cache_stale,
+            max_entries=cache_size)
+        self.key_verifier = key_verifier or KeyVerifier()
+        self.max_clients = max_clients or 20
+        self.connect_timeout = connect_timeout or 5
+        self.request_timeout = request_timeout or 20
+        self.on_request = None
+        self.index_retries = 5
+        self.stats = dict.fromkeys(("active", "queued", "requests",
+            "errors", "index_conflicts", "index_failures"), 0)
 
-    def _get_file(self, filename, query="", callback=None):
-        uri = "https://s3.amazonaws.com/%s/%s%s" % (
-            urllib.quote(self.bucket), urllib.quote(filename), query)
-        headers = {
+        self.http_client = _HTTPClient(self.io_loop,
+            max_clients=self.max_clients, force_instance=True)
+        self._fetches = inflight.InFlight()
+
+    def _fetch(self, operation, request, callback):
+        """
+        Makes `request` with the shared client, keeping `stats`.
+        """
+        start = time.time()
+        self.stats["active"] += 1
+        self.stats["queued"] = max(0, self.stats["active"] - self.max_clients)
+
+        def on_response(response):
+            self.stats["active"] -= 1
+            self.stats["queued"] = max(0,
+                self.stats["active"] - self.max_clients)
+            self.stats["requests"] += 1
+            if response.code >= 500:
+                self.stats["errors"] += 1
+            if self.on_request:
+                self.on_request(operation, time.time() - start, response.code)
+            callback(response)
+
+        self.http_client.fetch(request, on_response)
+
+    def _get_file(self, filename, query="", headers=None,
+            streaming_callback=None, callback=None):
+        uri = "%s/%s/%s%s" % (self.endpoint, urllib.quote(self.bucket),
+            urllib.quote(filename), query)
+        headers = dict(headers or {})
+        headers.update({
             "Date": email.utils.formatdate(None, False, True),
             "Content-Type": "",
-        }
+        })
         signed = sign_request(uri, self.key, "GET", headers)
         headers["Authorization"] = "AWS %s:%s" % (self.key_id, signed)
         request = tornado.httpclient.HTTPRequest(uri, method="GET",
-            headers=headers, validate_cert=False)
-        http_client = tornado.httpclient.AsyncHTTPClient(self.io_loop)
-        http_client.fetch(request, callback=callback)
+            headers=headers, validate_cert=False,
+            streaming_callback=streaming_callback,
+            connect_timeout=self.connect_timeout,
+            request_timeout=self.request_timeout)
+        self._fetch("list" if query else "get", request, callback)
 
-    def _put_file(self, filename, content, callback=None):
-        uri = "https://s3.amazonaws.com/%s/%s" % (
-            urllib.quote(self.bucket), urllib.quote(filename))
-        headers = {
+    def _put_file(self, filename, content, headers=None, callback=None):
+        uri = "%s/%s/%s" % (self.endpoint, urllib.quote(self.bucket),
+            urllib.quote(filename))
+        headers = dict(headers or {})
+        headers.update({
             "Date": email.utils.formatdate(None, False, True),
             "Content-Type": "text/plain",
             "Content-MD5": base64.b64encode(hashlib.md5(content).digest())
-        }
+        })
         signed = sign_request(uri, self.key, "PUT", headers)
         headers["Authorization"] = "AWS %s:%s" % (self.key_id, signed)
         request = tornado.httpclient.HTTPRequest(uri, method="PUT",
-            headers=headers, body=content, validate_cert=False)
-        http_client = tornado.httpclient.AsyncHTTPClient(self.io_loop)
-        http_client.fetch(request, callback=callback)
+            headers=headers, body=content, validate_cert=False,
+            connect_timeout=self.connect_timeout,
+            request_timeout=self.request_timeout)
+        self._fetch("put", request, callback)
+
+    def _delete_file(self, filename, callback=None):
+        uri = "%s/%s/%s" % (self.endpoint, urllib.quote(self.bucket),
+            urllib.quote(filename))
+        headers = {
+            "Date": email.utils.formatdate(None, False, True),
+            "Content-Type": "",
+        }
+        signed = sign_request(uri, self.key, "DELETE", headers)
+        headers["Authorization"] = "AWS %s:%s" % (self.key_id, signed)
+        request = tornado.httpclient.HTTPRequest(uri, method="DELETE",
+            headers=headers, validate_cert=False,
+            connect_timeout=self.connect_timeout,
+            request_timeout=self.request_timeout)
+        self._fetch("delete", request, callback)
 
     @gen.engine
-    def read_library(self, library_id, callback=None):
-        response = yield gen.Task(self._get_file,
-            library_id + "/dist.json")
-        if response.code != 200:
-            callback({"error": response.code})
+    def _fetch_definition(self, filename, callback=None):
+        """
+        GETs `filename`, conditionally if it's in the cache, and updates the
+        cache. Calls back with `((code, body), None)`, as an InFlight job.
+        """
+        entry, _ = self.cache.get(filename)
+        headers = {"If-None-Match": entry.etag} if entry else {}
+
+        response = yield gen.Task(self._get_file, filename, headers=headers)
+        if response.code == 304 and entry:
+            self.cache.stats["not_modified"] += 1
+            self.cache.put(filename, entry.body, entry.etag)
+            callback((200, entry.body), None)
+        elif response.code == 200:
+            self.cache.put(filename, response.body,
+                response.headers.get("Etag"))
+            callback((200, response.body), None)
+        elif response.code == 404:
+            self.cache.delete(filename)
+            callback((404, None), None)
+        elif entry:
+            # S3 is having trouble -- better to serve what we have
+            logging.warning("S3DB._fetch_definition(filename=%s): %d" % (
+                filename, response.code))
+            callback((200, entry.body), None)
         else:
-            callback(json.loads(response.body))
+            callback((response.code, None), None)
+
+    @gen.engine
+    def _read_definition(self, filename, callback=None, revalidate=False):
+        """
+        Returns the JSON object stored in `filename`, from the cache if
+        possible, or {"error": code}. With `revalidate`, a cached copy is
+        checked with S3 first, however fresh it is.
+        """
+        entry, state = self.cache.get(filename)
+        if revalidate:
+            state = None
+        if state == "fresh":
+            self.cache.stats["hits"] += 1
+            callback(json.loads(entry.body))
+            return
+        elif state == "stale":
+            # Serve the stale copy, and revalidate it in the background
+            self.cache.stats["stale_hits"] += 1
+            self._fetches.run(filename,
+                functools.partial(self._fetch_definition, filename),
+                lambda result, error: None)
+            callback(json.loads(entry.body))
+            return
+
+        self.cache.stats["misses"] += 1
+        result = yield gen.Task(self._fetches.run, filename,
+            functools.partial(self._fetch_definition, filename))
+        response, error = result.args
+        if error:
+            callback({"error": 500})
+        elif response[0] != 200:
+            callback({"error": response[0]})
+        else:
+            callback(json.loads(response[1]))
+
+    def read_library(self, library_id, callback=None):
+        self._read_definition(library_id + "/dist.json", callback=callback)
+
+    def verify_library_key(self, library_id, library, library_key,
+            callback=None):
+        """
+        Calls back with `(valid, error)`, where `valid` is True if
+        `library_key` is the key for `library` (as returned by
+        `read_library`); see `KeyVerifier.verify`.
+        """
+        self.key_verifier.verify(library_id, library_key, library["keyHash"],
+            callback=callback)
 
     @gen.engine
     def create_library(self, name, callback=None):
@@ -163,40 +484,221 @@ class S3DB(object):
             library_data["key"] = library_key
             callback(library_data)
 
+    @gen.engine
+    def _list_objects(self, prefix, on_objects, max_keys=None,
+            callback=None):
+        """
+        Lists the objects under `prefix` a page at a time, calling
+        `on_objects` with each batch of `ListBucketParser.Object`s as
+        they're parsed from the response; if it returns False, listing stops
+        there. Calls back with None when done, or {"error": code}.
+        """
+        marker = None
+        while True:
+            objects = []
+            parser = ListBucketParser(objects.append)
+            # [stopped, parse error]
+            state = [False, None]
+            def on_chunk(data):
+                if state[0] or state[1]:
+                    return
+                try:
+                    parser.feed(data)
+                except xml.sax.SAXException as e:
+                    state[1] = e
+                    return
+                if objects:
+                    batch = objects[:]
+                    del objects[:]
+                    state[0] = on_objects(batch) is False
+
+            query = "?prefix=" + urllib.quote(prefix, safe="")
+            if marker:
+                query += "&marker=" + urllib.quote(
+                    tornado.escape.utf8(marker), safe="")
+            if max_keys:
+                query += "&max-keys=%d" % max_keys
+            response = yield gen.Task(self._get_file, "", query=query,
+                streaming_callback=on_chunk)
+
+            if response.code != 200:
+                callback({"error": response.code})
+                return
+            if state[0]:
+                break
+            if not state[1]:
+                try:
+                    parser.close()
+                except xml.sax.SAXException as e:
+                    state[1] = e
+            if objects and not state[1]:
+                state[0] = on_objects(objects) is False
+            if state[1]:
+                logging.warning("S3DB._list_objects(prefix=%s): %s" % (
+                    prefix, state[1]))
+                callback({"error": 500})
+                return
+            if state[0] or not parser.is_truncated or not parser.marker:
+                break
+            marker = parser.marker
+
+        callback(None)
+
+    def iter_rendrs(self, library_id, on_rendrs, max_keys=None,
+            callback=None):
+        """
+        Lists the rendrs in a library from the bucket, calling `on_rendrs`
+        with each batch of rendr IDs as they're parsed from the response;
+        if it returns False, listing stops there. Calls back with None when
+        done, or {"error": code}.
+        """
+        prefix = library_id + "/rendrs/"
+        def on_objects(objects):
+            return on_rendrs([o.key[len(prefix):-len(".json")]
+                for o in objects if o.key.endswith(".json")])
+
+        self._list_objects(prefix, on_objects, max_keys=max_keys,
+            callback=callback)
+
     @gen.engine
     def list_rendrs(self, library_id, callback=None):
-        response = yield gen.Task(self._get_file, "",
-            query="?prefix=" + urllib.quote(library_id) + "/rendrs/")
-        if response.code != 200:
-            callback({"error": response.code})
-        else:
-            rendrs = []
-            pre_len = len(library_id + "/rendrs/")
-            post_len = len(".json")
-            dom = minidom.parseString(response.body)
-            for key in dom.getElementsByTagName("Key"):
-                fname = key.childNodes[0].nodeValue[pre_len:-post_len]
-                if fname:
-                    rendrs.append(fname)
-            callback(rendrs)
+        """
+        Returns a sorted list of the rendr IDs in the library, from its
+        index; or from the bucket, if the library hasn't been indexed.
+        """
+        index = yield gen.Task(self.read_index, library_id)
+        if "error" not in index:
+            callback(sorted(index["rendrs"]))
+            return
+        elif index["error"] != 404:
+            callback(index)
+            return
+
+        rendrs = []
+        error = yield gen.Task(self.iter_rendrs, library_id, rendrs.extend)
+        callback(error or rendrs)
+
+    def read_index(self, library_id, callback=None):
+        """
+        Returns the library's index: {"rendrs": {rendr_id: entry}}, where
+        each entry holds the MD5 `revision` of the stored rendr, its `size`
+        and its `modified` time.
+        """
+        self._read_definition(library_id + "/index.json", callback=callback)
 
     @gen.engine
-    def read_rendr(self, library_id, rendr_id, callback=None):
-        "Returns a rendr object with the given ID."
-        response = yield gen.Task(self._get_file,
-            library_id + "/rendrs/" + rendr_id + ".json")
-        if response.code != 200:
-            callback({"error": response.code})
-        else:
-            callback(json.loads(response.body))
+    def _build_index(self, library_id, callback=None):
+        """
+        Returns a new index for the library from a listing of the bucket.
+        """
+        rendrs = {}
+        prefix = library_id + "/rendrs/"
+        def on_objects(objects):
+            for o in objects:
+                if o.key.endswith(".json"):
+                    rendrs[o.key[len(prefix):-len(".json")]] = {
+                        "revision": (o.etag or "").strip('"'),
+                        "size": o.size, "modified": o.modified}
+
+        error = yield gen.Task(self._list_objects, prefix, on_objects)
+        callback(error or {"rendrs": rendrs})
+
+    @gen.engine
+    def update_index(self, library_id, rendr_id=None, entry=None,
+            rebuild=False, callback=None):
+        """
+        Sets the index entry for `rendr_id`, or with `rebuild`, replaces
+        the index with a listing of the bucket. A missing index is built
+        from a listing first. Calls back with the new index, or
+        {"error": code}.
+
+        The index is replaced with a conditional PUT, so a concurrent change
+        by another writer is detected (as a 412) rather than overwritten;
+        the update is then retried against the new index, up to
+        `index_retries` times.
+        """
+        filename = library_id + "/index.json"
+        for _ in range(self.index_retries):
+            response = yield gen.Task(self._get_file, filename)
+            if response.code == 200 and not rebuild:
+                index = json.loads(response.body)
+            elif response.code in (200, 404):
+                index = yield gen.Task(self._build_index, library_id)
+                if "error" in index:
+                    callback(index)
+                    return
+            else:
+                callback({"error": response.code})
+                return
+
+            if response.code == 200:
+                headers = {"If-Match": response.headers.get("Etag")}
+            else:
+                headers = {"If-None-Match": "*"}
+            if rendr_id is not None:
+                index["rendrs"][rendr_id] = entry
+
+            body = json.dumps(index, sort_keys=True, separators=(",", ":"))
+            response = yield gen.Task(self._put_file, filename, body,
+                headers=headers)
+            if response.code == 200:
+                self.cache.put(filename, body, response.headers.get("Etag"))
+                callback(index)
+                return
+            elif response.code not in (409, 412):
+                callback({"error": response.code})
+                return
+
+            self.stats["index_conflicts"] += 1
+            logging.warning("S3DB.update_index(library_id=%s): conflict" %
+                library_id)
+
+        callback({"error": 409})
+
+    def read_rendr(self, library_id, rendr_id, callback=None,
+            revalidate=False):
+        """
+        Returns a rendr object with the given ID; with `revalidate`, never a
+        cached copy S3 has a newer version of.
+        """
+        self._read_definition(library_id + "/rendrs/" + rendr_id + ".json",
+            callback=callback, revalidate=revalidate)
 
     @gen.engine
     def write_rendr(self, library_id, rendr_id, rendr, callback=None):
-        "Writes the rendr to the database."
-        response = yield gen.Task(self._put_file,
-            library_id + "/rendrs/" + rendr_id + ".json",
-            json.dumps(rendr))
+        """
+        Writes the rendr to the database, and updates the library's index.
+
+        The rendr is saved even if the index can't be updated; the index is
+        then deleted, so listings fall back to the bucket until the next
+        write rebuilds it.
+        """
+        filename = library_id + "/rendrs/" + rendr_id + ".json"
+        body = json.dumps(rendr)
+        response = yield gen.Task(self._put_file, filename, body)
         if response.code != 200:
+            self.cache.delete(filename)
             callback({"error": response.code})
-        else:
-            callback(rendr)
+            return
+
+        # Other nodes will pick up the change when their copies expire
+        revision = hashlib.md5(body).hexdigest()
+        self.cache.put(filename, body, '"%s"' % revision)
+
+        index = yield gen.Task(self.update_index, library_id, rendr_id, {
+            "revision": revision,
+            "size": len(body),
+            "modified": int(time.time())
+        })
+        if "error" in index:
+            self.stats["index_failures"] += 1
+            logging.warning("S3DB.write_rendr(library_id=%s, rendr_id=%s): "
+                "index update failed (%s)" % (library_id, rendr_id,
+                    index["error"]))
+            filename = library_id + "/index.json"
+            self.cache.delete(filename)
+            response = yield gen.Task(self._delete_file, filename)
+            if response.code not in (200, 204, 404):
+                logging.error("S3DB.write_rendr(library_id=%s): couldn't "
+                    "delete stale index (%d)" % (library_id, response.code))
+        callback(rendr)
@@ -0,0 +1,146 @@
+#Copyright (C) 2012 TaguchiMarketing Pty Ltd
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+import time
+from rendr import sharedtable
+
+
+CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+STATE_NAMES = {CLOSED: "closed", OPEN: "open", HALF_OPEN: "half_open"}
+
+
+class CircuitBreaker(object):
+    """
+    Stops work that keeps failing from being retried straight away.
+
+    Each key's breaker starts closed. After `failure_threshold` failures in a
+    row it opens, and `allow` refuses the key for `open_time` seconds. Then
+    it's half open: one probe is allowed through, and its outcome closes the
+    breaker or opens it again. If a probe hasn't reported back after
+    `probe_timeout` seconds, another is allowed.
+
+    State is kept in a `SharedTable` of `slots` entries, so the table is
+    bounded and, if the breaker is created before forking, shared between
+    processes. Keys not updated for `ttl` seconds are forgotten.
+
+    `on_transition`, if set, is called with `(key, state_name)` whenever a
+    key's breaker changes state in this process.
+    """
+    def __init__(self, failure_threshold=None, open_time=None,
+            probe_timeout=None, ttl=None, slots=None):
+        self.failure_threshold = failure_threshold or 1
+        self.open_time = open_time or 100
+        self.probe_timeout = probe_timeout or 10
+        self.ttl = max(ttl or 3600, self.open_time)
+        self.on_transition = None
+
+        # state, consecutive failures, when the state last changed, and
+        # when the last probe was allowed
+        self._table = sharedtable.SharedTable("BIdd", slots=slots)
+
+    def _get(self, key, now):
+        record = self._table.get(key)
+        if record is None or now - record[2] > self.ttl:
+            return (CLOSED, 0, now, 0.0)
+        return record
+
+    def _set(self, key, old_state, record):
+        if record[0] == CLOSED and not record[1]:
+            self._table.delete(key)
+        else:
+            self._table.put(key, record)
+
+        if record[0] != old_state and self.on_transition:
+            self.on_transition(key, STATE_NAMES[record[0]])
+
+    def state(self, key):
+        """
+        Returns the name of the state of `key`'s breaker.
+        """
+        now = time.time()
+        state, _, changed, _ = self._get(key, now)
+        if state == OPEN and now - changed >= self.open_time:
+            state = HALF_OPEN
+        return STATE_NAMES[state]
+
+    def retry_after(self, key):
+        """
+        Returns roughly how many seconds until `key` may be tried again.
+        """
+        now = time.time()
+        state, _, changed, probed = self._get(key, now)
+        if state == OPEN:
+            return max(0, changed + self.open_time - now)
+        elif state == HALF_OPEN:
+            return max(0, probed + self.probe_timeout - now)
+        return 0
+
+    def allow(self, key):
+        """
+        Returns True if work for `key` may go ahead. Once it's done, report
+        the outcome with `success` or `failure`, or if it didn't go ahead
+        after all, call `release`.
+        """
+        now = time.time()
+        state, failures, changed, probed = self._get(key, now)
+        if state == CLOSED:
+            return True
+        elif state == OPEN and now - changed < self.open_time:
+            return False
+        elif state == HALF_OPEN and now - probed < self.probe_timeout:
+            # Still waiting for the last probe
+            return False
+
+        self._set(key, state, (HALF_OPEN, failures,
+            changed if state == HALF_OPEN else now, now))
+        return True
+
+    def release(self, key):
+        """
+        Records that work allowed for `key` didn't go ahead, so that if it
+        was a probe, another is allowed straight away.
+        """
+        now = time.time()
+        state, failures, changed, probed = self._get(key, now)
+        if state == HALF_OPEN and probed:
+            self._set(key, state, (HALF_OPEN, failures, changed, 0.0))
+
+    def success(self, key):
+        """
+        Records that work for `key` succeeded, closing its breaker.
+        """
+        now = time.time()
+        state, failures, _, _ = self._get(key, now)
+        if state != CLOSED or failures:
+            self._set(key, state, (CLOSED, 0, now, 0.0))
+
+    def failure(self, key):
+        """
+        Records that work for `key` failed, opening its breaker if it's half
+        open or has failed `failure_threshold` times in a row.
+        """
+        now = time.time()
+        state, failures, changed, probed = self._get(key, now)
+        failures += 1
+        if state == HALF_OPEN or failures >= self.failure_threshold:
+            self._set(key, state, (OPEN, failures, now, probed))
+        else:
+            self._set(key, state, (CLOSED, failures, now, probed))
@@ -0,0 +1,306 @@
+#Copyright (C) 2012 TaguchiMarketing Pty Ltd
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import os
+import json
+import uuid
+import zlib
+import urllib
+import hashlib
+import logging
+import collections
+
+
+def cache_key(library_id, rendr_id, revision, data, format, quality=None,
+        region=None, options=None):
+    """
+    Returns the cache key for an image, or a named region of it: a
+    (library_id, rendr_id, digest) tuple, where the digest covers everything
+    else that affects the output, including any encoding `options`.
+    """
+    parts = [revision, data, format, quality]
+    if region is not None:
+        parts.append(region)
+    if options:
+        parts.append(options)
+    digest = hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+    return (library_id, rendr_id, digest)
+
+
+class MemoryCache(object):
+    """
+    An LRU cache holding at most `max_bytes` bytes of values.
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes or 64 * 1024 * 1024
+        self.size = 0
+
+        self._entries = collections.OrderedDict()
+        # (library_id, rendr_id) -> set of keys
+        self._groups = collections.defaultdict(set)
+
+    def get(self, key):
+        """
+        Returns the value for `key`, or None.
+        """
+        value = self._entries.pop(key, None)
+        if value is not None:
+            self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        """
+        Stores `value` under `key`; returns the number of entries evicted to
+        make room for it.
+        """
+        if len(value) > self.max_bytes:
+            return 0
+
+        self.delete(key)
+        self._entries[key] = value
+        self._groups[key[:2]].add(key)
+        self.size += len(value)
+
+        evicted = 0
+        while self.size > self.max_bytes:
+            # The least recently used
+            self.delete(next(iter(self._entries)))
+            evicted += 1
+        return evicted
+
+    def delete(self, key):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+            group = self._groups[key[:2]]
+            group.discard(key)
+            if not group:
+                del self._groups[key[:2]]
+
+    def delete_group(self, library_id, rendr_id):
+        """
+        Deletes every entry for the rendr; returns the number deleted.
+        """
+        keys = list(self._groups.get((library_id, rendr_id), ()))
+        for key in keys:
+            self.delete(key)
+        return len(keys)
+
+
+class DiskCache(object):
+    """
+    An LRU cache of files under `path`, holding at most `max_bytes` bytes.
+
+    Entries are stored as `path/<library>/<rendr>/<digest>`. The index of
+    entries is rebuilt from the directory when the cache is created, so the
+    cache survives restarts.
+
+    Several processes may share one directory: entries written by another
+    process are picked up when first read. Each process only counts the
+    entries it has written or read against `max_bytes`, so a directory
+    shared by N processes should be given `max_bytes` / N each. Given
+    `share`, an `(index, count)` pair, a process only loads its share of
+    the directory's entries, those whose digest hashes to `index` modulo
+    `count`, so between them the processes load each entry once.
+    """
+    def __init__(self, path=None, max_bytes=None, share=None):
+        self.path = path
+        self.max_bytes = max_bytes or 1024 * 1024 * 1024
+        self.share = share
+        self.size = 0
+
+        self._entries = collections.OrderedDict()
+        self._load()
+
+    def _filename(self, key):
+        library_id, rendr_id, digest = key
+        return os.path.join(self.path, urllib.quote(library_id, safe=""),
+            urllib.quote(rendr_id, safe=""), digest)
+
+    def _load(self):
+        found = []
+        for (root, _, names) in os.walk(self.path):
+            rel = os.path.relpath(root, self.path).split(os.sep)
+            if len(rel) != 2:
+                continue
+
+            for name in names:
+                if name.startswith("."):
+                    continue
+                if self.share and (zlib.crc32(name) & 0xffffffff) % \
+                        self.share[1] != self.share[0]:
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                key = (urllib.unquote(rel[0]), urllib.unquote(rel[1]), name)
+                found.append((st.st_mtime, key, st.st_size))
+
+        for (_, key, size) in sorted(found):
+            self._entries[key] = size
+            self.size += size
+
+    def get(self, key):
+        """
+        Returns the value for `key`, or None.
+        """
+        try:
+            with open(self._filename(key), "rb") as f:
+                value = f.read()
+        except IOError:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)
+            return None
+
+        if key in self._entries:
+            self._entries[key] = self._entries.pop(key)
+        else:
+            # Written by another process sharing the directory
+            self._entries[key] = len(value)
+            self.size += len(value)
+            self._evict()
+        return value
+
+    def put(self, key, value):
+        """
+        Stores `value` under `key`; returns the number of entries evicted to
+        make room for it.
+        """
+        if len(value) > self.max_bytes:
+            return 0
+
+        filename = self._filename(key)
+        # Write to a temporary name and rename, so readers never see a
+        # partial file
+        temp_filename = os.path.join(os.path.dirname(filename),
+            "." + uuid.uuid4().hex)
+        try:
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(temp_filename, "wb") as f:
+                f.write(value)
+            os.rename(temp_filename, filename)
+        except (IOError, OSError):
+            logging.exception("DiskCache.put(path=%s): failure!" % filename)
+            return 0
+
+        if key in self._entries:
+            self.size -= self._entries.pop(key)
+        self._entries[key] = len(value)
+        self.size += len(value)
+        return self._evict()
+
+    def delete_group(self, library_id, rendr_id):
+        """
+        Deletes every entry for the rendr, including any written by other
+        processes; returns the number deleted.
+        """
+        dirname = os.path.join(self.path, urllib.quote(library_id, safe=""),
+            urllib.quote(rendr_id, safe=""))
+        try:
+            names = os.listdir(dirname)
+        except OSError:
+            return 0
+
+        deleted = 0
+        for name in names:
+            if name.startswith("."):
+                continue
+            key = (library_id, rendr_id, name)
+            if key in self._entries:
+                self.size -= self._entries.pop(key)
+            try:
+                os.remove(os.path.join(dirname, name))
+                deleted += 1
+            except OSError:
+                pass
+        return deleted
+
+    def _evict(self):
+        evicted = 0
+        while self.size > self.max_bytes:
+            old_key, old_size = self._entries.popitem(last=False)
+            self.size -= old_size
+            evicted += 1
+            try:
+                os.remove(self._filename(old_key))
+            except OSError:
+                pass
+        return evicted
+
+
+class ImageCache(object):
+    """
+    Rendered images, in a `MemoryCache` backed by an optional `DiskCache`;
+    `disk_share` is passed on to it as `share`.
+
+    Counts of hits in each tier, misses, evictions and invalidations are
+    kept in `stats`.
+    """
+    def __init__(self, memory_bytes=None, disk_path=None, disk_bytes=None,
+            disk_share=None):
+        self.memory = MemoryCache(memory_bytes)
+        self.disk = None
+        if disk_path:
+            self.disk = DiskCache(disk_path, disk_bytes, disk_share)
+        self.stats = dict.fromkeys(("memory_hits", "disk_hits", "misses",
+            "evictions", "invalidations"), 0)
+
+    def get(self, key):
+        """
+        Returns a (value, tier) tuple, where tier is "memory", "disk" or None
+        for a miss. Disk hits are promoted to memory.
+        """
+        value = self.memory.get(key)
+        if value is not None:
+            self.stats["memory_hits"] += 1
+            return value, "memory"
+
+        if self.disk:
+            value = self.disk.get(key)
+            if value is not None:
+                self.stats["disk_hits"] += 1
+                self.stats["evictions"] += self.memory.put(key, value)
+                return value, "disk"
+
+        self.stats["misses"] += 1
+        return None, None
+
+    def put(self, key, value):
+        """
+        Stores `value` in both tiers; returns the number of entries evicted.
+        """
+        evicted = self.memory.put(key, value)
+        if self.disk:
+            evicted += self.disk.put(key, value)
+        self.stats["evictions"] += evicted
+        return evicted
+
+    def delete_rendr(self, library_id, rendr_id):
+        """
+        Deletes every image of the rendr from both tiers, e.g. once it's
+        been changed; returns the number of entries deleted.
+        """
+        deleted = self.memory.delete_group(library_id, rendr_id)
+        if self.disk:
+            deleted += self.disk.delete_group(library_id, rendr_id)
+        self.stats["invalidations"] += deleted
+        return deleted
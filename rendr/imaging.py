@@ -0,0 +1,252 @@
+#Copyright (C) 2012 TaguchiMarketing Pty Ltd
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+import time
+import cStringIO
+import collections
+from PIL import Image
+
+
+# Maps alpha values to a mask of the pixels a GIF shows as transparent:
+# those no more than half opaque. As a lookup table, it's applied to the
+# whole image by `point` without calling back into Python.
+TRANSPARENT_LUT = [255] * 129 + [0] * 127
+
+# The palette index GIFs use for transparent pixels
+TRANSPARENT_INDEX = 255
+
+
+class RegionError(ValueError):
+    """
+    A region to crop an image to which is outside the image.
+    """
+
+
+def _gif_palette(palette):
+    """
+    Returns a "P" image carrying `palette` (a list of 765 values, for 255
+    colors), for quantizing other images to it.
+    """
+    img = Image.new("P", (1, 1))
+    # The spare entry repeats the first, so opaque pixels map to that
+    # instead of the transparent index
+    img.putpalette(palette[:765] + palette[:3])
+    return img
+
+
+def encode_gif(img, palette=None):
+    """
+    img: Image
+        the image to encode, with or without an alpha channel
+    palette: list
+        a palette from an earlier call, to reuse rather than choosing one for
+        this image
+
+    Returns a `(body, palette)` tuple: the GIF, and the palette it was
+    quantized to, as a list of 765 values.
+    """
+    img.load()
+    mask = None
+    if "A" in img.getbands():
+        mask = img.split()[-1].point(TRANSPARENT_LUT)
+
+    img = img.convert("RGB")
+    if palette:
+        # Without dithering, which only bloats GIFs of flat-colored pages
+        img = img.quantize(palette=_gif_palette(palette), dither=Image.NONE)
+    else:
+        # Choosing a palette is most of the work of encoding
+        img = img.convert("P", palette=Image.ADAPTIVE, colors=255)
+        palette = img.getpalette()[:765]
+
+    if mask is not None:
+        img.paste(TRANSPARENT_INDEX, mask)
+
+    buf = cStringIO.StringIO()
+    img.save(buf, "gif", transparency=TRANSPARENT_INDEX)
+    return buf.getvalue(), palette
+
+
+# Formats images can be served in; "webp" needs Pillow built with WebP
+FORMATS = ("png", "jpg", "gif", "webp")
+
+MIME_TYPES = {"png": "image/png", "jpg": "image/jpeg", "gif": "image/gif",
+    "webp": "image/webp"}
+
+_encodable = {}
+
+
+def can_encode(format):
+    """
+    Returns True if images can be encoded in `format` by this Pillow.
+    """
+    if format not in _encodable:
+        try:
+            Image.new("RGB", (1, 1)).save(cStringIO.StringIO(),
+                "jpeg" if format == "jpg" else format)
+            _encodable[format] = format in FORMATS
+        except (IOError, KeyError, ValueError):
+            _encodable[format] = False
+    return _encodable[format]
+
+
+def image_format(body):
+    """
+    Returns the format of an encoded image, from its signature, or None.
+    """
+    if body.startswith("\x89PNG"):
+        return "png"
+    elif body.startswith("\xff\xd8"):
+        return "jpg"
+    elif body.startswith("GIF8"):
+        return "gif"
+    elif body.startswith("RIFF") and body[8:12] == "WEBP":
+        return "webp"
+    return None
+
+
+def _encode(img, format, quality, options, original=None,
+        lossless=False):
+    """
+    Encodes `img` as a PNG, JPEG or WebP. `original` is the rasterizer's
+    PNG of the same image, which is used as it is if no PNG options are
+    set. With `lossless`, a WebP is lossless, and `quality` is ignored.
+    """
+    buf = cStringIO.StringIO()
+    if format == "png":
+        level = options.get("compress_level")
+        colors = options.get("colors")
+        if original is not None and level is None and not colors:
+            return original
+
+        if colors:
+            # Fast octree (2) is the only quantizer that keeps the alpha
+            # channel
+            img = img.quantize(colors, method=2 if "A" in img.getbands()
+                else 0)
+        params = {}
+        if level is not None:
+            params["compress_level"] = level
+        img.save(buf, "png", **params)
+    elif format == "jpg":
+        img = img.convert("RGB")
+        if options.get("progressive"):
+            img.save(buf, "jpeg", quality=quality, progressive=True,
+                optimize=True)
+        else:
+            img.save(buf, "jpeg", quality=quality)
+    elif format == "webp" and lossless:
+        img.save(buf, "webp", lossless=True)
+    elif format == "webp":
+        img.save(buf, "webp", quality=quality)
+    else:
+        raise ValueError("unsupported format: %s" % format)
+    return buf.getvalue()
+
+
+def encode_image(data, format, quality=None, clip=None, palette=None,
+        options=None):
+    """
+    data: str
+        the PNG image from the rasterizer
+    format: str
+        "jpg", "gif", "png" or "webp"; or several joined with "+", e.g.
+        "png+webp", to use whichever comes out smallest
+    quality: int
+        the JPEG or WebP quality; a WebP standing in for a PNG is lossless
+    clip: list
+        a region of the image (top, left, bottom, right) to crop it to
+    palette: list
+        a GIF palette to reuse, as returned by an earlier call
+    options: dict
+        "progressive" for progressive, optimized JPEGs; "compress_level"
+        (0-9) and "colors" (a number of palette entries) to re-encode PNGs
+
+    Converts the PNG image to `format`. Returns a `(body, seconds, palette)`
+    tuple, where `seconds` is the time spent encoding and `palette` is the
+    palette of a GIF, or None. `image_format` tells which format a "+"
+    format produced. Raises RegionError if `clip` is outside the image.
+
+    This runs in an `AsyncPool`, possibly in another process, so it takes
+    and returns only picklable values.
+    """
+    t = time.time()
+    options = options or {}
+
+    img = Image.open(cStringIO.StringIO(data), "r")
+    if clip:
+        # Regions hanging off the edge of the page are cut short
+        top, left, bottom, right = clip
+        width, height = img.size
+        box = (min(left, width), min(top, height), min(right, width),
+            min(bottom, height))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            raise RegionError("region %s is outside the %dx%d image" % (
+                list(clip), width, height))
+        img = img.crop(box)
+
+    smallest, gif_palette = None, None
+    formats = format.split("+")
+    for f in formats:
+        if f == "gif":
+            body, gif_palette = encode_gif(img, palette)
+        else:
+            body = _encode(img, f, quality, options,
+                None if clip else data, lossless="png" in formats)
+        if smallest is None or len(body) < len(smallest):
+            smallest = body
+
+    return smallest, time.time() - t, gif_palette
+
+
+class PaletteCache(object):
+    """
+    The GIF palettes chosen for the last `max_entries` rendr revisions, so
+    later GIFs of a revision skip choosing their own. Every GIF of a
+    revision then shares the colors of the first one encoded, which suits
+    rendrs whose parameters change text rather than colors.
+
+    Counts of hits and misses are kept in `stats`.
+    """
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or 1000
+        self.stats = {"hits": 0, "misses": 0}
+
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """
+        Returns the palette for `key`, a (library_id, rendr_id, revision)
+        tuple, or None.
+        """
+        palette = self._entries.pop(key, None)
+        if palette is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        self._entries[key] = palette
+        return palette
+
+    def put(self, key, palette):
+        self._entries.pop(key, None)
+        self._entries[key] = palette
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,72 @@
+#Copyright (C) 2012 TaguchiMarketing Pty Ltd
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import logging
+import functools
+import tornado.stack_context
+
+
+class InFlight(object):
+    """
+    Tracks jobs in progress by key, so that concurrent callers asking for
+    the same key share a single job.
+
+    A job is a function taking a callback, which it calls with
+    `(result, error)` when done. Every caller waiting on the job is called
+    back with the same arguments, so failures are shared too. If the job
+    raises an exception, waiters are called back with `(None, exception)`.
+    """
+    def __init__(self):
+        self.stats = {"started": 0, "coalesced": 0}
+
+        self._waiters = {}
+
+    def __contains__(self, key):
+        return key in self._waiters
+
+    def run(self, key, job, callback=None):
+        """
+        Calls back with the result of the job in progress for `key`, or
+        starts `job` to produce it.
+        """
+        callback = tornado.stack_context.wrap(callback)
+        if key in self._waiters:
+            self.stats["coalesced"] += 1
+            self._waiters[key].append(callback)
+            return
+
+        self.stats["started"] += 1
+        self._waiters[key] = [callback]
+
+        def handle_exception(exc_type, exc_value, exc_traceback):
+            logging.error("InFlight.run(key=%s): failure!" % repr(key),
+                exc_info=(exc_type, exc_value, exc_traceback))
+            self._finish(key, None, exc_value)
+            return True
+
+        # The job belongs to all its waiters, not to the first caller
+        with tornado.stack_context.NullContext():
+            with tornado.stack_context.ExceptionStackContext(
+                    handle_exception):
+                job(functools.partial(self._finish, key))
+
+    def _finish(self, key, result, error=None):
+        for callback in self._waiters.pop(key, ()):
+            callback(result, error)
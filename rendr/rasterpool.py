@@ -0,0 +1,223 @@
+#Copyright (C) 2012 TaguchiMarketing Pty Ltd
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+import json
+import base64
+import logging
+import functools
+import collections
+import tornado.ioloop
+import tornado.stack_context
+from rendr import asyncprocess
+
+
+def image_data(response):
+    """
+    Returns the PNG image in a successful rasterizer response to a job
+    without an output file, or None if there isn't one.
+    """
+    if not response.startswith("success: data:image/png;base64,"):
+        return None
+    return base64.b64decode(response.partition(",")[2])
+
+
+def timed_out(response):
+    """
+    Returns True if a rasterizer response says the page timed out, either
+    in the rasterizer or waiting for it to respond.
+    """
+    return "timed out" in response
+
+
+def batch_responses(response, count):
+    """
+    Returns the list of `count` responses, one per page, for a response to
+    a batch job. If the batch failed as a whole, every page gets the batch's
+    response.
+    """
+    if response.startswith("batch: "):
+        try:
+            responses = json.loads(response[len("batch: "):])
+        except ValueError:
+            responses = None
+        if isinstance(responses, list) and len(responses) == count:
+            return [str(r) for r in responses]
+        response = "error: invalid batch response"
+    return [response] * count
+
+
+class RasterizePool(object):
+    """
+    A fixed number of warm rasterize processes (`rasterize --worker`), each
+    managed by an `AsyncProcess`.
+
+    Jobs are sent to the processes as single-line JSON messages, and wait in
+    a queue until a process has fewer than `pipeline` jobs outstanding; once
+    `max_queue` jobs are waiting, further jobs fail immediately. Each process
+    is restarted after it has been sent `max_jobs` jobs, and replaced if it
+    stops.
+    """
+    def __init__(self, command=None, size=None, max_queue=None, max_jobs=None,
+            timeout=None, pipeline=None, io_loop=None):
+        self.command = command
+        self.size = size or 4
+        self.max_queue = max_queue if max_queue is not None else 100
+        self.max_jobs = max_jobs or 500
+        self.timeout = timeout or 10
+        self.pipeline = pipeline or 1
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+
+        self._workers = []
+        self._jobs_sent = {}
+        self._queue = collections.deque()
+
+    def start(self):
+        """
+        Starts all processes in the pool.
+        """
+        for _ in range(self.size):
+            worker = asyncprocess.AsyncProcess(command=self.command,
+                timeout=self.timeout, io_loop=self.io_loop,
+                max_in_flight=self.pipeline)
+            worker.start()
+            self._workers.append(worker)
+            self._jobs_sent[worker] = 0
+
+    def stop(self):
+        """
+        Stops all processes, and fails any queued jobs.
+        """
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.stop("rasterizer pool stopped")
+
+        while self._queue:
+            _, callback, _ = self._queue.popleft()
+            callback("error: rasterizer pool stopped")
+
+    def queue_length(self):
+        """
+        Returns the number of jobs waiting for a process.
+        """
+        return len(self._queue)
+
+    def is_full(self):
+        """
+        Returns True if no more jobs can be queued.
+        """
+        return len(self._queue) >= self.max_queue
+
+    def rasterize(self, url, output=None, clip=None, html=None,
+            callback=None):
+        """
+        Renders `url` to the PNG file `output`, optionally clipped to the
+        region `clip` (top, left, bottom, right). If `html` is given, the page
+        is loaded from it rather than fetched, and `url` is only used as its
+        address. `callback` is called with the rasterizer's response line,
+        which starts with "success" if the image was written.
+
+        Without `output`, the image is sent back over the rasterizer's stdout
+        instead, as a data URI in the response; see `image_data`.
+        """
+        callback = tornado.stack_context.wrap(callback)
+        if self.is_full():
+            callback("error: rasterizer queue full")
+            return
+
+        job = {"url": url}
+        if output:
+            job["output"] = output
+        if clip:
+            job["clip"] = list(clip)
+        if html is not None:
+            job["html"] = html
+
+        self._queue.append((job, callback, None))
+        self._dispatch()
+
+    def rasterize_batch(self, pages, outputs=None, callback=None):
+        """
+        Renders each of `pages`, a list of (url, html) pairs, to a PNG image,
+        one after another in a single rasterizer job which reuses one page.
+        `callback` is called with a list of response lines, one per page,
+        like those from `rasterize`. Given `outputs`, a list of PNG files,
+        one per page, each image is written to its file; otherwise, each is
+        sent back in its response.
+
+        Each page may take up to `timeout` seconds, and the whole job up to
+        `timeout` seconds per page.
+        """
+        callback = tornado.stack_context.wrap(callback)
+        if self.is_full():
+            callback(["error: rasterizer queue full"] * len(pages))
+            return
+
+        job = {
+            "url": pages[0][0],
+            "pages": [{"url": url, "html": html} for url, html in pages],
+            "timeout": self.timeout * 1000
+        }
+        for page, output in zip(job["pages"], outputs or []):
+            page["output"] = output
+        self._queue.append((job, lambda response: callback(
+            batch_responses(response, len(pages))),
+            self.timeout * (len(pages) + 1)))
+        self._dispatch()
+
+    def _dispatch(self):
+        for worker in self._workers:
+            if not self._queue:
+                return
+
+            if not worker.is_serving():
+                # Stopped after writing to stderr and exiting -- replace it
+                self._jobs_sent[worker] = 0
+                try:
+                    worker.start()
+                except OSError:
+                    logging.exception(
+                        "RasterizePool._dispatch(cmd=%s): failure!" % \
+                        repr(self.command))
+                    continue
+
+            if self._jobs_sent[worker] >= self.max_jobs:
+                # Recycle worn-out processes once they've finished their jobs
+                if worker.pending():
+                    continue
+                worker.restart()
+                self._jobs_sent[worker] = 0
+
+            while self._queue and worker.pending() < self.pipeline and \
+                    self._jobs_sent[worker] < self.max_jobs:
+                job, callback, timeout = self._queue.popleft()
+                self._jobs_sent[worker] += 1
+                worker.submit(json.dumps(job),
+                    functools.partial(self._on_job_done, callback),
+                    timeout=timeout)
+
+        if self._queue and not any(w.is_serving() for w in self._workers):
+            while self._queue:
+                _, callback, _ = self._queue.popleft()
+                callback("error: no rasterizers available")
+
+    def _on_job_done(self, callback, response, error):
+        callback(response if error is None else "error: " + error)
+        self._dispatch()
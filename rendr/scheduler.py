@@ -0,0 +1,361 @@
+#Copyright (C) 2012 TaguchiMarketing Pty Ltd
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+import math
+import time
+import functools
+import collections
+import tornado.ioloop
+import tornado.stack_context
+
+
+# The library a render is for, when it was queued, when it was allowed to
+# start, and whether it was a background render
+Ticket = collections.namedtuple("Ticket", ("library_id", "queued",
+    "started", "background"))
+
+
+class RenderRejected(Exception):
+    """
+    A render that couldn't be started in time. `retry_after` is a suggested
+    number of seconds to wait before trying again.
+    """
+    def __init__(self, reason, retry_after):
+        super(RenderRejected, self).__init__(reason)
+        self.retry_after = retry_after
+
+
+class _Waiter(object):
+    def __init__(self, library_id, callback, queued, background=False):
+        self.library_id = library_id
+        self.callback = callback
+        self.queued = queued
+        self.background = background
+        self.timeout = None
+
+
+class RenderScheduler(object):
+    """
+    Admission control for renders: at most `concurrency` renders run at
+    once, and at most `max_queue` more wait for a turn.
+
+    Waiting renders are queued per library, and the libraries take turns by
+    deficit round-robin, so one library's burst can't hold up everyone
+    else's renders. In each turn a library may start as many renders as its
+    weight in `weights` (1 by default; weights may be fractional, but must
+    be positive). Each
+    library may also be limited to `library_concurrency` renders at once, and
+    to starting `library_rate` renders a second, in bursts of up to
+    `library_burst`.
+
+    Each render has a deadline by which it must start. Renders which the
+    scheduler expects can't start by then are rejected straight away rather
+    than queued, and queued renders are rejected when their deadline
+    passes. Expected waits come from a moving average of how long renders
+    take.
+
+    Background renders (e.g. warming the cache) wait in a queue of their
+    own, and only start when no other render is waiting; at most
+    `background_concurrency` of them run at once (by default, half of
+    `concurrency`), so requests are never stuck behind them for long.
+
+    Counts of renders started, queued, rejected and expired are kept in
+    `stats`.
+    """
+    def __init__(self, concurrency=None, max_queue=None, weights=None,
+            library_concurrency=None, library_rate=None, library_burst=None,
+            background_concurrency=None, io_loop=None):
+        self.concurrency = concurrency or 4
+        self.max_queue = max_queue if max_queue is not None else 100
+        self.weights = weights or {}
+        if any(not weight > 0 for weight in self.weights.values()):
+            raise ValueError("library weights must be positive")
+        self.library_concurrency = library_concurrency
+        self.library_rate = library_rate
+        self.library_burst = library_burst or max(1, library_rate or 0)
+        self.background_concurrency = background_concurrency or \
+            max(1, self.concurrency // 2)
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.running = 0
+        self.render_time = 1.0
+        self.stats = dict.fromkeys(("started", "queued", "rejected",
+            "expired"), 0)
+
+        self._queued = 0
+        self._queues = {}
+        self._active = collections.deque()
+        self._deficits = {}
+        self._library_running = {}
+        self._buckets = {}
+        self._wakeup = None
+        self._background = collections.deque()
+        self._background_running = 0
+
+    def queue_length(self, library_id=None):
+        """
+        Returns the number of renders waiting to start, in total or for one
+        library.
+        """
+        if library_id is None:
+            return self._queued
+        return len(self._queues.get(library_id, ()))
+
+    def expected_wait(self, library_id=None):
+        """
+        Returns roughly how many seconds a render for `library_id` queued
+        now would wait to start.
+        """
+        own = self.queue_length(library_id)
+        if library_id is None:
+            ahead = self._queued
+        else:
+            # Roughly one render from each other waiting library goes
+            # ahead of each of this library's
+            others = len(self._active) - (1 if own else 0)
+            ahead = min(self._queued, own + (own + 1) * others)
+
+        wait = 0.0
+        if ahead or self.running >= self.concurrency:
+            wait = (ahead + 1) * self.render_time / self.concurrency
+
+        if library_id is not None:
+            if self.library_concurrency and own + \
+                    self._library_running.get(library_id, 0) >= \
+                    self.library_concurrency:
+                wait = max(wait, (own + 1) * self.render_time /
+                    self.library_concurrency)
+            if self.library_rate:
+                wait = max(wait, (own + 1 - self._tokens(library_id)) /
+                    self.library_rate)
+        return wait
+
+    def _retry_after(self, library_id):
+        return max(1, int(math.ceil(self.expected_wait(library_id))))
+
+    def acquire(self, library_id, deadline, callback=None, background=False):
+        """
+        Waits for a turn to render for `library_id`, starting no later than
+        the timestamp `deadline`. Calls back with `(ticket, error)`; once
+        the render is done, the ticket must be passed to `release`. `error`
+        is a `RenderRejected` if the render may not start.
+        """
+        callback = tornado.stack_context.wrap(callback)
+        now = time.time()
+        waiter = _Waiter(library_id, callback, now, background)
+        if background:
+            self._acquire_background(waiter, deadline)
+            return
+
+        if self.running < self.concurrency and \
+                library_id not in self._queues and \
+                self._may_start(library_id):
+            self._start(waiter)
+            return
+
+        if self._queued >= self.max_queue:
+            self.stats["rejected"] += 1
+            callback(None, RenderRejected("render queue full",
+                self._retry_after(library_id)))
+            return
+        elif now + self.expected_wait(library_id) > deadline:
+            self.stats["rejected"] += 1
+            callback(None, RenderRejected("render would start too late",
+                self._retry_after(library_id)))
+            return
+
+        self.stats["queued"] += 1
+        if library_id not in self._queues:
+            self._queues[library_id] = collections.deque()
+            self._active.append(library_id)
+            self._deficits[library_id] = 0
+        self._queues[library_id].append(waiter)
+        self._queued += 1
+        waiter.timeout = self.io_loop.add_timeout(deadline,
+            functools.partial(self._expire, waiter))
+        self._dispatch()
+
+    def _acquire_background(self, waiter, deadline):
+        if not self._background and self._may_start_background(waiter):
+            self._start(waiter)
+            return
+        elif len(self._background) >= self.max_queue:
+            self.stats["rejected"] += 1
+            waiter.callback(None, RenderRejected("render queue full",
+                self._retry_after(waiter.library_id)))
+            return
+
+        # Background renders may wait until their deadline, however long
+        # the wait is expected to be
+        self.stats["queued"] += 1
+        self._background.append(waiter)
+        waiter.timeout = self.io_loop.add_timeout(deadline,
+            functools.partial(self._expire, waiter))
+
+    def _may_start_background(self, waiter):
+        return self.running < self.concurrency and not self._queued and \
+            self._background_running < self.background_concurrency and \
+            self._may_start(waiter.library_id)
+
+    def release(self, ticket, pages=1):
+        """
+        Ends the render `ticket` was issued for, letting the next one start.
+        A ticket for a batch of `pages` pages counts towards the average
+        render time as that many renders.
+        """
+        self.running -= 1
+        if ticket.background:
+            self._background_running -= 1
+        self._library_running[ticket.library_id] -= 1
+        if not self._library_running[ticket.library_id]:
+            del self._library_running[ticket.library_id]
+        self.render_time = 0.8 * self.render_time + \
+            0.2 * (time.time() - ticket.started) / pages
+        self._dispatch()
+
+    def _tokens(self, library_id):
+        """
+        Returns the number of renders `library_id` may start now under its
+        rate limit. Only libraries with less than a full bucket are tracked.
+        """
+        if library_id not in self._buckets:
+            return self.library_burst
+
+        now = time.time()
+        tokens, updated = self._buckets[library_id]
+        tokens += (now - updated) * self.library_rate
+        if tokens >= self.library_burst:
+            del self._buckets[library_id]
+            return self.library_burst
+
+        self._buckets[library_id] = (tokens, now)
+        return tokens
+
+    def _may_start(self, library_id):
+        if self.library_concurrency and \
+                self._library_running.get(library_id, 0) >= \
+                self.library_concurrency:
+            return False
+        if self.library_rate and self._tokens(library_id) < 1:
+            return False
+        return True
+
+    def _start(self, waiter):
+        library_id = waiter.library_id
+        self.running += 1
+        if waiter.background:
+            self._background_running += 1
+        self._library_running[library_id] = \
+            self._library_running.get(library_id, 0) + 1
+        if self.library_rate:
+            self._buckets[library_id] = (self._tokens(library_id) - 1,
+                time.time())
+        if waiter.timeout:
+            self.io_loop.remove_timeout(waiter.timeout)
+
+        self.stats["started"] += 1
+        # Not from inside the previous render's completion
+        self.io_loop.add_callback(functools.partial(waiter.callback,
+            Ticket(library_id, waiter.queued, time.time(), waiter.background),
+            None))
+
+    def _next(self):
+        """
+        Takes the next waiter to start from the library queues, or returns
+        None if no library may start a render now.
+        """
+        blocked = 0
+        while blocked < len(self._active):
+            library_id = self._active[0]
+            if not self._may_start(library_id):
+                blocked += 1
+                self._active.rotate(-1)
+                continue
+
+            if self._deficits[library_id] < 1:
+                self._deficits[library_id] += \
+                    self.weights.get(library_id) or 1
+            if self._deficits[library_id] < 1:
+                # Fractionally weighted libraries wait for more turns
+                self._active.rotate(-1)
+                continue
+
+            self._deficits[library_id] -= 1
+            queue = self._queues[library_id]
+            waiter = queue.popleft()
+            self._queued -= 1
+            if not queue:
+                self._remove(library_id)
+            elif self._deficits[library_id] < 1:
+                self._active.rotate(-1)
+            return waiter
+        return None
+
+    def _remove(self, library_id):
+        del self._queues[library_id]
+        del self._deficits[library_id]
+        self._active.remove(library_id)
+
+    def _dispatch(self):
+        while self.running < self.concurrency and self._active:
+            waiter = self._next()
+            if waiter is None:
+                break
+            self._start(waiter)
+
+        for waiter in list(self._background):
+            if self._may_start_background(waiter):
+                self._background.remove(waiter)
+                self._start(waiter)
+
+        if self.library_rate and (self._active or self._background) and \
+                self._wakeup is None and self.running < self.concurrency:
+            # Libraries may be waiting for their rate limits alone, so
+            # check again once the next of them may start
+            waiting = set(self._active)
+            waiting.update(w.library_id for w in self._background)
+            delays = [(1 - tokens) / self.library_rate for tokens in
+                (self._tokens(library_id) for library_id in waiting)
+                if tokens < 1]
+            if delays:
+                self._wakeup = self.io_loop.add_timeout(
+                    time.time() + max(min(delays), 0.001), self._on_wakeup)
+
+    def _on_wakeup(self):
+        self._wakeup = None
+        self._dispatch()
+
+    def _expire(self, waiter):
+        if waiter.background:
+            queue = self._background
+        else:
+            queue = self._queues.get(waiter.library_id)
+        if not queue or waiter not in queue:
+            return
+
+        queue.remove(waiter)
+        if not waiter.background:
+            self._queued -= 1
+            if not queue:
+                self._remove(waiter.library_id)
+
+        self.stats["expired"] += 1
+        waiter.callback(None, RenderRejected("render deadline passed",
+            self._retry_after(waiter.library_id)))
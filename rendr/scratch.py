@@ -0,0 +1,126 @@
+#Copyright (C) 2012 TaguchiMarketing Pty Ltd
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+import os
+import time
+import atexit
+import shutil
+import logging
+import tempfile
+import tornado.ioloop
+
+
+class ScratchDir(object):
+    """
+    A directory of temporary files belonging to this process.
+
+    Files are created with `mkstemp`, and should be removed with `remove`
+    as soon as they're finished with. Anything left behind -- for example,
+    an image written by a rasterizer after its job timed out -- is removed by
+    a periodic sweep once it's older than `max_age` seconds. As the
+    directory belongs to one process, sweeping it only lists its own files,
+    and it's removed when the process exits.
+
+    Counts of files created, removed and swept are kept in `stats`.
+    """
+    def __init__(self, path=None, max_age=None, sweep_interval=None,
+            io_loop=None):
+        self.max_age = max_age or 60
+        self.sweep_interval = sweep_interval or 30
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.stats = dict.fromkeys(("created", "removed", "swept", "sweeps"),
+            0)
+
+        if path:
+            self.path = os.path.join(path, "rendr-%d" % os.getpid())
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+        else:
+            self.path = tempfile.mkdtemp(prefix="rendr-%d-" % os.getpid())
+
+        self._timer = None
+        self._pid = os.getpid()
+        atexit.register(self.close)
+
+    def start(self):
+        """
+        Starts sweeping the directory periodically.
+        """
+        self._timer = tornado.ioloop.PeriodicCallback(self.sweep,
+            self.sweep_interval * 1000, io_loop=self.io_loop)
+        self._timer.start()
+
+    def close(self):
+        """
+        Stops sweeping, and removes the directory and everything in it.
+        """
+        if self._timer:
+            self._timer.stop()
+            self._timer = None
+        # A forked child inherits the exit handler, but not the directory
+        if os.getpid() == self._pid:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def mkstemp(self, suffix=""):
+        """
+        Creates an empty file in the directory, and returns its path.
+        """
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=self.path)
+        os.close(fd)
+        self.stats["created"] += 1
+        return path
+
+    def remove(self, path):
+        """
+        Removes a file created by `mkstemp`, if it still exists.
+        """
+        try:
+            os.remove(path)
+            self.stats["removed"] += 1
+        except OSError:
+            pass
+
+    def sweep(self):
+        """
+        Removes files older than `max_age` seconds; returns how many were
+        removed.
+        """
+        self.stats["sweeps"] += 1
+        swept = 0
+        cutoff = time.time() - self.max_age
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            logging.exception("ScratchDir.sweep(path=%s): failure!" % \
+                self.path)
+            return 0
+
+        for name in names:
+            target = os.path.join(self.path, name)
+            try:
+                if os.path.getmtime(target) < cutoff:
+                    os.remove(target)
+                    swept += 1
+            except OSError:
+                continue
+
+        self.stats["swept"] += swept
+        return swept
@@ -0,0 +1,109 @@
+#Copyright (C) 2012 TaguchiMarketing Pty Ltd
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+import mmap
+import struct
+import hashlib
+
+
+class SharedTable(object):
+    """
+    A fixed-size hash table of records in shared memory, so that processes
+    forked after it is created all see the same entries.
+
+    Keys are any values with a stable `repr`, and are stored as 64-bit
+    hashes. Each record is a tuple packed with the `struct` format
+    `record_format`. A key can only live in one of `probe` slots, so once
+    those are full, adding a key overwrites one of them: the table is
+    bounded by `slots`, and entries are best-effort.
+
+    Access isn't locked: a reader racing a writer may see a partly written
+    record, so records should only be used as hints (e.g. "this rendr
+    recently failed"), never for anything that must be exact.
+    """
+    _header = struct.Struct("=Q")
+
+    def __init__(self, record_format, slots=None, probe=None):
+        self.slots = slots or 65536
+        self.probe = probe or 4
+        self._record = struct.Struct("=Q" + record_format.lstrip("=@<>!"))
+        self._map = mmap.mmap(-1, self.slots * self._record.size)
+
+    def _digest(self, key):
+        digest, = self._header.unpack(
+            hashlib.sha1(repr(key)).digest()[:self._header.size])
+        # 0 marks an empty slot
+        return digest or 1
+
+    def _slots(self, digest):
+        start = digest % self.slots
+        return [(start + i) % self.slots for i in range(self.probe)]
+
+    def _read(self, slot):
+        offset = slot * self._record.size
+        return self._record.unpack(
+            self._map[offset:offset + self._record.size])
+
+    def _write(self, slot, record):
+        offset = slot * self._record.size
+        self._map[offset:offset + self._record.size] = \
+            self._record.pack(*record)
+
+    def get(self, key, default=None):
+        """
+        Returns the record for `key`, or `default`.
+        """
+        digest = self._digest(key)
+        for slot in self._slots(digest):
+            record = self._read(slot)
+            if record[0] == digest:
+                return record[1:]
+        return default
+
+    def put(self, key, record):
+        """
+        Stores the tuple `record` under `key`.
+        """
+        digest = self._digest(key)
+        slots = self._slots(digest)
+        target = None
+        for slot in slots:
+            found = self._read(slot)[0]
+            if found == digest:
+                target = slot
+                break
+            elif found == 0 and target is None:
+                target = slot
+        if target is None:
+            # No room -- evict the key in this key's first slot
+            target = slots[0]
+        self._write(target, (digest, ) + tuple(record))
+
+    def delete(self, key):
+        digest = self._digest(key)
+        for slot in self._slots(digest):
+            if self._read(slot)[0] == digest:
+                offset = slot * self._record.size
+                self._map[offset:offset + self._record.size] = \
+                    "\0" * self._record.size
+
+    def clear(self):
+        self._map[:] = "\0" * len(self._map)
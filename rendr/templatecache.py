@@ -0,0 +1,68 @@
+#Copyright (C) 2012 TaguchiMarketing Pty Ltd
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+import hashlib
+import pystache
+import collections
+import tornado.escape
+
+
+class TemplateCache(object):
+    """
+    Parsed mustache templates, so each is only parsed once.
+
+    Templates are cached under a caller-chosen key -- e.g. a rendr and which
+    of its parts the template is -- along with a hash of their source, so
+    an entry is replaced as soon as the source changes. At most
+    `max_entries` templates are kept, least recently used first out.
+
+    Counts of hits and misses are kept in `stats`.
+    """
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or 1000
+        self.stats = {"hits": 0, "misses": 0}
+
+        self._entries = collections.OrderedDict()
+
+    def parse(self, key, source):
+        """
+        Returns the parsed template for `source`.
+        """
+        source = tornado.escape.to_unicode(source)
+        digest = hashlib.sha1(source.encode("utf-8")).digest()
+
+        entry = self._entries.pop(key, None)
+        if entry and entry[0] == digest:
+            self.stats["hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            entry = (digest, pystache.parse(source))
+            if len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+
+        self._entries[key] = entry
+        return entry[1]
+
+    def render(self, key, source, context):
+        """
+        Renders `source` with `context`, using the cached parse.
+        """
+        return pystache.render(self.parse(key, source), context)
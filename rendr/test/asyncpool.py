@@ -0,0 +1,79 @@
+import os
+import time
+import tornado.testing
+from rendr import asyncpool
+
+
+class AsyncPoolTestCase(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(AsyncPoolTestCase, self).setUp()
+        self.pool = asyncpool.AsyncPool(workers=1, max_queue=1,
+            io_loop=self.io_loop)
+
+    def test_run(self):
+        self.pool.run(sum, [1, 2, 3],
+            callback=lambda result, error: self.stop((result, error)))
+        self.assertEqual((6, None), self.wait())
+        self.assertEqual(0, self.pool.pending)
+
+    def test_error(self):
+        self.pool.run(int, "x",
+            callback=lambda result, error: self.stop((result, error)))
+        result, error = self.wait()
+        self.assertTrue(isinstance(error, ValueError))
+
+    def test_full(self):
+        results = []
+        def callback(result, error):
+            results.append((result, error))
+            if len(results) == 3:
+                self.stop()
+
+        # One call running and one queued; the third is turned away
+        for _ in range(3):
+            self.pool.run(time.sleep, 0.05, callback=callback)
+        self.wait()
+        self.assertTrue(isinstance(results[0][1], asyncpool.PoolFull))
+        self.assertEqual([(None, None)] * 2, results[1:])
+
+    def tearDown(self):
+        self.pool.close()
+        super(AsyncPoolTestCase, self).tearDown()
+
+
+class ProcessPoolTestCase(tornado.testing.AsyncTestCase):
+    def test_run(self):
+        pool = asyncpool.AsyncPool(workers=1, processes=True,
+            io_loop=self.io_loop)
+        try:
+            pool.run(os.getpid,
+                callback=lambda result, error: self.stop((result, error)))
+            pid, error = self.wait()
+        finally:
+            pool.close()
+        self.assertEqual(None, error)
+        self.assertNotEqual(os.getpid(), pid)
+
+    def test_unpicklable(self):
+        pool = asyncpool.AsyncPool(workers=1, processes=True,
+            io_loop=self.io_loop)
+        try:
+            pool.run(len, lambda: None,
+                callback=lambda result, error: self.stop((result, error)))
+            result, error = self.wait()
+        finally:
+            pool.close()
+        self.assertTrue(error is not None)
+        self.assertEqual(0, pool.pending)
+
+    def test_worker_died(self):
+        pool = asyncpool.AsyncPool(workers=1, processes=True, timeout=0.5,
+            io_loop=self.io_loop)
+        try:
+            pool.run(os._exit, 1,
+                callback=lambda result, error: self.stop((result, error)))
+            result, error = self.wait()
+        finally:
+            pool._pool.terminate()
+        self.assertTrue(isinstance(error, asyncpool.TaskTimeout))
+        self.assertEqual(0, pool.pending)
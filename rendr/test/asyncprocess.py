@@ -0,0 +1,87 @@
+import sys
+import tornado.testing
+from rendr import asyncprocess
+
+
+# Echoes each line back in upper case. "sleep" never gets a response, "die"
+# exits the process, and "err" writes to stderr before exiting.
+WORKER = [sys.executable, "-u", "-c", """
+import sys, time
+for line in iter(sys.stdin.readline, ""):
+    if line == "sleep\\n":
+        time.sleep(3600)
+    elif line == "die\\n":
+        sys.exit(1)
+    elif line == "err\\n":
+        sys.stderr.write("broken")
+        sys.exit(1)
+    sys.stdout.write(line.upper())
+"""]
+
+
+class AsyncProcessTestCase(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(AsyncProcessTestCase, self).setUp()
+        self.proc = asyncprocess.AsyncProcess(command=WORKER, timeout=1,
+            io_loop=self.io_loop, max_in_flight=4)
+        self.proc.start()
+
+    def submit_all(self, messages):
+        responses = {}
+        def callback(i, response, error):
+            responses[i] = (response, error)
+            if len(responses) == len(messages):
+                self.stop()
+
+        for i, message in enumerate(messages):
+            self.proc.submit(message,
+                lambda response, error, i=i: callback(i, response, error))
+        self.wait()
+        return [responses[i] for i in range(len(messages))]
+
+    def test_run_cmd(self):
+        asyncprocess.run_cmd(["echo", "hello"],
+            callback=lambda stdout, stderr: self.stop((stdout, stderr)),
+            io_loop=self.io_loop)
+        self.assertEqual(("hello\n", ""), self.wait())
+
+    def test_pipelined(self):
+        messages = ["message %d" % i for i in range(20)]
+        self.assertEqual([(m.upper(), None) for m in messages],
+            self.submit_all(messages))
+        self.assertEqual(20, self.proc.responses)
+
+    def test_large_message(self):
+        # Much bigger than the pipe buffer, so it's written in pieces
+        message = "x" * (2 * 1024 * 1024)
+        self.proc.timeout = 10
+        self.assertEqual([(message.upper(), None)],
+            self.submit_all([message]))
+
+    def test_queue_full(self):
+        self.proc.max_queue = 1
+        self.proc.max_in_flight = 1
+        responses = self.submit_all(["sleep", "a", "b"])
+        self.assertEqual((None, "queue full"), responses[2])
+
+    def test_timeout(self):
+        responses = self.submit_all(["sleep", "a"])
+        self.assertEqual([(None, "timed out after 1 seconds"), ("A", None)],
+            responses)
+        self.assertTrue(self.proc.is_running())
+
+    def test_respawn(self):
+        # "a" is in flight when the process dies, so it's re-issued; "die"
+        # fails once it's been retried max_retries times
+        responses = self.submit_all(["die", "a"])
+        self.assertEqual([(None, "process exited"), ("A", None)], responses)
+        self.assertTrue(self.proc.is_running())
+
+    def test_stderr(self):
+        responses = self.submit_all(["err", "a"])
+        self.assertEqual([(None, "process exited: broken")] * 2, responses)
+        self.assertFalse(self.proc.is_serving())
+
+    def tearDown(self):
+        self.proc.stop()
+        super(AsyncProcessTestCase, self).tearDown()
@@ -1,6 +1,13 @@
 import os
+import json
+import time
+import hashlib
+import urlparse
+import tornado.web
 import tornado.testing
+import tornado.httpclient
 from rendr import asyncs3
+from rendr import asyncpool
 from xml.dom import minidom
 
 class S3DBTestCase(tornado.testing.AsyncTestCase):
@@ -109,3 +116,382 @@ class S3DBTestCase(tornado.testing.AsyncTestCase):
     def tearDown(self):
         # TODO: delete everything in the it.rendr.test bucket
         super(S3DBTestCase, self).tearDown()
+
+
+class FakeResponse(object):
+    def __init__(self, code, body=None, etag=None):
+        self.code = code
+        self.body = body
+        self.headers = {"Etag": etag} if etag else {}
+
+
+class FakeS3DB(asyncs3.S3DB):
+    "S3DB with an in-memory bucket, which counts GETs"
+    def __init__(self, **kwargs):
+        super(FakeS3DB, self).__init__(**kwargs)
+        self.files = {}
+        self.gets = 0
+        self.before_put = None
+        self.failing_puts = set()
+
+    def _get_file(self, filename, query="", headers=None,
+            streaming_callback=None, callback=None):
+        self.gets += 1
+        if query:
+            self._list(query, streaming_callback, callback)
+            return
+
+        if filename not in self.files:
+            response = FakeResponse(404)
+        else:
+            body = self.files[filename]
+            etag = self.etag(filename)
+            if (headers or {}).get("If-None-Match") == etag:
+                response = FakeResponse(304)
+            else:
+                response = FakeResponse(200, body, etag)
+        self.io_loop.add_callback(lambda: callback(response))
+
+    def _list(self, query, streaming_callback, callback):
+        # Like S3: up to max-keys keys after the marker, streamed in small
+        # chunks
+        params = dict((k, v[0]) for k, v in
+            urlparse.parse_qs(query[1:]).items())
+        keys = sorted(k for k in self.files
+            if k.startswith(params["prefix"])
+            and k > params.get("marker", ""))
+        max_keys = int(params.get("max-keys", 1000))
+        body = "".join(["<ListBucketResult><IsTruncated>%s</IsTruncated>" % (
+            "true" if len(keys) > max_keys else "false")] +
+            ["<Contents><Key>%s</Key><LastModified>2013-02-05T06:55:23.000Z"
+                "</LastModified><ETag>%s</ETag><Size>%d</Size></Contents>" % (
+                k, self.etag(k), len(self.files[k]))
+                for k in keys[:max_keys]] +
+            ["</ListBucketResult>"])
+        for i in range(0, len(body), 16):
+            streaming_callback(body[i:i + 16])
+        self.io_loop.add_callback(lambda: callback(FakeResponse(200, "")))
+
+    def etag(self, filename):
+        return '"%s"' % hashlib.md5(self.files[filename]).hexdigest()
+
+    def _put_file(self, filename, content, headers=None, callback=None):
+        # Conditional PUTs, as S3 supports them
+        headers = headers or {}
+        if self.before_put:
+            self.before_put(filename)
+        if filename in self.failing_puts:
+            response = FakeResponse(500)
+        elif ("If-Match" in headers and (filename not in self.files or
+                    self.etag(filename) != headers["If-Match"])) or \
+                ("If-None-Match" in headers and filename in self.files):
+            response = FakeResponse(412)
+        else:
+            self.files[filename] = content
+            response = FakeResponse(200, "", self.etag(filename))
+        self.io_loop.add_callback(lambda: callback(response))
+
+    def _delete_file(self, filename, callback=None):
+        self.files.pop(filename, None)
+        self.io_loop.add_callback(lambda: callback(FakeResponse(204)))
+
+
+class DefinitionCacheTestCase(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(DefinitionCacheTestCase, self).setUp()
+        self.db = FakeS3DB(io_loop=self.io_loop, cache_ttl=60,
+            cache_stale=60)
+        self.db.files["lib/rendrs/r.json"] = '{"rendrId": "r"}'
+
+    def read(self):
+        self.db.read_rendr("lib", "r", self.stop)
+        return self.wait()
+
+    def age(self, seconds):
+        filename = "lib/rendrs/r.json"
+        entry = self.db.cache._entries[filename]
+        self.db.cache._entries[filename] = entry._replace(
+            fetched=entry.fetched - seconds)
+
+    def test_fresh(self):
+        self.assertEqual({"rendrId": "r"}, self.read())
+        self.assertEqual({"rendrId": "r"}, self.read())
+        self.assertEqual(1, self.db.gets)
+
+    def test_stale_while_revalidate(self):
+        self.read()
+        self.db.files["lib/rendrs/r.json"] = '{"rendrId": "r2"}'
+        self.age(90)
+
+        # The stale copy is served while the refresh happens
+        self.assertEqual({"rendrId": "r"}, self.read())
+        self.assertEqual(2, self.db.gets)
+        self.io_loop.add_timeout(time.time() + 0.01, self.stop)
+        self.wait()
+        self.assertEqual({"rendrId": "r2"}, self.read())
+        self.assertEqual(2, self.db.gets)
+
+    def test_revalidate_not_modified(self):
+        self.read()
+        self.age(150)
+        self.assertEqual({"rendrId": "r"}, self.read())
+        self.assertEqual(1, self.db.cache.stats["not_modified"])
+
+    def test_write_updates_cache(self):
+        self.read()
+        self.db.write_rendr("lib", "r", {"rendrId": "r3"}, self.stop)
+        self.wait()
+        gets = self.db.gets
+        self.assertEqual({"rendrId": "r3"}, self.read())
+        self.assertEqual(gets, self.db.gets)
+
+        # The cached copy revalidates against S3's ETag
+        self.age(150)
+        self.read()
+        self.assertEqual(1, self.db.cache.stats["not_modified"])
+
+    def test_revalidate(self):
+        self.read()
+        self.db.files["lib/rendrs/r.json"] = '{"rendrId": "r4"}'
+        self.assertEqual({"rendrId": "r"}, self.read())
+        self.db.read_rendr("lib", "r", revalidate=True, callback=self.stop)
+        self.assertEqual({"rendrId": "r4"}, self.wait())
+        self.assertEqual({"rendrId": "r4"}, self.read())
+
+    def test_missing(self):
+        self.db.read_rendr("lib", "missing", self.stop)
+        self.assertEqual({"error": 404}, self.wait())
+
+
+class ListingTestCase(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(ListingTestCase, self).setUp()
+        self.db = FakeS3DB(io_loop=self.io_loop)
+        self.ids = ["r%02d" % i for i in range(25)]
+        for rendr_id in self.ids:
+            self.db.files["lib/rendrs/%s.json" % rendr_id] = "{}"
+        self.db.files["lib/dist.json"] = "{}"
+        self.db.files["lib2/rendrs/other.json"] = "{}"
+
+    def test_paginated(self):
+        batches = []
+        self.db.iter_rendrs("lib", batches.append, max_keys=10,
+            callback=self.stop)
+        self.assertEqual(None, self.wait())
+        self.assertEqual(self.ids, sum(batches, []))
+        # Three pages, each streamed in several batches
+        self.assertEqual(3, self.db.gets)
+        self.assertTrue(len(batches) > 3)
+
+    def test_stop(self):
+        seen = []
+        def on_rendrs(rendr_ids):
+            seen.extend(rendr_ids)
+            return len(seen) < 5
+
+        self.db.iter_rendrs("lib", on_rendrs, max_keys=10,
+            callback=self.stop)
+        self.assertEqual(None, self.wait())
+        self.assertEqual(self.ids[:len(seen)], seen)
+        self.assertEqual(1, self.db.gets)
+
+    def test_list_rendrs(self):
+        self.db.list_rendrs("lib", self.stop)
+        self.assertEqual(self.ids, self.wait())
+
+    def test_parser(self):
+        objects = []
+        parser = asyncs3.ListBucketParser(objects.append)
+        body = ("<?xml version='1.0' encoding='UTF-8'?>"
+            "<ListBucketResult><Name>bucket</Name><IsTruncated>true"
+            "</IsTruncated><Contents><Key>a/b&amp;c</Key><Size>1</Size>"
+            "<LastModified>2013-02-05T06:55:23.000Z</LastModified>"
+            "<ETag>&quot;abc&quot;</ETag></Contents><Contents><Key>a/d</Key>"
+            "</Contents></ListBucketResult>")
+        for c in body:
+            parser.feed(c)
+        parser.close()
+        self.assertEqual([(u"a/b&c", 1, u'"abc"', 1360047323),
+            (u"a/d", 0, None, None)], objects)
+        self.assertTrue(parser.is_truncated)
+        self.assertEqual(u"a/d", parser.marker)
+
+
+
+class IndexTestCase(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(IndexTestCase, self).setUp()
+        self.db = FakeS3DB(io_loop=self.io_loop)
+
+    def write(self, rendr_id):
+        self.db.write_rendr("lib", rendr_id, {"rendrId": rendr_id},
+            self.stop)
+        return self.wait()
+
+    def index(self):
+        return json.loads(self.db.files["lib/index.json"])["rendrs"]
+
+    def test_write(self):
+        self.write("a")
+        self.write("b")
+        body = self.db.files["lib/rendrs/a.json"]
+        self.assertEqual(["a", "b"], sorted(self.index()))
+        self.assertEqual(hashlib.md5(body).hexdigest(),
+            self.index()["a"]["revision"])
+        self.assertEqual(len(body), self.index()["a"]["size"])
+
+        # Listing the library is a single GET of the index
+        self.db.cache.delete("lib/index.json")
+        gets = self.db.gets
+        self.db.list_rendrs("lib", self.stop)
+        self.assertEqual(["a", "b"], self.wait())
+        self.assertEqual(gets + 1, self.db.gets)
+
+    def test_conflict(self):
+        self.write("a")
+
+        # Another node adds "b" between our read and write of the index
+        def before_put(filename):
+            if filename == "lib/index.json":
+                self.db.before_put = None
+                index = json.loads(self.db.files[filename])
+                index["rendrs"]["b"] = {}
+                self.db.files[filename] = json.dumps(index)
+
+        self.db.before_put = before_put
+        self.write("c")
+        self.assertEqual(["a", "b", "c"], sorted(self.index()))
+        self.assertEqual(1, self.db.stats["index_conflicts"])
+
+    def test_index_failure(self):
+        self.write("a")
+        self.db.failing_puts.add("lib/index.json")
+
+        # The rendr is saved, and the out-of-date index is dropped
+        self.assertEqual({"rendrId": "b"}, self.write("b"))
+        self.assertTrue("lib/rendrs/b.json" in self.db.files)
+        self.assertFalse("lib/index.json" in self.db.files)
+        self.assertEqual(1, self.db.stats["index_failures"])
+        self.db.list_rendrs("lib", self.stop)
+        self.assertEqual(["a", "b"], self.wait())
+
+        # The next write rebuilds it
+        self.db.failing_puts.clear()
+        self.write("c")
+        self.assertEqual(["a", "b", "c"], sorted(self.index()))
+
+    def test_unindexed(self):
+        # Libraries written before the index are indexed from a listing
+        self.db.files["lib/rendrs/old.json"] = "{}"
+        self.write("new")
+        self.assertEqual(["new", "old"], sorted(self.index()))
+        self.assertEqual('"%s"' % self.index()["old"]["revision"],
+            self.db.etag("lib/rendrs/old.json"))
+
+    def test_rebuild(self):
+        self.write("a")
+        del self.db.files["lib/rendrs/a.json"]
+        self.db.files["lib/rendrs/b.json"] = "{}"
+        self.db.update_index("lib", rebuild=True, callback=self.stop)
+        self.assertEqual(["b"], sorted(self.wait()["rendrs"]))
+        self.assertEqual(["b"], sorted(self.index()))
+
+
+class KeyVerifierTestCase(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(KeyVerifierTestCase, self).setUp()
+        self.key_hash = asyncs3.pwd_context.encrypt("secret")
+
+    def verify(self, verifier, key):
+        verifier.verify("lib", key, self.key_hash,
+            lambda valid, error: self.stop((valid, error)))
+        return self.wait()
+
+    def check(self, verifier):
+        for key, valid in (("secret", True), ("secret", True),
+                ("wrong", False), ("wrong", False)):
+            self.assertEqual((valid, None), self.verify(verifier, key))
+
+        # Only successful verifications are remembered
+        self.assertEqual({"hits": 1, "misses": 3, "failures": 2},
+            verifier.stats)
+
+    def test_verify(self):
+        self.check(asyncs3.KeyVerifier())
+
+    def test_verify_in_pool(self):
+        pool = asyncpool.AsyncPool(workers=1, io_loop=self.io_loop)
+        try:
+            self.check(asyncs3.KeyVerifier(pool=pool))
+        finally:
+            pool.close()
+
+    def test_pool_full(self):
+        pool = asyncpool.AsyncPool(workers=1, max_queue=0,
+            io_loop=self.io_loop)
+        try:
+            pool.pending = 1
+            valid, error = self.verify(asyncs3.KeyVerifier(pool=pool),
+                "secret")
+        finally:
+            pool.pending = 0
+            pool.close()
+        # A busy pool isn't the same as a wrong key
+        self.assertFalse(valid)
+        self.assertTrue(isinstance(error, asyncpool.PoolFull))
+
+    def test_expiry(self):
+        verifier = asyncs3.KeyVerifier(ttl=0)
+        for _ in range(2):
+            self.assertEqual((True, None), self.verify(verifier, "secret"))
+        self.assertEqual(0, verifier.stats["hits"])
+
+
+class SlowHandler(tornado.web.RequestHandler):
+    def initialize(self, io_loop=None):
+        self.io_loop = io_loop
+
+    @tornado.web.asynchronous
+    def get(self):
+        self.io_loop.add_timeout(time.time() + 0.1, self.finish)
+
+
+class ObjectHandler(tornado.web.RequestHandler):
+    def get(self, key):
+        self.write({"key": key})
+
+
+class HTTPClientTestCase(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return tornado.web.Application([
+            (r"/", SlowHandler, {"io_loop": self.io_loop}),
+            (r"/bucket/(.*)", ObjectHandler)])
+
+    def test_endpoint(self):
+        db = asyncs3.S3DB(key_id="id", key="secret", bucket="bucket",
+            endpoint=self.get_url("/"), io_loop=self.io_loop)
+        db.read_rendr("lib", "rendr", self.stop)
+        self.assertEqual({"key": "lib/rendrs/rendr.json"}, self.wait())
+
+    def test_shared_client(self):
+        db = asyncs3.S3DB(io_loop=self.io_loop, max_clients=1)
+        requests = []
+        db.on_request = lambda *args: requests.append(args)
+        def callback(response):
+            if len(requests) == 2:
+                self.stop()
+
+        for _ in range(2):
+            db._fetch("get", tornado.httpclient.HTTPRequest(
+                self.get_url("/")), callback)
+        self.assertEqual({"active": 2, "queued": 1, "requests": 0,
+            "errors": 0, "index_conflicts": 0, "index_failures": 0},
+            db.stats)
+        self.wait()
+
+        self.assertEqual(["get", "get"], [r[0] for r in requests])
+        self.assertEqual([200, 200], [r[2] for r in requests])
+        # The second request waited for the first
+        self.assertTrue(requests[1][1] >= 0.2)
+        self.assertEqual(0, db.stats["active"])
+        self.assertEqual(2, db.stats["requests"])
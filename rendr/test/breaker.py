@@ -0,0 +1,79 @@
+import unittest
+from rendr import breaker
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.breaker = breaker.CircuitBreaker(failure_threshold=2,
+            open_time=60, probe_timeout=10, slots=16)
+        self.transitions = []
+        self.breaker.on_transition = \
+            lambda key, state: self.transitions.append(state)
+
+    def backdate(self, key, seconds):
+        state, failures, changed, probed = self.breaker._table.get(key)
+        self.breaker._table.put(key, (state, failures, changed - seconds,
+            probed - seconds))
+
+    def test_threshold(self):
+        self.breaker.failure("r")
+        self.assertTrue(self.breaker.allow("r"))
+        self.breaker.success("r")
+        self.breaker.failure("r")
+        self.assertEqual("closed", self.breaker.state("r"))
+
+        self.breaker.failure("r")
+        self.assertEqual("open", self.breaker.state("r"))
+        self.assertFalse(self.breaker.allow("r"))
+        self.assertTrue(59 < self.breaker.retry_after("r") <= 60)
+        self.assertEqual(["open"], self.transitions)
+
+    def test_half_open_probe(self):
+        self.breaker.failure("r")
+        self.breaker.failure("r")
+        self.backdate("r", 61)
+        self.assertEqual("half_open", self.breaker.state("r"))
+
+        # One probe at a time
+        self.assertTrue(self.breaker.allow("r"))
+        self.assertFalse(self.breaker.allow("r"))
+
+        # A failed probe opens the breaker again straight away
+        self.breaker.failure("r")
+        self.assertEqual("open", self.breaker.state("r"))
+
+        self.backdate("r", 61)
+        self.assertTrue(self.breaker.allow("r"))
+        self.breaker.success("r")
+        self.assertEqual("closed", self.breaker.state("r"))
+        self.assertEqual(["open", "half_open", "open", "half_open",
+            "closed"], self.transitions)
+
+    def test_probe_timeout(self):
+        self.breaker.failure("r")
+        self.breaker.failure("r")
+        self.backdate("r", 61)
+        self.assertTrue(self.breaker.allow("r"))
+
+        # The probe never reported back
+        self.backdate("r", 11)
+        self.assertTrue(self.breaker.allow("r"))
+
+    def test_release(self):
+        self.breaker.failure("r")
+        self.breaker.failure("r")
+        self.backdate("r", 61)
+        self.assertTrue(self.breaker.allow("r"))
+
+        # The probe didn't go ahead, so another may
+        self.breaker.release("r")
+        self.assertEqual("half_open", self.breaker.state("r"))
+        self.assertEqual(0, self.breaker.retry_after("r"))
+        self.assertTrue(self.breaker.allow("r"))
+
+    def test_ttl(self):
+        self.breaker.failure("r")
+        self.breaker.failure("r")
+        self.backdate("r", 3601)
+        self.assertEqual("closed", self.breaker.state("r"))
+        self.assertTrue(self.breaker.allow("r"))
@@ -0,0 +1,97 @@
+import shutil
+import tempfile
+import unittest
+from rendr import imagecache
+
+
+class MemoryCacheTestCase(unittest.TestCase):
+    def test_lru(self):
+        cache = imagecache.MemoryCache(max_bytes=10)
+        self.assertEqual(0, cache.put("a", "1234"))
+        self.assertEqual(0, cache.put("b", "1234"))
+        self.assertEqual("1234", cache.get("a"))
+
+        # "b" is least recently used, so it goes first
+        self.assertEqual(1, cache.put("c", "1234"))
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual("1234", cache.get("a"))
+        self.assertEqual(8, cache.size)
+
+    def test_oversized(self):
+        cache = imagecache.MemoryCache(max_bytes=10)
+        cache.put("a", "1234")
+        self.assertEqual(0, cache.put("b", "x" * 11))
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual("1234", cache.get("a"))
+
+
+class ImageCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def key(self, n):
+        return imagecache.cache_key("lib", "rendr", "rev", {"params": [n]},
+            "png")
+
+    def test_tiers(self):
+        cache = imagecache.ImageCache(memory_bytes=4, disk_path=self.path,
+            disk_bytes=8)
+        self.assertEqual((None, None), cache.get(self.key(1)))
+        cache.put(self.key(1), "1111")
+        self.assertEqual(("1111", "memory"), cache.get(self.key(1)))
+
+        # Pushed out of memory, but still on disk
+        cache.put(self.key(2), "2222")
+        self.assertEqual(("1111", "disk"), cache.get(self.key(1)))
+
+        # Pushed off disk as well
+        cache.put(self.key(3), "3333")
+        cache.put(self.key(4), "4444")
+        self.assertEqual((None, None), cache.get(self.key(2)))
+        self.assertEqual(2, cache.stats["misses"])
+
+    def test_disk_reload(self):
+        cache = imagecache.ImageCache(disk_path=self.path)
+        cache.put(self.key(1), "1111")
+
+        cache = imagecache.ImageCache(disk_path=self.path)
+        self.assertEqual(("1111", "disk"), cache.get(self.key(1)))
+        self.assertEqual(4, cache.disk.size)
+
+    def test_disk_shared(self):
+        # Two processes' caches over the same directory
+        first = imagecache.ImageCache(disk_path=self.path)
+        second = imagecache.ImageCache(disk_path=self.path)
+        first.put(self.key(1), "1111")
+        self.assertEqual(("1111", "disk"), second.get(self.key(1)))
+        self.assertEqual(4, second.disk.size)
+
+    def test_disk_shares(self):
+        # After a restart, the processes each load their own share of the
+        # directory, rather than all of it
+        cache = imagecache.ImageCache(disk_path=self.path)
+        for n in range(10):
+            cache.put(self.key(n), "1111")
+        shares = [imagecache.ImageCache(disk_path=self.path,
+            disk_share=(i, 2)) for i in range(2)]
+        self.assertEqual(40, sum(share.disk.size for share in shares))
+        self.assertTrue(all(share.disk.size < 40 for share in shares))
+
+    def test_delete_rendr(self):
+        other = imagecache.cache_key("lib", "other", "rev", {}, "png")
+        first = imagecache.ImageCache(disk_path=self.path)
+        second = imagecache.ImageCache(disk_path=self.path)
+        first.put(self.key(1), "1111")
+        first.put(other, "0000")
+        second.put(self.key(2), "2222")
+
+        # Entries written by another process go from disk too
+        self.assertEqual(3, first.delete_rendr("lib", "rendr"))
+        self.assertEqual((None, None), first.get(self.key(1)))
+        self.assertEqual((None, None), first.get(self.key(2)))
+        self.assertEqual(("0000", "memory"), first.get(other))
+        self.assertEqual(4, first.memory.size)
+        self.assertEqual(4, first.disk.size)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
@@ -0,0 +1,103 @@
+import cStringIO
+import unittest
+from PIL import Image
+from rendr import imaging
+
+
+def make_png(width=64, height=64):
+    """
+    Returns a PNG with red, black and transparent quarters.
+    """
+    img = Image.new("RGBA", (width, height), (0, 0, 0, 255))
+    img.paste((255, 0, 0, 255), (0, 0, width / 2, height / 2))
+    img.paste((0, 0, 0, 0), (width / 2, height / 2, width, height))
+    buf = cStringIO.StringIO()
+    img.save(buf, "png")
+    return buf.getvalue()
+
+
+class EncodeGIFTestCase(unittest.TestCase):
+    def decode(self, body):
+        img = Image.open(cStringIO.StringIO(body))
+        self.assertEqual("GIF", img.format)
+        return img.convert("RGBA")
+
+    def test_gif(self):
+        body, _, palette = imaging.encode_image(make_png(), "gif")
+        img = self.decode(body)
+        self.assertEqual((255, 0, 0, 255), img.getpixel((0, 0)))
+        self.assertEqual((0, 0, 0, 255), img.getpixel((40, 0)))
+        self.assertEqual(0, img.getpixel((40, 40))[3])
+        self.assertEqual(765, len(palette))
+
+    def test_reused_palette(self):
+        _, _, palette = imaging.encode_image(make_png(), "gif")
+        body, _, reused = imaging.encode_image(make_png(32, 32), "gif",
+            palette=palette)
+        self.assertEqual(palette, reused)
+        # Black pixels stay opaque, though the palette has a spare entry
+        img = self.decode(body)
+        self.assertEqual((0, 0, 0, 255), img.getpixel((20, 0)))
+        self.assertEqual(0, img.getpixel((20, 20))[3])
+
+    def test_other_formats(self):
+        body, _, palette = imaging.encode_image(make_png(), "jpg",
+            quality=50)
+        self.assertEqual("\xff\xd8", body[:2])
+        self.assertEqual(None, palette)
+
+
+class PaletteCacheTestCase(unittest.TestCase):
+    def test_lru(self):
+        palettes = imaging.PaletteCache(max_entries=2)
+        palettes.put("a", [1])
+        palettes.put("b", [2])
+        self.assertEqual([1], palettes.get("a"))
+        palettes.put("c", [3])
+        self.assertEqual(None, palettes.get("b"))
+        self.assertEqual([3], palettes.get("c"))
+        self.assertEqual({"hits": 2, "misses": 1}, palettes.stats)
+
+
+class EncodeImageTestCase(unittest.TestCase):
+    def test_png(self):
+        png = make_png()
+        # Served as rendered, unless asked to be re-encoded
+        self.assertEqual(png, imaging.encode_image(png, "png")[0])
+        body, _, _ = imaging.encode_image(png, "png",
+            options={"compress_level": 9, "colors": 4})
+        img = Image.open(cStringIO.StringIO(body))
+        self.assertEqual("P", img.mode)
+        self.assertEqual((0, 0, 0, 0),
+            img.convert("RGBA").getpixel((40, 40)))
+
+    def test_progressive_jpeg(self):
+        body, _, _ = imaging.encode_image(make_png(), "jpg", quality=70,
+            options={"progressive": True})
+        img = Image.open(cStringIO.StringIO(body))
+        self.assertTrue(img.info.get("progressive"))
+
+    def test_smallest(self):
+        png = make_png()
+        body, _, _ = imaging.encode_image(png, "png+webp", quality=70)
+        self.assertEqual("webp", imaging.image_format(body))
+        self.assertTrue(len(body) < len(png))
+        # A WebP in place of a PNG is lossless
+        self.assertEqual(
+            list(Image.open(cStringIO.StringIO(png)).getdata()),
+            list(Image.open(cStringIO.StringIO(body)).convert("RGBA")
+                .getdata()))
+
+        body, _, _ = imaging.encode_image(png, "jpg+webp", quality=70)
+        sizes = [len(imaging.encode_image(png, f, quality=70)[0])
+            for f in ("jpg", "webp")]
+        self.assertEqual(min(sizes), len(body))
+
+    def test_clip(self):
+        png = make_png()
+        # Regions hanging off the edge are cut short; those outside fail
+        body, _, _ = imaging.encode_image(png, "png", clip=[32, 48, 80, 80])
+        self.assertEqual((16, 32),
+            Image.open(cStringIO.StringIO(body)).size)
+        self.assertRaises(imaging.RegionError, imaging.encode_image, png,
+            "png", clip=[64, 0, 80, 10])
@@ -0,0 +1,127 @@
+import os
+import sys
+import tempfile
+import tornado.testing
+from rendr import rasterpool
+
+
+FAKE_RASTERIZE = [sys.executable,
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_rasterize")]
+
+
+class RasterizePoolTestCase(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(RasterizePoolTestCase, self).setUp()
+        self.pool = rasterpool.RasterizePool(command=FAKE_RASTERIZE, size=1,
+            max_queue=2, max_jobs=3, timeout=1, io_loop=self.io_loop)
+        self.pool.start()
+
+    def output_path(self):
+        fd, path = tempfile.mkstemp(suffix=".png")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_rasterize(self):
+        path = self.output_path()
+        self.pool.rasterize("http://127.0.0.1:8000/l/r.html", path,
+            callback=self.stop)
+        response = self.wait()
+        self.assertEqual("success: written image to " + path, response)
+        with open(path, "rb") as f:
+            self.assertEqual("\x89PNG", f.read(4))
+
+    def test_rasterize_pipe(self):
+        self.pool.rasterize("http://127.0.0.1:8000/l/r.html",
+            callback=self.stop)
+        self.assertEqual("\x89PNG", rasterpool.image_data(self.wait())[:4])
+        self.assertEqual(None, rasterpool.image_data("error: timed out"))
+        self.assertFalse(rasterpool.timed_out("error: process exited"))
+        self.assertTrue(rasterpool.timed_out(
+            "error: timed out after 10 seconds"))
+
+    def test_rasterize_html(self):
+        path = self.output_path()
+        self.pool.rasterize("http://127.0.0.1:8000/l/r.html", path,
+            html="<div>crash</div>", callback=self.stop)
+        self.assertEqual("error: process exited", self.wait())
+
+        self.pool.rasterize("http://127.0.0.1:8000/l/r.html", path,
+            html="<div>hello</div>", callback=self.stop)
+        self.assertEqual("success: written image to " + path, self.wait())
+
+    def test_rasterize_batch(self):
+        url = "http://127.0.0.1:8000/l/r.html"
+        self.pool.rasterize_batch([(url, "<div>a</div>"),
+            (url, "<div>broken</div>"), (url, "<div>b</div>")],
+            callback=self.stop)
+        responses = self.wait()
+        self.assertEqual("\x89PNG", rasterpool.image_data(responses[0])[:4])
+        self.assertEqual("error: couldn't open page", responses[1])
+        self.assertEqual(responses[0], responses[2])
+
+        # When the whole batch fails, every page fails with it
+        self.pool.rasterize_batch([(url, "<div>crash</div>"),
+            (url, "<div>a</div>")], callback=self.stop)
+        self.assertEqual(["error: process exited"] * 2, self.wait())
+
+    def test_rasterize_batch_to_files(self):
+        url = "http://127.0.0.1:8000/l/r.html"
+        paths = [self.output_path(), self.output_path()]
+        self.pool.rasterize_batch([(url, "<div>a</div>"),
+            (url, "<div>b</div>")], outputs=paths, callback=self.stop)
+        self.assertEqual(["success: written image to " + path
+            for path in paths], self.wait())
+        for path in paths:
+            with open(path, "rb") as f:
+                self.assertEqual("\x89PNG", f.read(4))
+
+    def test_worker_reuse_and_recycle(self):
+        pids = []
+        for _ in range(4):
+            self.pool.rasterize("http://127.0.0.1:8000/l/r.html",
+                self.output_path(), callback=self.stop)
+            pids.append(self.pool._workers[0].process.pid)
+            self.assertTrue(self.wait().startswith("success"))
+
+        # The same process serves max_jobs jobs, then is restarted
+        self.assertEqual(1, len(set(pids[:3])))
+        self.assertNotEqual(pids[0], pids[3])
+
+    def test_queue_full(self):
+        responses = []
+        def callback(response):
+            responses.append(response)
+            if len(responses) == 4:
+                self.stop()
+
+        # One job in flight and two queued; the fourth is rejected
+        for _ in range(4):
+            self.pool.rasterize("http://127.0.0.1:8000/l/r.html",
+                self.output_path(), callback=callback)
+        self.wait()
+        self.assertEqual("error: rasterizer queue full", responses[0])
+        self.assertTrue(all(r.startswith("success") for r in responses[1:]))
+
+    def test_timeout(self):
+        self.pool.rasterize("http://127.0.0.1:8000/hang.html",
+            self.output_path(), callback=self.stop)
+        self.assertEqual("error: timed out after 1 seconds", self.wait())
+
+        # The worker is replaced, and keeps serving jobs
+        self.pool.rasterize("http://127.0.0.1:8000/l/r.html",
+            self.output_path(), callback=self.stop)
+        self.assertTrue(self.wait().startswith("success"))
+
+    def test_crash(self):
+        self.pool.rasterize("http://127.0.0.1:8000/crash.html",
+            self.output_path(), callback=self.stop)
+        self.assertEqual("error: process exited", self.wait())
+
+        self.pool.rasterize("http://127.0.0.1:8000/l/r.html",
+            self.output_path(), callback=self.stop)
+        self.assertTrue(self.wait().startswith("success"))
+
+    def tearDown(self):
+        self.pool.stop()
+        super(RasterizePoolTestCase, self).tearDown()
@@ -0,0 +1,514 @@
+import os
+import json
+import time
+import email
+import cStringIO
+import tornado.testing
+import tornado.httpclient
+import rendr
+from PIL import Image
+from rendr import warmer
+from rendr import scratch
+from rendr import imaging
+from rendr import breaker
+from rendr import scheduler
+from rendr import asyncpool
+from rendr import imagecache
+from rendr import rasterpool
+from rendr.test.rasterpool import FAKE_RASTERIZE
+
+
+class FakeDB(object):
+    "In-memory stand-in for S3DB"
+    def __init__(self):
+        self.rendrs = {}
+        # Out-of-date cached copies, served unless revalidated
+        self.stale = {}
+        self.reads = 0
+
+    def read_rendr(self, library_id, rendr_id, callback=None,
+            revalidate=False):
+        self.reads += 1
+        if not revalidate and (library_id, rendr_id) in self.stale:
+            callback(self.stale[(library_id, rendr_id)])
+            return
+        callback(self.rendrs.get((library_id, rendr_id), {"error": 404}))
+
+    def write_rendr(self, library_id, rendr_id, rendr, callback=None):
+        self.rendrs[(library_id, rendr_id)] = rendr
+        callback(rendr)
+
+    def read_library(self, library_id, callback=None):
+        callback({"libraryId": library_id, "keyHash": "key"})
+
+    def verify_library_key(self, library_id, library, library_key,
+            callback=None):
+        # "busy" stands for a key the verifier had no room to check
+        if library_key == "busy":
+            callback(False, asyncpool.PoolFull())
+        else:
+            callback(library_key == library["keyHash"], None)
+
+
+class RendererTestCase(tornado.testing.AsyncHTTPTestCase):
+    transfer = "pipe"
+
+    def setUp(self):
+        self.db = FakeDB()
+        self.db.rendrs[("lib", "rendr")] = {
+            "rendrId": "rendr",
+            "libraryId": "lib",
+            "css": "div { color: {{color}}; }",
+            "body": "<div>{{#params}}{{.}}{{/params}}</div>"
+        }
+        # The fake rasterizer exits when it sees "crash" in the page
+        self.db.rendrs[("lib", "crash")] = {"rendrId": "crash",
+            "libraryId": "lib", "css": "", "body": "crash"}
+        # The fake rasterizer's images are 4x4
+        self.db.rendrs[("lib", "sliced")] = {"rendrId": "sliced",
+            "libraryId": "lib", "css": "", "body": "sliced",
+            "regions": {"top": [0, 0, 2, 4], "left": [0, 0, 4, 1],
+                "outside": [5, 5, 8, 8]}}
+        self.cache = imagecache.ImageCache()
+        self.breaker = breaker.CircuitBreaker(open_time=60, slots=16)
+        self.palettes = imaging.PaletteCache()
+        super(RendererTestCase, self).setUp()
+
+    def get_app(self):
+        self.rasterizers = rasterpool.RasterizePool(
+            command=FAKE_RASTERIZE + ["--delay", "0.1"], size=1,
+            io_loop=self.io_loop)
+        self.rasterizers.start()
+        self.encoder = asyncpool.AsyncPool(workers=1, io_loop=self.io_loop)
+        self.scratch = scratch.ScratchDir(io_loop=self.io_loop)
+        self.scheduler = scheduler.RenderScheduler(concurrency=1,
+            max_queue=0, io_loop=self.io_loop)
+        self.warmer = warmer.CacheWarmer(self.get_http_port(), max_clients=1,
+            io_loop=self.io_loop)
+        self.renderer_args = {"db": self.db, "timeout": 2,
+            "port": self.get_http_port(), "rasterizers": self.rasterizers,
+            "cache": self.cache, "encoder": self.encoder,
+            "transfer": self.transfer, "scratch": self.scratch,
+            "scheduler": self.scheduler, "breaker": self.breaker,
+            "palettes": self.palettes,
+            "static_subdomains": ("about", "static")}
+        return rendr.CollectdLoggingApplication([
+            (r"/rendr/([^./]+)/([^./]+)", rendr.RendrManager,
+                {"db": self.db, "cache": self.cache, "warmer": self.warmer}),
+            (r"/batch/([^./]+)/([^./]+)\.(gif|png|jpg|webp)",
+                rendr.BatchRenderer,
+                {"db": self.db, "timeout": 2, "port": self.get_http_port(),
+                "rasterizers": self.rasterizers, "cache": self.cache,
+                "encoder": self.encoder, "transfer": self.transfer,
+                "scratch": self.scratch, "scheduler": self.scheduler,
+                "breaker": self.breaker, "batch_size": 2, "max_batch": 5}),
+            (r"/.*\.(gif|png|jpg|webp|html|json)", rendr.Renderer,
+                self.renderer_args),
+        ])
+
+    def test_png(self):
+        response = self.fetch("/lib/rendr/hello.png")
+        self.assertEqual(200, response.code)
+        self.assertEqual("image/png", response.headers["Content-Type"])
+        self.assertEqual("\x89PNG", response.body[:4])
+
+        # The page was handed to the rasterizer, not fetched back over HTTP
+        self.assertEqual(1, self.db.reads)
+
+        # The second request is served from the cache
+        self.assertEqual(response.body, self.fetch("/lib/rendr/hello.png").body)
+        self.assertEqual(1, self.cache.stats["memory_hits"])
+
+    def test_jpg(self):
+        response = self.fetch("/lib/rendr/hello.jpg?q=50")
+        self.assertEqual(200, response.code)
+        self.assertEqual("image/jpeg", response.headers["Content-Type"])
+        self.assertEqual("\xff\xd8", response.body[:2])
+
+    def test_gif(self):
+        response = self.fetch("/lib/rendr/hello.gif")
+        self.assertEqual(200, response.code)
+        self.assertEqual("image/gif", response.headers["Content-Type"])
+        self.assertEqual("GIF89a", response.body[:6])
+
+        # Later GIFs of the same revision reuse the first one's palette
+        self.assertEqual(200, self.fetch("/lib/rendr/bye.gif").code)
+        self.assertEqual({"hits": 1, "misses": 1}, self.palettes.stats)
+
+        # ...so their bytes depend on encoding order, and their ETags are
+        # weak
+        etag = response.headers["Etag"]
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertEqual(304, self.fetch("/lib/rendr/hello.gif",
+            headers={"If-None-Match": etag}).code)
+
+    def test_webp(self):
+        response = self.fetch("/lib/rendr/hello.webp?q=50")
+        self.assertEqual(200, response.code)
+        self.assertEqual("image/webp", response.headers["Content-Type"])
+        self.assertEqual("WEBP", response.body[8:12])
+
+    def test_png_options(self):
+        plain = self.fetch("/lib/rendr/hello.png").body
+        response = self.fetch("/lib/rendr/hello.png?zlib=9&colors=16")
+        self.assertEqual(200, response.code)
+        self.assertNotEqual(plain, response.body)
+        self.assertEqual("P",
+            Image.open(cStringIO.StringIO(response.body)).mode)
+
+        # Server-wide, PNGs are re-encoded too
+        self.renderer_args["png_compress_level"] = 0
+        self.assertNotEqual(plain, self.fetch("/lib/rendr/hello.png").body)
+
+    def test_negotiate(self):
+        self.renderer_args["negotiate"] = True
+        accept = {"Accept": "image/webp,image/*,*/*;q=0.8"}
+        response = self.fetch("/lib/rendr/hello.png", headers=accept)
+        self.assertEqual(200, response.code)
+        self.assertEqual("Accept", response.headers["Vary"])
+        # Whichever is smaller; the fake rasterizer's tiny image is smaller
+        # as a PNG
+        self.assertEqual(imaging.MIME_TYPES[imaging.image_format(
+            response.body)], response.headers["Content-Type"])
+        etag = response.headers["Etag"]
+
+        # Clients which don't accept WebP get what they asked for, from a
+        # different cache entry
+        response = self.fetch("/lib/rendr/hello.png")
+        self.assertEqual("image/png", response.headers["Content-Type"])
+        self.assertEqual("Accept", response.headers["Vary"])
+        self.assertNotEqual(etag, response.headers["Etag"])
+        self.assertEqual(0, self.cache.stats["memory_hits"])
+
+    def test_html(self):
+        response = self.fetch("/lib/rendr/hello.html?color=red")
+        self.assertEqual(200, response.code)
+        self.assertTrue("<div>hello</div>" in response.body)
+        self.assertTrue("div { color: red; }" in response.body)
+
+    def test_not_modified(self):
+        response = self.fetch("/lib/rendr/hello.png")
+        etag = response.headers["Etag"]
+        self.assertEqual(etag, self.fetch("/lib/rendr/hello.png").headers[
+            "Etag"])
+
+        # The client's copy is current: nothing is rendered or sent
+        started = rendr.Renderer._in_flight.stats["started"]
+        hits = self.cache.stats["memory_hits"]
+        for inm in (etag, '"other", W/' + etag, "*"):
+            response = self.fetch("/lib/rendr/hello.png",
+                headers={"If-None-Match": inm})
+            self.assertEqual(304, response.code)
+            self.assertEqual(etag, response.headers["Etag"])
+            self.assertTrue("Cache-Control" in response.headers)
+        self.assertEqual(started, rendr.Renderer._in_flight.stats["started"])
+        self.assertEqual(hits, self.cache.stats["memory_hits"])
+
+        # Different parameters, formats or revisions are different images
+        for path in ("/lib/rendr/bye.png", "/lib/rendr/hello.gif"):
+            response = self.fetch(path, headers={"If-None-Match": etag})
+            self.assertEqual(200, response.code)
+            self.assertNotEqual(etag, response.headers["Etag"])
+        self.db.rendrs[("lib", "rendr")]["body"] = "<p>{{params}}</p>"
+        response = self.fetch("/lib/rendr/hello.png",
+            headers={"If-None-Match": etag})
+        self.assertEqual(200, response.code)
+
+    def test_not_modified_json(self):
+        for path in ("/lib/rendr/hello.json", "/lib/rendr/hello.html"):
+            etag = self.fetch(path).headers["Etag"]
+            response = self.fetch(path, headers={"If-None-Match": etag})
+            self.assertEqual(304, response.code)
+
+        # The JSON is the same whatever the parameters
+        etag = self.fetch("/lib/rendr/hello.json").headers["Etag"]
+        self.assertEqual(304, self.fetch("/lib/rendr/bye.json",
+            headers={"If-None-Match": etag}).code)
+        self.assertEqual(200, self.fetch("/lib/rendr/bye.html",
+            headers={"If-None-Match": etag}).code)
+
+    def fetch_concurrently(self, path, count):
+        return self.fetch_all([path] * count)
+
+    def fetch_all(self, paths):
+        responses = {}
+        def callback(i, response):
+            responses[i] = response
+            if len(responses) == len(paths):
+                self.stop()
+
+        client = tornado.httpclient.AsyncHTTPClient(self.io_loop)
+        for i, path in enumerate(paths):
+            client.fetch(self.get_url(path),
+                lambda response, i=i: callback(i, response))
+        self.wait(timeout=10)
+        return [responses[i] for i in range(len(paths))]
+
+    def test_coalesced(self):
+        stats = dict(rendr.Renderer._in_flight.stats)
+        responses = self.fetch_concurrently("/lib/rendr/together.png", 3)
+        self.assertEqual([200] * 3, [r.code for r in responses])
+        self.assertEqual(1, len(set(r.body for r in responses)))
+        self.assertEqual(stats["started"] + 1,
+            rendr.Renderer._in_flight.stats["started"])
+        self.assertEqual(stats["coalesced"] + 2,
+            rendr.Renderer._in_flight.stats["coalesced"])
+
+    def test_coalesced_failure(self):
+        stats = dict(rendr.Renderer._in_flight.stats)
+        responses = self.fetch_concurrently("/lib/crash/together.png", 3)
+        self.assertEqual([504] * 3, [r.code for r in responses])
+        self.assertEqual(stats["started"] + 1,
+            rendr.Renderer._in_flight.stats["started"])
+
+    def wait_for_render(self):
+        def check():
+            if not self.scheduler.running:
+                self.io_loop.add_timeout(time.time() + 0.01, check)
+            else:
+                self.stop()
+        check()
+        self.wait()
+
+    def test_priority_from_client(self):
+        # Clients can't ask for background renders
+        client = tornado.httpclient.AsyncHTTPClient(self.io_loop)
+        client.fetch(self.get_url("/lib/rendr/hello.png"), self.stop,
+            headers={warmer.PRIORITY_HEADER: "background"})
+        self.wait_for_render()
+        self.assertEqual(0, self.scheduler._background_running)
+        self.assertEqual(200, self.wait().code)
+
+    def test_foreground_during_warm(self):
+        # A request doesn't join a background render of the same image,
+        # but renders it at its own priority
+        self.scheduler.max_queue = 1
+        self.scheduler.render_time = 0.1
+        stats = dict(rendr.Renderer._in_flight.stats)
+        self.warmer.warm(["/lib/rendr/together.png"])
+        self.wait_for_render()
+        self.assertEqual(200, self.fetch("/lib/rendr/together.png").code)
+        self.assertEqual(stats["started"] + 2,
+            rendr.Renderer._in_flight.stats["started"])
+
+    def test_render_rejected(self):
+        # Only one render at a time, and none may wait for a turn
+        responses = self.fetch_all(["/lib/rendr/first.png",
+            "/lib/rendr/second.png"])
+        self.assertEqual([200, 503], [r.code for r in responses])
+        self.assertEqual("1", responses[1].headers["Retry-After"])
+
+    def test_shed_load(self):
+        # With no room in the rasterizers' queue, renders are refused
+        self.rasterizers.max_queue = 0
+        response = self.fetch("/lib/rendr/hello.png")
+        self.assertEqual(503, response.code)
+        self.assertEqual("1", response.headers["Retry-After"])
+
+        code, parts = self.post_batch("/batch/lib/rendr.png",
+            [{"params": ["a"]}])
+        self.assertEqual(["503"], [p["X-Status"] for p in parts])
+        self.assertEqual(["1"], [p["Retry-After"] for p in parts])
+
+    def test_breaker_open(self):
+        self.breaker.failure(("lib", "rendr"))
+        response = self.fetch("/lib/rendr/hello.png")
+        self.assertEqual(503, response.code)
+        self.assertTrue(59 <= int(response.headers["Retry-After"]) <= 60)
+
+    def half_open(self, key):
+        self.breaker.failure(key)
+        state, failures, changed, probed = self.breaker._table.get(key)
+        self.breaker._table.put(key, (state, failures, changed - 61,
+            probed))
+
+    def test_breaker_probe_error(self):
+        # A probe failing other than by timing out closes the breaker
+        self.half_open(("lib", "rendr"))
+        self.assertEqual(504, self.fetch("/lib/rendr/broken.png").code)
+        self.assertEqual("closed", self.breaker.state(("lib", "rendr")))
+
+    def test_breaker_crash(self):
+        # A crash is retried after a pause, which can take as long as a
+        # timeout, but isn't one, so doesn't count towards tripping the
+        # breaker
+        self.half_open(("lib", "crash"))
+        self.assertEqual(504, self.fetch("/lib/crash/hello.png").code)
+        self.assertEqual("closed", self.breaker.state(("lib", "crash")))
+
+    def test_breaker_probe_shed(self):
+        # A probe turned away lets the next request probe
+        self.half_open(("lib", "rendr"))
+        self.rasterizers.max_queue = 0
+        self.assertEqual(503, self.fetch("/lib/rendr/hello.png").code)
+        self.rasterizers.max_queue = 100
+        self.assertEqual(200, self.fetch("/lib/rendr/hello.png").code)
+        self.assertEqual("closed", self.breaker.state(("lib", "rendr")))
+
+    def test_missing(self):
+        self.assertEqual(404, self.fetch("/lib/missing/hello.png").code)
+        self.assertEqual(404, self.fetch("/lib/missing/hello.json").code)
+
+    def test_regions(self):
+        started = rendr.Renderer._in_flight.stats["started"]
+        sizes = []
+        for region in ("top", "left"):
+            response = self.fetch("/lib/sliced/hello.png?region=" + region)
+            self.assertEqual(200, response.code)
+            sizes.append(Image.open(cStringIO.StringIO(response.body)).size)
+        self.assertEqual([(4, 2), (1, 4)], sizes)
+
+        response = self.fetch("/lib/sliced/hello.jpg?region=top")
+        self.assertEqual("\xff\xd8", response.body[:2])
+
+        # The page was rendered once, for the first region; the rest were
+        # cropped from the cached image
+        self.assertEqual(started + 1,
+            rendr.Renderer._in_flight.stats["started"])
+
+        self.assertEqual(404,
+            self.fetch("/lib/sliced/hello.png?region=missing").code)
+        self.assertEqual(400,
+            self.fetch("/lib/sliced/hello.png?region=outside").code)
+
+    def save(self, key):
+        return self.fetch("/rendr/lib/rendr", method="PUT",
+            body=json.dumps({"libraryKey": key, "css": "",
+                "body": "<div>new</div>", "testPath": "test",
+                "testParams": ""}))
+
+    def test_save_key_unchecked(self):
+        # A key the verifier was too busy to check is retried, not refused
+        response = self.save("busy")
+        self.assertEqual(503, response.code)
+        self.assertEqual("1", response.headers["Retry-After"])
+        self.assertEqual(403, self.save("wrong").code)
+
+    def test_save_warms_cache(self):
+        self.assertEqual(200, self.fetch("/lib/rendr/hello.png").code)
+        response = self.fetch("/rendr/lib/rendr", method="PUT",
+            body=json.dumps({"libraryKey": "key", "css": "",
+                "body": "<div>new</div>", "testPath": "test",
+                "testParams": "color=blue", "warmPaths": ["hot.jpg?q=50"]}))
+        self.assertEqual(200, response.code)
+
+        # The old revision's image is gone, and the new test image and hot
+        # path are rendered in the background
+        self.assertEqual(1, self.cache.stats["invalidations"])
+        def check():
+            if self.warmer.stats["warmed"] + self.warmer.stats["failed"] < 2:
+                self.io_loop.add_timeout(time.time() + 0.05, check)
+            else:
+                self.stop()
+        check()
+        self.wait()
+        self.assertEqual(2, self.warmer.stats["warmed"])
+
+        self.fetch("/lib/rendr/test.png?color=blue")
+        self.fetch("/lib/rendr/hot.jpg?q=50")
+        self.assertEqual(2, self.cache.stats["memory_hits"])
+
+    def test_warm_stale_definition(self):
+        # Another process saved the rendr; this one has the old revision
+        current = self.db.rendrs[("lib", "rendr")]
+        self.db.stale[("lib", "rendr")] = dict(current, body="old")
+        self.warmer.warm(["/lib/rendr/hello.png"], self.stop,
+            revision=rendr.rendr_revision(current))
+        self.assertEqual(0, self.wait())
+
+        # The current revision's image was rendered
+        del self.db.stale[("lib", "rendr")]
+        self.assertEqual(200, self.fetch("/lib/rendr/hello.png").code)
+        self.assertEqual(1, self.cache.stats["memory_hits"])
+
+    def test_revision_from_client(self):
+        # Only the warmer may make the server go back to S3
+        current = self.db.rendrs[("lib", "rendr")]
+        self.db.stale[("lib", "rendr")] = dict(current, body="old")
+        self.fetch("/lib/rendr/hello.png", headers={
+            warmer.REVISION_HEADER: rendr.rendr_revision(current)})
+        self.assertEqual(1, self.db.reads)
+
+    def post_batch(self, path, sets):
+        response = self.fetch(path, method="POST",
+            body=json.dumps({"params": sets}))
+        if response.code != 200:
+            return response.code, None
+        message = email.message_from_string("Content-Type: %s\r\n\r\n%s" % (
+            response.headers["Content-Type"], response.body))
+        return response.code, message.get_payload()
+
+    def test_batch(self):
+        code, parts = self.post_batch("/batch/lib/rendr.png", [
+            {"params": ["a"]}, {"params": ["broken"]},
+            {"params": ["c", "d"], "color": "red"}])
+        self.assertEqual(200, code)
+        self.assertEqual(["<0>", "<1>", "<2>"],
+            [p["Content-ID"] for p in parts])
+        self.assertEqual(["200", "504", "200"],
+            [p["X-Status"] for p in parts])
+        self.assertEqual("/lib/rendr/c/d.png?color=red",
+            parts[2]["Content-Location"])
+        self.assertEqual("image/png", parts[0]["Content-Type"])
+        self.assertEqual("\x89PNG", parts[0].get_payload()[:4])
+        self.assertEqual(1, self.db.reads)
+
+        # The images are cached just as if they'd been rendered one by one
+        response = self.fetch("/lib/rendr/c/d.png?color=red")
+        self.assertEqual(parts[2].get_payload(), response.body)
+        self.assertEqual(1, self.cache.stats["memory_hits"])
+
+    def test_batch_regions(self):
+        started = rendr.Renderer._in_flight.stats["started"]
+        code, parts = self.post_batch("/batch/lib/sliced.png", [
+            {"params": ["a"], "region": "top"},
+            {"params": ["a"], "region": "left"},
+            {"params": ["a"], "region": "missing"},
+            {"params": ["a"], "region": "outside"}])
+        self.assertEqual(["200", "200", "404", "400"],
+            [p["X-Status"] for p in parts])
+        self.assertEqual("/lib/sliced/a.png?region=top",
+            parts[0]["Content-Location"])
+        self.assertEqual([(4, 2), (1, 4)], [Image.open(cStringIO.StringIO(
+            p.get_payload())).size for p in parts[:2]])
+
+        # The whole image was rendered once, and cached for GETs of other
+        # regions to crop
+        response = self.fetch("/lib/sliced/a.png?region=left")
+        self.assertEqual(parts[1].get_payload(), response.body)
+        response = self.fetch("/lib/sliced/a.jpg?region=top")
+        self.assertEqual(200, response.code)
+        self.assertEqual(started, rendr.Renderer._in_flight.stats["started"])
+
+    def test_batch_invalid(self):
+        self.assertEqual(400, self.post_batch("/batch/lib/rendr.png",
+            [{"params": ["a"]}] * 6)[0])
+        self.assertEqual(400, self.post_batch("/batch/lib/rendr.png",
+            [{"color": 1}])[0])
+        self.assertEqual(404, self.post_batch("/batch/lib/missing.png",
+            [{}])[0])
+
+    def tearDown(self):
+        self.warmer.http_client.close()
+        self.rasterizers.stop()
+        self.encoder.close()
+        self.scratch.close()
+        super(RendererTestCase, self).tearDown()
+
+
+class FileTransferRendererTestCase(RendererTestCase):
+    transfer = "file"
+
+    def test_scratch_files_removed(self):
+        self.assertEqual(200, self.fetch("/lib/rendr/hello.png").code)
+        self.assertEqual(504, self.fetch("/lib/crash/hello.png").code)
+        self.assertEqual(2, self.scratch.stats["removed"])
+        self.assertEqual([], os.listdir(self.scratch.path))
+
+    def test_batch_scratch_files_removed(self):
+        code, parts = self.post_batch("/batch/lib/rendr.png", [
+            {"params": ["a"]}, {"params": ["broken"]}])
+        self.assertEqual(["200", "504"], [p["X-Status"] for p in parts])
+        self.assertEqual(2, self.scratch.stats["created"])
+        self.assertEqual(2, self.scratch.stats["removed"])
+        self.assertEqual([], os.listdir(self.scratch.path))
@@ -0,0 +1,199 @@
+import time
+import tornado.testing
+from rendr import scheduler
+
+
+class RenderSchedulerTestCase(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(RenderSchedulerTestCase, self).setUp()
+        self.scheduler = scheduler.RenderScheduler(concurrency=1,
+            max_queue=1, io_loop=self.io_loop)
+        self.results = []
+
+    def acquire(self, deadline, library_id="lib"):
+        self.scheduler.acquire(library_id, time.time() + deadline,
+            lambda ticket, error: self.results.append((ticket, error)))
+
+    def spin(self):
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+
+    def test_queued(self):
+        self.acquire(10)
+        self.acquire(10)
+        self.spin()
+        self.assertEqual(1, len(self.results))
+        self.assertEqual(1, self.scheduler.queue_length())
+
+        # The queued render starts once the first is done
+        self.scheduler.release(self.results[0][0])
+        self.spin()
+        ticket, error = self.results[1]
+        self.assertEqual(None, error)
+        self.assertEqual("lib", ticket.library_id)
+        self.assertEqual(1, self.scheduler.running)
+
+    def test_batch_render_time(self):
+        # A batch's time is averaged over its pages
+        self.acquire(10)
+        self.spin()
+        ticket, error = self.results[0]
+        self.scheduler.release(ticket._replace(started=time.time() - 5.0),
+            pages=5)
+        self.assertTrue(0.99 < self.scheduler.render_time < 1.01)
+
+    def test_queue_full(self):
+        # One render running and one queued; the third is turned away,
+        # and told to retry once both are expected to be done
+        for _ in range(3):
+            self.acquire(10)
+        ticket, error = self.results[0]
+        self.assertTrue(isinstance(error, scheduler.RenderRejected))
+        self.assertEqual("render queue full", str(error))
+        self.assertEqual(2, error.retry_after)
+
+    def test_too_late(self):
+        # Renders are expected to take a second, so a render waiting for
+        # another can't start within half a second
+        self.acquire(10)
+        self.acquire(0.5)
+        ticket, error = self.results[0]
+        self.assertEqual("render would start too late", str(error))
+        self.assertEqual(0, self.scheduler.queue_length())
+
+    def test_expired(self):
+        self.scheduler.render_time = 0.01
+        self.acquire(10)
+        self.scheduler.acquire("lib", time.time() + 0.1,
+            lambda ticket, error: self.stop((ticket, error)))
+        ticket, error = self.wait()
+        self.assertEqual("render deadline passed", str(error))
+        self.assertEqual(1, self.scheduler.stats["expired"])
+        self.assertEqual(0, self.scheduler.queue_length())
+
+
+class FairSchedulingTestCase(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(FairSchedulingTestCase, self).setUp()
+        self.started = []
+
+    def run_all(self, sched, library_ids):
+        """
+        Queues a render for each library ID, and returns the order they
+        were started in, releasing each as soon as it starts.
+        """
+        def callback(ticket, error):
+            self.assertEqual(None, error)
+            self.started.append(ticket.library_id)
+            sched.release(ticket)
+            if len(self.started) == len(library_ids):
+                self.stop()
+
+        for library_id in library_ids:
+            sched.acquire(library_id, time.time() + 60, callback)
+        self.wait()
+        return self.started
+
+    def test_round_robin(self):
+        sched = scheduler.RenderScheduler(concurrency=1,
+            io_loop=self.io_loop)
+        sched.render_time = 0.01
+        # "big" queues a burst before "small" asks for anything
+        order = self.run_all(sched, ["big"] * 4 + ["small"] * 2)
+        self.assertEqual(["big", "big", "small", "big", "small", "big"],
+            order)
+
+    def test_weights(self):
+        sched = scheduler.RenderScheduler(concurrency=1,
+            weights={"heavy": 2}, io_loop=self.io_loop)
+        sched.render_time = 0.01
+        order = self.run_all(sched, ["light"] * 3 + ["heavy"] * 4)
+        self.assertEqual(["light", "light", "heavy", "heavy", "light",
+            "heavy", "heavy"], order)
+
+    def test_invalid_weights(self):
+        for weight in (0, -1):
+            self.assertRaises(ValueError, scheduler.RenderScheduler,
+                weights={"a": weight}, io_loop=self.io_loop)
+
+    def test_library_concurrency(self):
+        sched = scheduler.RenderScheduler(concurrency=4,
+            library_concurrency=1, io_loop=self.io_loop)
+        tickets = []
+        for library_id in ("a", "a", "b"):
+            sched.acquire(library_id, time.time() + 60,
+                lambda ticket, error: tickets.append(ticket))
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        self.assertEqual(["a", "b"], [t.library_id for t in tickets])
+        self.assertEqual(1, sched.queue_length("a"))
+
+    def test_library_rate(self):
+        sched = scheduler.RenderScheduler(concurrency=4, library_rate=20,
+            library_burst=1, io_loop=self.io_loop)
+        t = time.time()
+        self.run_all(sched, ["a"] * 3)
+        # The first starts straight away, then one every 50ms
+        self.assertTrue(time.time() - t >= 0.09)
+
+    def test_background(self):
+        sched = scheduler.RenderScheduler(concurrency=1,
+            io_loop=self.io_loop)
+        sched.render_time = 0.01
+        started = []
+        def acquire(library_id, background=False):
+            def callback(ticket, error):
+                started.append((library_id, ticket.background))
+                sched.release(ticket)
+                if len(started) == 4:
+                    self.stop()
+            sched.acquire(library_id, time.time() + 60, callback,
+                background=background)
+
+        # The background render waits until nothing else is waiting
+        acquire("a")
+        acquire("warm", background=True)
+        acquire("b")
+        acquire("c")
+        self.wait()
+        self.assertEqual([("a", False), ("b", False), ("c", False),
+            ("warm", True)], started)
+
+    def test_background_concurrency(self):
+        sched = scheduler.RenderScheduler(concurrency=4,
+            io_loop=self.io_loop)
+        tickets = []
+        for _ in range(3):
+            sched.acquire("warm", time.time() + 60,
+                lambda ticket, error: tickets.append(ticket),
+                background=True)
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        # Half the renders may run in the background, leaving room for
+        # requests
+        self.assertEqual(2, len(tickets))
+        sched.release(tickets[0])
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        self.assertEqual(3, len(tickets))
+
+    def test_background_rate_limited(self):
+        sched = scheduler.RenderScheduler(concurrency=4, library_rate=50,
+            library_burst=1, io_loop=self.io_loop)
+        done = []
+
+        def callback(ticket, error):
+            done.append(error)
+            if ticket:
+                sched.release(ticket)
+            if len(done) == 5:
+                self.stop()
+
+        # Renders held back by the rate limit start when it allows
+        for _ in range(5):
+            sched.acquire("warm", time.time() + 60, callback,
+                background=True)
+        self.wait()
+        self.assertEqual([None] * 5, done)
+        self.assertEqual(0, sched.running)
+        self.assertEqual(0, sched._background_running)
@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+from rendr import scratch
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+class ScratchDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.scratch = scratch.ScratchDir(max_age=60)
+
+    def test_mkstemp_and_remove(self):
+        path = self.scratch.mkstemp(suffix=".png")
+        self.assertEqual(self.scratch.path, os.path.dirname(path))
+        self.scratch.remove(path)
+        self.scratch.remove(path)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(1, self.scratch.stats["removed"])
+
+    def test_sweep(self):
+        old = self.scratch.mkstemp()
+        new = self.scratch.mkstemp()
+        then = time.time() - 120
+        os.utime(old, (then, then))
+
+        self.assertEqual(1, self.scratch.sweep())
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+        self.assertEqual(1, self.scratch.stats["swept"])
+
+    def test_close(self):
+        self.scratch.mkstemp()
+        self.scratch.close()
+        self.assertFalse(os.path.exists(self.scratch.path))
+
+    def test_removed_on_exit(self):
+        parent = tempfile.mkdtemp()
+        try:
+            subprocess.check_call([sys.executable, "-c",
+                "from rendr import scratch; "
+                "scratch.ScratchDir(path=%r).mkstemp()" % parent],
+                env=dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT] +
+                    filter(None, [os.getenv("PYTHONPATH")]))))
+            self.assertEqual([], os.listdir(parent))
+        finally:
+            shutil.rmtree(parent)
+
+    def tearDown(self):
+        self.scratch.close()
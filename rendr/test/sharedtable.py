@@ -0,0 +1,33 @@
+import os
+import unittest
+from rendr import sharedtable
+
+
+class SharedTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.table = sharedtable.SharedTable("dI", slots=8, probe=2)
+
+    def test_put_get(self):
+        self.assertEqual(None, self.table.get(("lib", "rendr")))
+        self.table.put(("lib", "rendr"), (1.5, 3))
+        self.assertEqual((1.5, 3), self.table.get(("lib", "rendr")))
+        self.table.put(("lib", "rendr"), (2.5, 4))
+        self.assertEqual((2.5, 4), self.table.get(("lib", "rendr")))
+
+        self.table.delete(("lib", "rendr"))
+        self.assertEqual((0, 0), self.table.get(("lib", "rendr"), (0, 0)))
+
+    def test_bounded(self):
+        for i in range(100):
+            self.table.put(i, (i, i))
+        self.assertEqual((99, 99), self.table.get(99))
+        self.assertTrue(sum(self.table.get(i) is not None
+            for i in range(100)) <= 8)
+
+    def test_shared_with_child(self):
+        pid = os.fork()
+        if not pid:
+            self.table.put("child", (1.0, 1))
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual((1.0, 1), self.table.get("child"))
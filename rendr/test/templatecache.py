@@ -0,0 +1,27 @@
+import unittest
+from rendr import templatecache
+
+
+class TemplateCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.templates = templatecache.TemplateCache(max_entries=2)
+
+    def test_render(self):
+        key = ("lib", "rendr", "body")
+        for name in ("a", "b"):
+            self.assertEqual(u"<b>%s</b>" % name, self.templates.render(key,
+                "<b>{{name}}</b>", {"name": name}))
+        self.assertEqual({"hits": 1, "misses": 1}, self.templates.stats)
+
+    def test_source_changed(self):
+        key = ("lib", "rendr", "body")
+        self.templates.render(key, "{{a}}", {"a": 1})
+        self.assertEqual(u"2!", self.templates.render(key, "{{a}}!",
+            {"a": 2}))
+        self.assertEqual(2, self.templates.stats["misses"])
+
+    def test_evict(self):
+        for key in ("a", "b", "c"):
+            self.templates.parse(key, "{{x}}")
+        self.templates.parse("a", "{{x}}")
+        self.assertEqual(4, self.templates.stats["misses"])
@@ -0,0 +1,103 @@
+#Copyright (C) 2012 TaguchiMarketing Pty Ltd
+#
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+#
+#The above copyright notice and this permission notice shall be included in
+#all copies or substantial portions of the Software.
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+
+import os
+import hmac
+import logging
+import binascii
+import functools
+import tornado.ioloop
+import tornado.httpclient
+import tornado.stack_context
+
+
+# Requests from this server to itself with this header set to "background"
+# are rendered at low priority
+PRIORITY_HEADER = "X-Rendr-Priority"
+
+# ...and with this header, are rendered from the given revision of the
+# rendr, even if the process serving them has an older one cached
+REVISION_HEADER = "X-Rendr-Revision"
+
+# The warmer proves its requests are from this server by sending this
+# header with the secret below; on other requests, the headers above are
+# ignored. Server processes forked after this module is imported share the
+# secret.
+SECRET_HEADER = "X-Rendr-Warmer"
+SECRET = binascii.hexlify(os.urandom(16))
+
+
+def from_warmer(request):
+    """
+    Returns True if `request` was made by a `CacheWarmer` of this server.
+    """
+    return hmac.compare_digest(request.headers.get(SECRET_HEADER, ""),
+        SECRET)
+
+
+class CacheWarmer(object):
+    """
+    Renders images into the cache ahead of time, by requesting them from the
+    server on `port` as background renders, `max_clients` at a time. With
+    several server processes, any of them may serve a request, so requests
+    name the revision to render.
+
+    Counts of images requested, warmed and failed are kept in `stats`.
+    """
+    def __init__(self, port, max_clients=None, io_loop=None):
+        self.port = port
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.stats = dict.fromkeys(("requested", "warmed", "failed"), 0)
+
+        self.http_client = tornado.httpclient.AsyncHTTPClient(self.io_loop,
+            max_clients=max_clients or 2, force_instance=True)
+
+    def warm(self, paths, callback=None, revision=None):
+        """
+        Requests each of the image `paths`, e.g. "/lib/rendr/hello.png", of
+        the rendr `revision`, and then calls `callback`, if given, with the
+        number that failed.
+        """
+        callback = tornado.stack_context.wrap(callback)
+        pending = [len(paths), 0]
+        def on_response(path, response):
+            if response.code == 200:
+                self.stats["warmed"] += 1
+            else:
+                self.stats["failed"] += 1
+                pending[1] += 1
+                logging.warning("CacheWarmer.warm(path=%s): %d" % (path,
+                    response.code))
+
+            pending[0] -= 1
+            if not pending[0] and callback:
+                callback(pending[1])
+
+        if not paths and callback:
+            callback(0)
+        headers = {PRIORITY_HEADER: "background", SECRET_HEADER: SECRET}
+        if revision:
+            headers[REVISION_HEADER] = revision
+        for path in paths:
+            self.stats["requested"] += 1
+            self.http_client.fetch("http://127.0.0.1:%d%s" % (self.port,
+                path), functools.partial(on_response, path),
+                headers=headers)
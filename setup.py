@@ -4,13 +4,16 @@ setup(
     name='rendr.it',
     version='1.0dev1',
     packages=['rendr', 'rendr.test'],
-    scripts=['bin/server'],
+    scripts=['bin/server', 'bin/rebuild-index'],
     package_data={'rendr': ['script/rasterize', 'template/*.html',
         'static/css/*.css', 'static/font/*', 'static/img/*',
         'static/js/ace/*.js', 'static/js/*.js', 'static/robots.txt',
-        'static/favicon.ico']},
+        'static/favicon.ico'],
+        'rendr.test': ['fake_rasterize']},
     install_requires=['tornado>=2.1', 'pystache', 'slimit', 'cssmin',
-        "passlib", "pil>=1.1.7"],
+        "passlib", "Pillow>=6.0"],
+    # Keep-alive connections to S3
+    extras_require={'curl': ['pycurl']},
     dependency_links=['https://github.com/rspivak/slimit/tarball/master#egg=slimit-0.7.4'],
 
     # meta